@@ -3,17 +3,21 @@ import pandas as pd
 from datetime import datetime
 from difflib import SequenceMatcher
 from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor
 
 from lib.ble_device import ble_device
-from lib.db import DB
+from lib.db import DB, warn_unmigrated
 from lib.similarity import similarity
+from lib.ble_features import ble_features
+from lib.ble_linking import ble_linker
+from lib.text_similarity import trigram_index
 from lib.ble_gatt import GattService, GattCharacteristic, GattDescriptor
 
 class ble_stats:
     TBL_TIME = "time"
     TBL_DEV = "ble_device"
     TBL_DEV_TIME = "ble_device_time"
+    TBL_SIGHTING = "ble_sighting"
+    TBL_LOCATION = "location"
     TBL_SVC = "ble_service"
     TBL_CHAR = "ble_characteristic"
     TBL_DESC = "ble_descriptor"
@@ -30,10 +34,13 @@ Requesting information ...""",
             ]
 
     attributes = []
+    features = None
+    name_index = None
 
     def __init__(self, db):
         self.db = db
 
+        warn_unmigrated(self.db)
         self.TBL_DEV_names = self.db.get_columns(self.TBL_DEV)
         # self.TBL_SVC_names = self.db.get_columns(self.TBL_SVC)
 
@@ -62,29 +69,38 @@ Requesting information ...""",
     def get_all_devices(self):
         return pd.Series(self.db.execute(f"SELECT id, name, address FROM {self.TBL_DEV}")).unique()
 
-    def find_most_seen_devices(self):
+    def find_most_seen_devices(self, min_span=60*60*24):
+        # devices seen over a span of at least min_span seconds (default 24h)
         res = self.db.execute(f"""
-            SELECT ble_device.address, time.timestamp
-            FROM {self.TBL_DEV_TIME}
-            JOIN {self.TBL_DEV} ON ble_device_time.device_id = ble_device.id
-            JOIN {self.TBL_TIME} ON ble_device_time.time_id = time.id
+            SELECT d.address
+            FROM {self.TBL_SIGHTING} s
+            JOIN {self.TBL_DEV} d ON s.device_id = d.id
+            GROUP BY d.address
+            HAVING MAX(s.ts) - MIN(s.ts) >= {int(min_span)}
         """)
-            # WHERE ble_device.addresstype = 'random';
-
-        device_timestamps = defaultdict(list)
-        for address, timestamp in res:
-            device_timestamps[address].append(datetime.fromisoformat(timestamp))
-
-        interesting_devices = []
-        for address, timestamps in device_timestamps.items():
-            timestamps.sort()
-            if (timestamps[-1] - timestamps[0]).total_seconds() >= 60*60*24: # 24h
-                interesting_devices.append(address)
-
-        return interesting_devices
-
-    def search_device(self, search):
-        return pd.Series(self.db.execute(f"SELECT id, name, address FROM {self.TBL_DEV} WHERE name LIKE '%{search}%'")).unique()
+            # WHERE d.addresstype = 'random'
+
+        return [r[0] for r in res] if res else []
+
+    def get_name_index(self, reload=False):
+        # trigram index of all device names, see lib/text_similarity.py
+        if self.name_index is None or reload:
+            names = self.db.execute(f"SELECT DISTINCT name FROM {self.TBL_DEV} WHERE name IS NOT NULL") or []
+            self.name_index = trigram_index(r[0] for r in names if r[0])
+        return self.name_index
+
+    def search_device(self, search, threshold=0.6):
+        # names containing search, then similar names (typos, other counters or serials), best first
+        res = self.db.execute(f"SELECT id, name, address FROM {self.TBL_DEV} WHERE name LIKE '%{search}%'") or []
+        similar = [name for name, _ in self.get_name_index().search(search, threshold)]
+        by_name = defaultdict(list)
+        for start in range(0, len(similar), 500):
+            names = {f"n{i}": name for i, name in enumerate(similar[start:start + 500])}
+            rows = self.db.execute(f"SELECT id, name, address FROM {self.TBL_DEV} WHERE name IN ({', '.join(':' + k for k in names)})", names) or []
+            for row in rows:
+                by_name[row[1]].append(row)
+        res = list(res) + [row for name in similar for row in by_name[name]]
+        return pd.Series(res).unique()
 
     def get_device(self, device_id):
 
@@ -95,17 +111,23 @@ Requesting information ...""",
 
         dev = ble_device(res[0])
 
-        dev.add_timings(self.db.execute(f"""SELECT t.timestamp, t.geolocation FROM {self.TBL_TIME} t
-                            INNER JOIN {self.TBL_DEV_TIME} dt ON t.id = dt.time_id
-                            WHERE dt.device_id = {device_id}
+        dev.add_timings(self.db.execute(f"""SELECT s.ts, l.name FROM {self.TBL_SIGHTING} s
+                            LEFT JOIN {self.TBL_LOCATION} l ON s.location_id = l.id
+                            WHERE s.device_id = {device_id}
+                            ORDER BY s.ts
                             """))
 
+        dev.services = self.get_services(dev.address)
+
+        return dev
+
+    def get_services(self, address):
         # get services, characteristics, descriptors
         char_info = []
         try:
             char_info = self.db.execute(f"""SELECT service_id, char_id
                                          FROM {self.TBL_DEV_CHAR}
-                                         WHERE device_address = '{dev.address}'
+                                         WHERE device_address = '{address}'
                                          """)
                                          # WHERE device_id = {device_id}
         except:
@@ -146,9 +168,7 @@ Requesting information ...""",
         for svc in services.values():
             parsed_services[svc.handle] = svc
 
-        dev.services = parsed_services
-
-        return dev
+        return parsed_services
 
     def get_devices_by_attribute(self, attribute, val = None, dev_origin: ble_device = None):
         if val:
@@ -171,100 +191,41 @@ Requesting information ...""",
 
         return devices
 
-    def calculate_similarity_from_attributes(self, original_attributes, random_device):
-        def _is_none_val(val):
-            if not val:
-                return True
-            elif isinstance(val, (list, set, dict)) and len(val) <= 0:
-                return True
-            else:
-                return False
+    def evaluation_stats(self):
+        # compared and pruned devices per attribute of the cascade in ble_features.top
+        if self.features is None:
+            return {}
+        return dict(self.features.stats.snapshot()["counters"])
 
-        similarity_score = 0
-        total_weight = 0
-
-        for attr, weight, checker_fun in self.attributes:
-            if attr in original_attributes and getattr(random_device, attr, None) is not None:
-                # TODO UPDATE HERE (check for None. if both: ignore, if one: 0) if list/set/dict check len()
-                original_attr = original_attributes[attr]
-                random_attr = random_device[attr]
-                if _is_none_val(original_attr) and _is_none_val(random_attr):
-                    # ignore value if both are None (empty lists/... count as None)
-                    pass
-                elif _is_none_val(original_attr) or _is_none_val(random_attr):
-                    # if one is None, don't call checker_fun
-                    total_weight += weight
-                else:
-                    similarity_score += weight * similarity.calculate_similarity(original_attr, random_attr, checker_fun)
-                    total_weight += weight
-
-        return similarity_score / total_weight if total_weight > 0 else 0
-
-    def find_similar_devices(self, device_id, chunk_size=100, similarity_threshold=0.1, max_workers=8):
-        def get_db_connection():
-            return DB(self.db.path)
-
-        def process_chunk(chunk_offset):
-            local_db = get_db_connection()
-
-            random_devices_data = local_db.execute(
-                f"""
-                SELECT * FROM {self.TBL_DEV}
-                LIMIT {chunk_size} OFFSET {chunk_offset}
-                """
-            )
-            # TODO WHERE id NOT IN ({','.join(str(d.id) for d in original_devices)})
-
-            likely_matches_chunk = []
-            for device_data in random_devices_data:
-                random_device = ble_device(device_data)
-
-                similarity_sum = 0
-                for original_attributes in original_unique_attributes:
-
-                    sim = self.calculate_similarity_from_attributes(
-                        original_attributes, random_device
-                    )
-                    similarity_sum += sim
-
-                similarity_sum = similarity_sum / len(original_devices)
-                if similarity_sum >= similarity_threshold:
-                    likely_matches_chunk.append((random_device.id, similarity_sum))
-                    # print(f"Likely match found: Device ID = {random_device.id}, similarity = {similarity_sum:.2f}")
-
-            return likely_matches_chunk
+    def get_features(self, reload=False):
+        # all devices encoded once, see lib/ble_features.py
+        if self.features is None or reload:
+            self.features = ble_features(self.db, self.attributes)
+        return self.features
 
+    def find_similar_devices(self, device_id, similarity_threshold=0.1, top_k=100):
+        # the top_k devices (all if None) most similar to device_id and the devices sharing its address
         original_device = self.get_device(device_id)
         original_devices = self.get_devices_by_attribute("address", original_device.address)
 
         print(f"found {len(original_devices)} devices with the same address as {device_id}")
 
-        original_unique_attributes = [
-            {attr: dev[attr] for attr, _, _ in self.attributes if dev[attr] is not None}
-            for dev in original_devices
-        ]
-
-        likely_matches = []
-        offset = 0
-
-        total_rows = self.db.execute(
-            f"""
-            SELECT COUNT(*) FROM {self.TBL_DEV}
-            """
-            # WHERE id NOT IN ({','.join(str(d.id) for d in original_devices)})
-        )[0][0]
+        features = self.get_features()
+        rows = [features.row(dev.id) for dev in original_devices]
+        if None in rows:
+            # inserted since the features were loaded
+            features = self.get_features(reload=True)
+            rows = [features.row(dev.id) for dev in original_devices]
 
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            offsets = range(0, total_rows, chunk_size)
+        def get_services(dev_id):
+            return self.get_services(features.value("address", features.row(dev_id)))
 
-            test = process_chunk(offsets[0])
+        likely_matches = features.top(
+                rows, k=top_k, threshold=similarity_threshold,
+                services=[dev.services for dev in original_devices],
+                get_services=get_services,
+                )
 
-            futures = [executor.submit(process_chunk, offset) for offset in offsets]
-
-            for future in futures:
-                likely_matches.extend(future.result())
-
-        likely_matches = sorted(likely_matches, key=lambda x: x[1], reverse=True)
         if len(likely_matches) == 0:
             print(f"Found no likely matches")
         else:
@@ -272,20 +233,39 @@ Requesting information ...""",
 
         return likely_matches
 
-    def find_interesting_random_devices(self, chunk_size=100, similarity_threshold=0.1, max_workers=8):
-        devices = self.db.execute(f"SELECT id,manufacturers FROM {self.TBL_DEV} WHERE addresstype = 'random'")
+    def find_interesting_random_devices(self, similarity_threshold=0.8, save=True):
+        # links all devices (see lib/ble_linking.py) and prints the clusters
+        # which contain random addresses and more than one address
+        features = self.get_features()
+        linker = ble_linker(features)
 
-        covered_devices = []
-        devices = [d[0] for d in devices]
-        for d in devices: # this could exclude some but this just takes too long
-            if d in covered_devices \
-                or self.get_device(d).manufacturers == "Apple, Inc.": # Apple has way too many...
-                continue
+        def get_services(dev_id):
+            return self.get_services(features.value("address", features.row(dev_id)))
 
-            check, devs = self.check_similar_devices(d, chunk_size, similarity_threshold, max_workers)
-            covered_devices = covered_devices + devs
-            if check > 0:
-                print(f"{d}\t{check}")
+        linker.link(similarity_threshold, get_services=get_services)
+        if save:
+            linker.save(self.db)
+
+        addresses = features.by_name["address"]
+        interesting = {}
+        for cluster_id, dev_ids in linker.clusters().items():
+            rows = [features.row(d) for d in dev_ids]
+            if not features.random_address[rows].any():
+                continue
+            n_addresses = len({addresses.codes[r] for r in rows})
+            if n_addresses > 1:
+                interesting[cluster_id] = dev_ids
+                print(f"{cluster_id}\t{n_addresses} addresses\t{len(dev_ids)} devices")
+        return interesting
+
+    def get_cluster(self, device_id):
+        # devices linked to device_id by the last find_interesting_random_devices
+        res = self.db.execute(f"""SELECT c2.device_id FROM ble_cluster c1
+                                JOIN ble_cluster c2 ON c1.cluster_id = c2.cluster_id
+                                WHERE c1.device_id = {int(device_id)}
+                                ORDER BY c2.device_id
+                                """)
+        return [r[0] for r in res] if res else [device_id]
 
     def print_all_timings(self, devices):
         timings = []
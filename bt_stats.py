@@ -3,7 +3,7 @@ import pandas as pd
 from collections import Counter
 
 from lib.bt_device import bt_device
-from lib.db import DB
+from lib.db import DB, warn_unmigrated
 
 class bt_stats:
     TBL_TIME = "time"
@@ -11,6 +11,8 @@ class bt_stats:
     TBL_SVC = "bluetooth_service"
     TBL_DEV_SVC = "bluetooth_device_service"
     TBL_DEV_TIME = "bluetooth_device_time"
+    TBL_SIGHTING = "bluetooth_sighting"
+    TBL_LOCATION = "location"
 
     interest_score = -1
     summary = None
@@ -26,6 +28,7 @@ Requesting information ...""",
         if device_id is not None:
             self.parse_id(device_id)
 
+        warn_unmigrated(self.db)
         self.TBL_DEV_names = self.db.get_columns(self.TBL_DEV)
         self.TBL_SVC_names = self.db.get_columns(self.TBL_SVC)
 
@@ -56,17 +59,19 @@ Requesting information ...""",
         self.interest_score = interest_score
         self.summary = summary
 
-    def get_device(self, device_id):
+    def get_device(self, device_id, update_manufacturer=True):
 
         dev = bt_device(
                 self.db.execute(f"SELECT * FROM {self.TBL_DEV} WHERE id = '{device_id}'")[0]
                 )
-        dev.update_manufacturer()
+        if update_manufacturer:
+            dev.update_manufacturer()
 
-        dev.add_timings(self.db.execute(f"""SELECT t.timestamp, t.geolocation FROM {self.TBL_TIME} t
-                            INNER JOIN {self.TBL_DEV_TIME} dt ON t.id = dt.time_id
-                            WHERE dt.device_id = {device_id}
-                            """))
+        dev.add_timings(self.db.execute(f"""SELECT s.ts, l.name FROM {self.TBL_SIGHTING} s
+                            LEFT JOIN {self.TBL_LOCATION} l ON s.location_id = l.id
+                            WHERE s.device_id = {device_id}
+                            ORDER BY s.ts
+                            """) or [])
 
         services = self.db.execute(f"""SELECT * FROM {self.TBL_SVC} s
                                        INNER JOIN {self.TBL_DEV_SVC} ds ON s.id = ds.service_id
@@ -101,7 +106,8 @@ Requesting information ...""",
         dev_ids = [i[0] for i in dev_ids]
 
         for dev_id in dev_ids:
-            devices.append(self.get_device(dev_id))
+            devices.append(self.get_device(dev_id, update_manufacturer=False))
+        bt_device.update_manufacturers(devices)
 
         return devices
 
@@ -178,5 +184,5 @@ def pr(device):
     print(device.get_timings_minmax())
 
 DB_PATH = "db/2024.db"
-db = DB(DB_PATH)
+db = DB(DB_PATH, profile="analysis")
 bt = bt_stats(db)
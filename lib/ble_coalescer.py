@@ -0,0 +1,185 @@
+import hashlib
+import threading
+import time
+
+from lib.metrics import metrics
+from lib.log import log
+
+class advert_record:
+    # all adverts of one (address, payload) within one coalescing window
+    __slots__ = ("device", "advertisement", "first_seen", "last_seen", "count", "rssi_min", "rssi_max", "rssi_last",
+                 "rssi_by_adapter", "adapter")
+
+    def __init__(self, device, advertisement, now, rssi, adapter=None):
+        self.device = device
+        self.advertisement = advertisement
+        self.first_seen = now
+        self.last_seen = now
+        self.count = 1
+        self.rssi_min = rssi
+        self.rssi_max = rssi
+        self.rssi_last = rssi
+        self.rssi_by_adapter = {adapter: rssi} if adapter is not None else {}
+        self.adapter = adapter # the one with the strongest signal
+
+    def add(self, device, advertisement, now, rssi, adapter=None):
+        # keep the newest bleak objects, they carry the same payload
+        self.device = device
+        self.advertisement = advertisement
+        self.last_seen = now
+        self.count += 1
+        if adapter is not None:
+            best = self.rssi_by_adapter.get(adapter)
+            if best is None or (rssi is not None and rssi > best):
+                self.rssi_by_adapter[adapter] = rssi
+        if rssi is not None:
+            self.rssi_last = rssi
+            if self.rssi_min is None or rssi < self.rssi_min:
+                self.rssi_min = rssi
+            if self.rssi_max is None or rssi > self.rssi_max:
+                self.rssi_max = rssi
+                if adapter is not None:
+                    self.adapter = adapter
+        if self.adapter is None:
+            self.adapter = adapter
+
+class ble_coalescer:
+    # Sits between ble_scanner and the consumers: repeats of the same advert
+    # are folded into one advert_record per window, so the consumers only
+    # run once per distinct device and payload.
+
+    # props which change between otherwise identical adverts (or the same advert on another adapter)
+    volatile_props = ("RSSI", "Adapter")
+
+    def __init__(self, callback, window=1.0, max_pending=50000):
+        self.callback = callback
+        self.window = window
+        self.max_pending = max_pending
+        self.pending = {} # (address, digest) -> advert_record
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self.thread = None
+        self.stats = metrics()
+
+    def __call__(self, device, advertisement, adapter=None):
+        # can directly be used as ble_scanner callback
+        self.add(device, advertisement, adapter)
+
+    @staticmethod
+    def _freeze(value):
+        if isinstance(value, dict):
+            return tuple(sorted((str(k), ble_coalescer._freeze(v)) for k, v in value.items()))
+        if isinstance(value, (list, tuple, set)):
+            return tuple(ble_coalescer._freeze(v) for v in value)
+        if isinstance(value, (bytes, bytearray)):
+            return bytes(value)
+        return value
+
+    def digest(self, device, advertisement):
+        details = getattr(device, "details", None)
+        props = details.get("props") if isinstance(details, dict) else None
+        if props:
+            payload = {k: v for k, v in props.items() if k not in self.volatile_props}
+        elif advertisement is not None:
+            payload = {
+                "name": advertisement.local_name,
+                "manufacturer_data": advertisement.manufacturer_data,
+                "service_data": advertisement.service_data,
+                "service_uuids": advertisement.service_uuids,
+                "tx_power": advertisement.tx_power,
+            }
+        else:
+            payload = {"name": device.name}
+        return hashlib.blake2b(repr(self._freeze(payload)).encode(), digest_size=8).digest()
+
+    @staticmethod
+    def _rssi(device, advertisement):
+        if advertisement is not None and advertisement.rssi is not None:
+            return advertisement.rssi
+        details = getattr(device, "details", None)
+        if isinstance(details, dict):
+            return (details.get("props") or {}).get("RSSI")
+        return None
+
+    @staticmethod
+    def adapter(device):
+        # bluez object path of the adapter, e.g. /org/bluez/hci0 -> hci0
+        details = getattr(device, "details", None)
+        if isinstance(details, dict):
+            path = (details.get("props") or {}).get("Adapter")
+            if path:
+                return str(path).rsplit("/", 1)[-1]
+        return None
+
+    def add(self, device, advertisement=None, adapter=None):
+        now = time.time()
+        rssi = self._rssi(device, advertisement)
+        if adapter is None:
+            adapter = self.adapter(device)
+        key = (device.address, self.digest(device, advertisement))
+        self.stats.incr("adverts")
+
+        overflow = None
+        with self._lock:
+            record = self.pending.get(key)
+            if record is not None:
+                record.add(device, advertisement, now, rssi, adapter)
+                if adapter is not None:
+                    self.stats.incr(f"adverts_{adapter}")
+                return
+
+            record = advert_record(device, advertisement, now, rssi, adapter)
+            if adapter is not None:
+                self.stats.incr(f"adverts_{adapter}")
+                self.stats.incr(f"first_{adapter}") # first to see this advert in the window
+            if len(self.pending) < self.max_pending:
+                self.pending[key] = record
+            else:
+                overflow = record
+
+        if overflow is not None:
+            # too many distinct adverts, pass it on without coalescing
+            self.stats.incr("overflow")
+            self._emit([overflow])
+
+    def _emit(self, records):
+        for record in records:
+            try:
+                self.callback(record)
+            except Exception as e:
+                log.error(f"Error in coalesced advert callback: {e}")
+        self.stats.incr("records", len(records))
+
+    def flush(self, force=False):
+        now = time.time()
+        with self._lock:
+            if force:
+                done = list(self.pending.values())
+                self.pending.clear()
+            else:
+                done_keys = [k for k, r in self.pending.items() if r.first_seen + self.window <= now]
+                done = [self.pending.pop(k) for k in done_keys]
+            self.stats.gauge("pending", len(self.pending))
+
+        if done:
+            self._emit(done)
+        return len(done)
+
+    def _run(self):
+        while not self._stopping.wait(min(self.window / 2, 0.5)):
+            self.flush()
+
+    def start(self):
+        self._stopping.clear()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def is_alive(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def stop(self):
+        self._stopping.set()
+        if self.thread:
+            self.thread.join()
+        self.flush(force=True)
+        log.debug(f"Advert coalescer stopped: {self.stats}")
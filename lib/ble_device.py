@@ -1,85 +1,107 @@
 import datetime
+import operator
 from bleak.backends.device import BLEDevice
 
 from lib.manufacturers import Manufacturer
 from lib.ieee import IEEE
 from lib.device_classes import CoD
+from lib.ble_coalescer import advert_record
 from lib.log import log
 
 class ble_device:
     manu = Manufacturer()
     ieee = IEEE()
+
+    # column order of the ble_device table
+    db_fields = ("id", "name", "name2", "address", "address2", "addresstype",
+                 "alias", "appearance", "paired", "bonded", "trusted", "blocked", "legacypairing",
+                 "connected", "uuids", "manufacturers", "manufacturer_binary", "servicedata",
+                 "advertisingflags", "advertisingdata", "txpower", "servicesresolved", "class_of_device", "modalias",
+                 "icon")
+    attributes = ("name", "name2", "address", "address2", "addresstype", "alias",
+                  "appearance", "paired", "bonded", "trusted", "blocked", "legacypairing",
+                  "rssi", "connected", "uuids", "manufacturers",
+                  "manufacturer_binary", "servicedata", "advertisingflags",
+                  "advertisingdata", "txpower", "servicesresolved", "class_of_device",
+                  "modalias", "icon")
+    # fixed layout, no __dict__ and no reference to the bleak objects
+    done_props = ("Class", "Modalias", "Icon", "Name", "Address", "AddressType", "Alias", "Appearance", "Paired", "Bonded", "Trusted", "Blocked", "LegacyPairing", "RSSI", "Connected", "UUIDs", "ManufacturerData", "ServiceData", "AdvertisingFlags", "AdvertisingData", "TxPower", "ServicesResolved", "Adapter")
+
+    __slots__ = db_fields + ("rssi", "timestamp", "geolocation", "adapter", "rssi_by_adapter", "timings", "services", "device_type")
+
+    _get_attributes = operator.attrgetter(*attributes)
+
     def __init__(self, device):
         if isinstance(device, BLEDevice):
             self.__init_new_device(device)
+        elif isinstance(device, advert_record):
+            self.__init_new_device(device.device)
+            self.__init_record(device)
         elif isinstance(device, tuple):
             self.__init_db_device(device)
         else:
             log.error("wrong input for ble_device")
 
+    @classmethod
+    def from_row(cls, row, parse=True):
+        # parse=False skips the manufacturer and device type lookups for bulk loads
+        dev = cls.__new__(cls)
+        dev.__init_db_device(row, parse)
+        return dev
+
+    @staticmethod
+    def __hex_dict(value):
+        if value:
+            return str({k: str(v.hex()) for k, v in value.items()})
+        return None
+
     def __init_new_device(self, device):
-        self.details = device.details
-        self.props = self.details['props']
+        props = device.details['props'] or {}
+        get = props.get
 
+        self.id = None
         self.name = device.name
-        self.name2 = self.__in_props("Name")
+        self.name2 = get("Name")
         self.address = device.address
-        self.address2 = self.__in_props("Address")
-        self.addresstype = self.__in_props("AddressType")
-        self.alias = self.__in_props("Alias")
-        self.appearance = self.__in_props("Appearance")
-        self.paired = self.__in_props("Paired")
-        self.bonded = self.__in_props("Bonded")
-        self.trusted = self.__in_props("Trusted")
-        self.blocked = self.__in_props("Blocked")
-        self.servicedata = self.__in_props("ServiceData"),
-        if self.servicedata and self.servicedata[0]:
-            res = {}
-            for k, v in self.servicedata[0].items():
-                res[k] = str(v.hex())
-            self.servicedata = str(res)
-        else:
-            self.servicedata = None
-        self.advertisingflags = self.__in_props("AdvertisingFlags"),
-        if self.advertisingflags and self.advertisingflags[0]:
-            self.advertisingflags = self.advertisingflags[0].hex()
-        else:
-            self.advertisingflags = None
-        self.advertisingdata = self.__in_props("AdvertisingData"),
-        if self.advertisingdata and self.advertisingdata[0]:
-            res = {}
-            for k, v in self.advertisingdata[0].items():
-                res[k] = str(v.hex())
-            self.advertisingdata = str(res)
-        else:
-            self.advertisingdata = None
-        self.legacypairing = self.__in_props("LegacyPairing")
-        self.rssi = self.__in_props("RSSI")
-        self.connected = self.__in_props("Connected")
-        self.uuids = self.__in_props("UUIDs")
+        self.address2 = get("Address")
+        self.addresstype = get("AddressType")
+        self.alias = get("Alias")
+        self.appearance = get("Appearance")
+        self.paired = get("Paired")
+        self.bonded = get("Bonded")
+        self.trusted = get("Trusted")
+        self.blocked = get("Blocked")
+        self.servicedata = self.__hex_dict(get("ServiceData"))
+        flags = get("AdvertisingFlags")
+        self.advertisingflags = flags.hex() if flags else None
+        self.advertisingdata = self.__hex_dict(get("AdvertisingData"))
+        self.legacypairing = get("LegacyPairing")
+        self.rssi = get("RSSI")
+        self.connected = get("Connected")
+        self.uuids = get("UUIDs")
         if self.uuids is not None:
             self.uuids = ",".join(self.uuids)
-        manu_data = self.__in_props("ManufacturerData")
+        manu_data = get("ManufacturerData")
         self.manufacturers = None
         self.manufacturer_binary = None
         if manu_data is not None:
             self.manufacturers = ",".join([str(s) for s in manu_data])
             self.manufacturer_binary = ",".join([b.hex() for b in list(manu_data.values())])
-        self.txpower = self.__in_props("TxPower")
-        self.servicesresolved = self.__in_props("ServicesResolved")
-        self.class_of_device = self.__in_props("Class")
-        self.modalias = self.__in_props("Modalias")
-        self.icon = self.__in_props("Icon")
+        self.txpower = get("TxPower")
+        self.servicesresolved = get("ServicesResolved")
+        self.class_of_device = get("Class")
+        self.modalias = get("Modalias")
+        self.icon = get("Icon")
         self.timestamp = datetime.datetime.now().replace(microsecond=0) # timestamp in seconds
         self.geolocation = None
+        adapter = get("Adapter")
+        self.adapter = str(adapter).rsplit("/", 1)[-1] if adapter else None
+        self.rssi_by_adapter = None
 
+        self.timings = []
         self.services = {}
 
-        self.props = self.details['props']
-
-        done_props = "Class", "Modalias", "Icon", "Name", "Address", "AddressType", "Alias", "Appearance", "Paired", "Bonded", "Trusted", "Blocked", "LegacyPairing", "RSSI", "Connected", "UUIDs", "ManufacturerData", "ServiceData", "AdvertisingFlags", "AdvertisingData", "TxPower", "ServicesResolved", "Adapter"
-
-        missing_props = [p for p in self.props if p not in done_props]
+        missing_props = [p for p in props if p not in self.done_props]
         if missing_props:
             log.warning(f"MISSED PROPS({self.address}): {missing_props}.")
         if self.name != None and self.name2 != None and self.name != self.name2:
@@ -89,18 +111,48 @@ class ble_device:
 
         self.device_type = self.__parse_device_type()
 
+    def __init_record(self, record):
+        # coalesced adverts: strongest signal at the time it was last seen
+        if record.rssi_max is not None:
+            self.rssi = record.rssi_max
+        if record.adapter is not None:
+            self.adapter = record.adapter
+        if len(record.rssi_by_adapter) > 1:
+            # heard by several adapters, the signal of each one is kept as well
+            self.rssi_by_adapter = dict(record.rssi_by_adapter)
+        self.timestamp = datetime.datetime.fromtimestamp(record.last_seen).replace(microsecond=0)
+
     def update_manufacturer(self):
         res = self.parse_manufacturer()
         if res:
             self.manufacturers = res
 
+    @classmethod
+    def update_manufacturers(cls, devices):
+        # batch version of update_manufacturer, for devices loaded with from_row(parse=False)
+        parsed = cls.manu.parse_many([d.manufacturers for d in devices])
+        for dev, res in zip(devices, parsed):
+            if not cls.raw_manufacturers(dev.manufacturers):
+                res = None
+            elif not res and dev.addresstype == 'public':
+                res = cls.ieee.search_address(dev.address)
+            if res:
+                dev.manufacturers = res
+            dev.device_type = dev.__parse_device_type()
+
+    @staticmethod
+    def raw_manufacturers(value):
+        # False for old databases, manufacturers is already parsed
+        if isinstance(value, str):
+            try:
+                int(value.split(",")[0])
+            except ValueError:
+                return False
+        return True
+
     def parse_manufacturer(self):
         # parse using manufacturer data
-        try:
-            # handle old databases (manufacturers is already parsed)
-            if isinstance(self.manufacturers, str):
-                test = int(self.manufacturers.split(",")[0])
-        except ValueError:
+        if not self.raw_manufacturers(self.manufacturers):
             return
 
         res = self.manu.parse(self.manufacturers)
@@ -109,22 +161,20 @@ class ble_device:
         elif self.addresstype == 'public':
             return self.ieee.search_address(self.address)
 
-    def __in_props(self, search):
-        if self.props != None and search in self.props:
-            return self.props[search]
-        else:
-            return None
-
-    def __init_db_device(self, struct):
+    def __init_db_device(self, struct, parse=True):
         (
             self.id, self.name, self.name2, self.address, self.address2, self.addresstype,
             self.alias, self.appearance, self.paired, self.bonded, self.trusted, self.blocked, self.legacypairing,
             self.connected, self.uuids, self.manufacturers, self.manufacturer_binary, self.servicedata,
             self.advertisingflags, self.advertisingdata, self.txpower, self.servicesresolved, self.class_of_device, self.modalias,
             self.icon
-        ) = struct
+        ) = struct[:25] # ignore trailing columns (content hash)
 
         self.rssi = None
+        self.timestamp = None
+        self.geolocation = None
+        self.adapter = None
+        self.rssi_by_adapter = None
 
         # Handle special cases for specific attributes
         if self.manufacturer_binary == "(None,)":
@@ -139,16 +189,14 @@ class ble_device:
         self.timings = []
         self.services = {}
 
-        self.update_manufacturer()
-        self.device_type = self.__parse_device_type()
+        if parse:
+            self.update_manufacturer()
+            self.device_type = self.__parse_device_type()
+        else:
+            self.device_type = None
 
     def get_attributes(self):
-        return ["name", "name2", "address", "address2", "addresstype", "alias",
-                "appearance", "paired", "bonded", "trusted", "blocked", "legacypairing",
-                "legacypairing", "rssi", "connected", "uuids", "manufacturers",
-                "manufacturer_binary", "servicedata", "advertisingflags",
-                "advertisingdata", "txpower", "servicesresolved", "class_of_device",
-                "modalias", "icon"]
+        return list(self.attributes)
 
     def __parse_device_type(self):
         if self.manufacturer_binary and len(self.manufacturer_binary) >= 4:
@@ -202,14 +250,16 @@ class ble_device:
             return "Keyboard"
 
     def __getitem__(self, item):
-        # not nice but makes things so much easier
-        return eval(f"self.{item}")
+        return getattr(self, item)
 
     def __parse_timings(self, timings):
         ret = []
         if timings:
             for t in timings:
-                time = datetime.datetime.strptime(t[0], "%Y-%m-%d %H:%M:%S")
+                if isinstance(t[0], int): # epoch seconds from the sighting tables
+                    time = datetime.datetime.fromtimestamp(t[0])
+                else:
+                    time = datetime.datetime.strptime(t[0], "%Y-%m-%d %H:%M:%S")
                 geo = t[1]
                 ret.append((time, geo))
 
@@ -239,10 +289,7 @@ class ble_device:
         return ret_str
 
     def to_dict(self):
-        res = {}
-        for a in self.get_attributes():
-            res[a] = self[a]
-        return res
+        return dict(zip(self.attributes, self._get_attributes(self)))
 
     def print(self):
         print(self)
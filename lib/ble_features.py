@@ -0,0 +1,486 @@
+import heapq
+import numpy as np
+import pandas as pd
+
+from lib.ble_device import ble_device
+from lib.similarity import similarity, checker_costs
+from lib.payload_similarity import payload_matrix
+from lib.metrics import metrics
+from lib.log import log
+
+# Column-wise encoding of the ble_device table for ble_stats: every attribute
+# is interned into integer codes of a vocabulary of its unique values, so one
+# query is scored against all devices by scoring the vocabulary once and
+# gathering the result with the codes. None is the extra code len(vocab).
+#
+# Scores are the weighted mean of the attribute similarities: an attribute
+# is skipped if one value is None or both are empty, it counts with 0 if only
+# one is empty.
+
+# stored instead of NULL by older databases
+none_strings = {
+    "manufacturer_binary": "(None,)",
+    "advertisingflags": "(None,)",
+    "servicedata": "(None,)",
+}
+
+def _is_none_val(val):
+    if not val:
+        return True
+    elif isinstance(val, (list, set, dict)) and len(val) <= 0:
+        return True
+    return False
+
+class feature_column:
+    # deferred columns are too expensive for the whole vocabulary, the batch
+    # pass only uses an upper bound and the survivors are scored exactly
+    deferred = False
+
+    def __init__(self, name, weight, checker, values, cache_size=64):
+        self.name = name
+        self.weight = weight
+        self.checker = checker
+        codes, vocab = pd.factorize(pd.Series(values, dtype=object))
+        self.vocab = np.asarray(vocab, dtype=object)
+        self.none = len(self.vocab)
+        codes[codes < 0] = self.none
+        self.codes = codes.astype(np.int32)
+        self.empty = np.array([_is_none_val(v) for v in self.vocab] + [True])
+        self.cache_size = cache_size
+        self._cache = {}
+        self.prepare()
+
+    def prepare(self):
+        pass
+
+    def value(self, code):
+        return None if code == self.none else self.vocab[code]
+
+    def counted(self, code):
+        # vocabulary mask of the values which count towards the total weight
+        counted = ~(self.empty & self.empty[code])
+        counted[self.none] = False
+        return counted
+
+    def scores(self, code):
+        # vocabulary scores against the value with the given code
+        res = self._cache.get(code)
+        if res is None:
+            if self.empty[code]:
+                res = np.zeros(self.none + 1)
+            else:
+                res = self._scores(code)
+                res[self.empty] = 0
+            if len(self._cache) >= self.cache_size:
+                self._cache.pop(next(iter(self._cache)))
+            self._cache[code] = res
+        return res
+
+    def _scores(self, code):
+        raise NotImplementedError
+
+    def pair_scores(self, a, b):
+        # scores of the (non empty) code pairs a[i], b[i], each distinct pair is compared once
+        keys = a.astype(np.int64) * (self.none + 1) + b
+        unique, inverse = np.unique(keys, return_inverse=True)
+        res = np.array([self.checker(self.vocab[k // (self.none + 1)], self.vocab[k % (self.none + 1)])
+                        for k in unique.tolist()], dtype=np.float64)
+        return res[inverse]
+
+class exact_column(feature_column):
+    def _scores(self, code):
+        res = np.zeros(self.none + 1)
+        res[code] = 1
+        return res
+
+    def pair_scores(self, a, b):
+        return (a == b).astype(np.float64)
+
+class numeric_column(feature_column):
+    def prepare(self):
+        values = np.full(self.none + 1, np.nan)
+        for i, v in enumerate(self.vocab):
+            try:
+                values[i] = int(v)
+            except (TypeError, ValueError):
+                pass
+        self.values = values
+
+    def _scores(self, code):
+        q = self.values[code]
+        v = self.values
+        with np.errstate(divide="ignore", invalid="ignore"):
+            res = 1 - np.abs(v - q) / np.maximum(np.abs(v), np.abs(q))
+        res = np.nan_to_num(res, nan=0.0, posinf=0.0, neginf=0.0)
+        res[code] = 1
+        return res
+
+    def pair_scores(self, a, b):
+        va, vb = self.values[a], self.values[b]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            res = 1 - np.abs(va - vb) / np.maximum(np.abs(va), np.abs(vb))
+        res = np.nan_to_num(res, nan=0.0, posinf=0.0, neginf=0.0)
+        res[a == b] = 1
+        return res
+
+class set_column(feature_column):
+    # comma separated lists (similarity.uuids), stored as token ids per value
+    def prepare(self):
+        token_ids = {}
+        owners = []
+        tokens = []
+        lengths = np.zeros(self.none + 1)
+        for i, v in enumerate(self.vocab):
+            if self.empty[i]:
+                continue
+            items = str(v).split(",")
+            lengths[i] = len(items)
+            for t in set(items):
+                owners.append(i)
+                tokens.append(token_ids.setdefault(t, len(token_ids)))
+        self.token_ids = token_ids
+        self.owners = np.array(owners, dtype=np.int32)
+        self.tokens = np.array(tokens, dtype=np.int32)
+        self.lengths = lengths
+
+    def _scores(self, code):
+        weights = np.zeros(len(self.token_ids))
+        items = str(self.vocab[code]).split(",")
+        for t in items:
+            weights[self.token_ids[t]] += 1
+        matches = np.bincount(self.owners, weights=weights[self.tokens], minlength=self.none + 1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            res = np.minimum(1, (matches * 2) / np.maximum(len(items), self.lengths))
+        return np.nan_to_num(res, nan=0.0)
+
+class payload_column(feature_column):
+    # hex payloads (similarity.hex) as one byte array, see lib/payload_similarity.py
+    def prepare(self):
+        self.payloads = payload_matrix(list(self.vocab) + [None])
+
+    def _scores(self, code):
+        return self.payloads.similarity(code)
+
+    def pair_scores(self, a, b):
+        return self.payloads.pair_similarity(a, b)
+
+class text_column(feature_column):
+    # SequenceMatcher ratio, bounded by 2 * min(len) / (len1 + len2). Small
+    # vocabularies (names, icons, ...) are scored whole, large ones deferred.
+    zero_strings = ("(bytearray(b'\\x00'),)", "(None,)")
+    max_vocab = 1000
+
+    def prepare(self):
+        self.deferred = self.none > self.max_vocab
+        self.lengths = np.array([len(str(v)) for v in self.vocab] + [0], dtype=np.float64)
+        zero = self.empty.copy()
+        for s in self.zero_strings:
+            zero |= np.array([v == s for v in self.vocab] + [False])
+        self.zero = zero
+
+    def _scores(self, code):
+        q = self.vocab[code]
+        res = np.zeros(self.none + 1)
+        for i, v in enumerate(self.vocab):
+            if not self.zero[i]:
+                res[i] = similarity.text(q, v)
+        return res
+
+    def bound(self, code):
+        if self.zero[code]:
+            return np.zeros(self.none + 1)
+        q = self.lengths[code]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            res = 2 * np.minimum(self.lengths, q) / (self.lengths + q)
+        res[self.zero] = 0
+        return np.nan_to_num(res, nan=0.0)
+
+    def exact(self, code, codes):
+        # scores of the given codes only, remembered per query value
+        known = self._cache.get(code)
+        if known is None:
+            if len(self._cache) >= self.cache_size:
+                self._cache.pop(next(iter(self._cache)))
+            known = self._cache[code] = {}
+        q = self.vocab[code] if not self.empty[code] else None
+        for c in np.unique(codes):
+            if c not in known:
+                known[c] = 0.0 if q is None or self.empty[c] else similarity.text(q, self.vocab[c])
+        return np.array([known[c] for c in codes.tolist()])
+
+column_types = {
+    similarity.exact: exact_column,
+    similarity.numeric: numeric_column,
+    similarity.uuids: set_column,
+    similarity.hex: payload_column,
+    similarity.text: text_column,
+}
+
+class ble_features:
+    # Feature matrices of all BLE devices, built once per ble_stats instance.
+    # top() scores query rows against every device in array operations.
+    chunk_size = 1024
+    seed_size = 4 # devices fully scored per k for the first cut
+    tolerance = 1e-9 # rounding of the bounds
+    compact = 0.75 # devices are dropped once at most this share of them is left
+
+    def __init__(self, db, attributes, table="ble_device"):
+        self.db = db
+        self.table = table
+        self.attributes = [a for a in attributes if a[1] > 0]
+        self.stats = metrics()
+        with self.stats.timer("load"):
+            self.load()
+        log.debug(f"Encoded {len(self.ids)} devices in {self.stats.snapshot()['timings']['load']['total']:.1f}s")
+
+    def load(self):
+        names = [attr for attr, _, checker in self.attributes if checker is not similarity.gatt_services]
+        rows = self.db.execute(f"SELECT id, addresstype, address, {', '.join(names)} FROM {self.table} ORDER BY id") or []
+        cols = list(zip(*rows)) if rows else [()] * (len(names) + 3)
+        self.ids = np.array(cols[0], dtype=np.int64)
+        addresstypes, addresses = cols[1], cols[2]
+        self.random_address = pd.Series(addresstypes, dtype=object).eq("random").to_numpy()
+        del rows
+
+        self.columns = []
+        for (attr, weight, checker), values in zip([a for a in self.attributes if a[0] in names], cols[3:]):
+            if attr in none_strings:
+                values = [None if v == none_strings[attr] else v for v in values]
+            if attr == "manufacturers":
+                values = self.__manufacturers(values, addresstypes, addresses)
+            column_type = column_types.get(checker)
+            if column_type is None:
+                log.warning(f"No feature encoding for {attr}, ignored")
+                continue
+            self.columns.append(column_type(attr, weight, checker, values))
+        self.by_name = {c.name: c for c in self.columns}
+
+        # GATT trees are only compared for the survivors, the batch pass needs to know who has one
+        self.services_weight = sum(w for _, w, checker in self.attributes if checker is similarity.gatt_services)
+        try:
+            with_services = {r[0] for r in self.db.execute("SELECT DISTINCT device_address FROM ble_device_char") or []}
+        except Exception:
+            with_services = set()
+        self.has_services = pd.Series(addresses, dtype=object).isin(with_services).to_numpy()
+
+    @staticmethod
+    def __manufacturers(values, addresstypes, addresses):
+        # same result as ble_device.update_manufacturers, parsed once per unique value
+        unique = list({v for v in values if v is not None})
+        parsed = dict(zip(unique, ble_device.manu.parse_many(unique)))
+        res = []
+        for value, addresstype, address in zip(values, addresstypes, addresses):
+            p = parsed.get(value)
+            if not ble_device.raw_manufacturers(value):
+                p = None
+            elif not p and addresstype == "public":
+                p = ble_device.ieee.search_address(address)
+            res.append(p or value)
+        return res
+
+    def __len__(self):
+        return len(self.ids)
+
+    def row(self, device_id):
+        i = np.searchsorted(self.ids, device_id)
+        if i < len(self.ids) and self.ids[i] == device_id:
+            return int(i)
+        return None
+
+    def value(self, attr, row):
+        column = self.by_name[attr]
+        return column.value(column.codes[row])
+
+    def pair_scores(self, I, J, skip=(), get_services=None):
+        # similarity of the rows I[i] and J[i], attributes in skip are ignored.
+        # Without get_services GATT trees only count if one device has none.
+        score = np.zeros(len(I))
+        weight = np.zeros(len(I))
+        for column in self.columns:
+            if column.name in skip:
+                continue
+            a = column.codes[I]
+            b = column.codes[J]
+            counted = (a != column.none) & (b != column.none) & ~(column.empty[a] & column.empty[b])
+            weight += column.weight * counted
+            both = counted & ~column.empty[a] & ~column.empty[b]
+            if both.any():
+                score[both] += column.weight * column.pair_scores(a[both], b[both])
+
+        if self.services_weight and "services" not in skip:
+            sa = self.has_services[I]
+            sb = self.has_services[J]
+            weight += self.services_weight * (sa != sb)
+            if get_services is not None:
+                trees = {}
+                def tree(row):
+                    if row not in trees:
+                        trees[row] = get_services(int(self.ids[row]))
+                    return trees[row]
+                for i in np.flatnonzero(sa & sb).tolist():
+                    t1, t2 = tree(int(I[i])), tree(int(J[i]))
+                    if t1 or t2:
+                        weight[i] += self.services_weight
+                    if t1 and t2:
+                        score[i] += self.services_weight * similarity.gatt_services(t1, t2)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.nan_to_num(score / weight)
+
+    def cascade(self):
+        # columns by cost per weight: cheap attributes which decide a lot come first
+        return sorted(self.columns, key=lambda c: checker_costs.get(c.checker, 10) / c.weight)
+
+    @staticmethod
+    def _mean(a, b):
+        # a / b, 0 where nothing was compared
+        return np.divide(a, b, out=np.zeros(len(a)), where=b > 0)
+
+    def _upper(self, parts, remaining):
+        # upper bound of the mean similarity while the remaining weight of
+        # every query row is not evaluated yet (it may count with 0 or 1)
+        upper = 0
+        for (score, weight, slack), r in zip(parts, remaining):
+            upper = upper + self._mean(score + slack + r, weight + r)
+        return upper / len(parts)
+
+    def _lower(self, parts):
+        return sum(self._mean(score, weight) for score, weight, _ in parts) / len(parts)
+
+    def _add(self, column, rows, has, devices, parts):
+        # adds one column (None: GATT) of the query rows for the given device rows
+        everything = len(devices) == len(self.ids)
+        if column is not None:
+            codes = column.codes if everything else column.codes[devices]
+        else:
+            present = self.has_services if everything else self.has_services[devices]
+        for i, row in enumerate(rows):
+            score, weight, slack = parts[i]
+            if column is None:
+                weight += self.services_weight if has[i] else self.services_weight * present
+                if has[i]:
+                    slack += self.services_weight * present
+                continue
+            code = column.codes[row]
+            if code == column.none:
+                continue
+            weight += column.weight * column.counted(code)[codes]
+            if column.deferred:
+                slack += column.weight * column.bound(code)[codes]
+            else:
+                score += column.weight * column.scores(code)[codes]
+
+    def _seed_cut(self, rows, has, devices, k):
+        # the k-th best lower bound of some likely matches, a lower bound of
+        # the k-th best similarity to prune the rest with
+        parts = [(np.zeros(len(devices)), np.zeros(len(devices)), np.zeros(len(devices))) for _ in rows]
+        for column in self.columns + [None]:
+            self._add(column, rows, has, devices, parts)
+        lower = self._lower(parts)
+        return np.partition(lower, -k)[-k] if len(lower) >= k else 0
+
+    def top(self, rows, k=None, threshold=0.0, services=None, get_services=None):
+        # Mean similarity of every device to the query rows, the k best (all if
+        # k is None) above threshold as [(device id, similarity)].
+        # services: GATT trees of the query rows, get_services(device_id) loads
+        # the tree of a candidate, without them GATT only counts by presence.
+        if not rows or not len(self.ids):
+            return []
+        has = [bool(services[i]) if services is not None else bool(self.has_services[row]) for i, row in enumerate(rows)]
+        stages = self.cascade() + ([None] if self.services_weight else [])
+        # GATT can only add a match if the query row has a tree, otherwise it
+        # only adds weight for the devices which have one
+        remaining = [sum(c.weight for c in stages if c is not None and c.codes[row] != c.none) + self.services_weight * has[i]
+                     for i, row in enumerate(rows)]
+        totals = list(remaining)
+
+        # Columns are added in cascade order, devices which can't reach the
+        # cut any more are dropped before the next column is gathered. The
+        # cut is the threshold or, for top k, the k-th best lower bound of the
+        # devices leading after the first stage.
+        cut = threshold
+        alive = np.arange(len(self.ids))
+        parts = [(np.zeros(len(alive)), np.zeros(len(alive)), np.zeros(len(alive))) for _ in rows]
+        with self.stats.timer("batch"):
+            for stage, column in enumerate(stages):
+                name = column.name if column is not None else "services"
+                self.stats.incr(f"evaluated_{name}", len(alive))
+                self._add(column, rows, has, alive, parts)
+                for i, row in enumerate(rows):
+                    if column is None:
+                        remaining[i] -= self.services_weight * has[i]
+                    elif column.codes[row] != column.none:
+                        remaining[i] -= column.weight
+                # a device without any match so far still has r / total,
+                # while that reaches the cut no device can be dropped
+                floor = sum(r / t for r, t in zip(remaining, totals) if t) / len(rows)
+                if 0 < stage < len(stages) - 1 and floor >= cut:
+                    continue
+                upper = self._upper(parts, remaining)
+
+                if stage == 0 and k is not None and k < len(alive):
+                    leading = alive[np.argpartition(-upper, min(self.seed_size * k, len(alive) - 1))[:self.seed_size * k]]
+                    cut = max(cut, self._seed_cut(rows, has, leading, k))
+
+                keep = np.flatnonzero(upper >= cut - self.tolerance)
+                # compacting costs about as much as a stage, small prunes wait for the next one
+                if len(keep) < len(alive) and (len(keep) <= self.compact * len(alive) or stage == len(stages) - 1):
+                    self.stats.incr(f"pruned_{name}", len(alive) - len(keep))
+                    alive = alive[keep]
+                    upper = upper[keep]
+                    parts = [(score[keep], weight[keep], slack[keep]) for score, weight, slack in parts]
+
+            if k is not None and k < len(alive):
+                # all columns are in, the lower bounds only miss the deferred part
+                lower = self._lower(parts)
+                keep = upper >= np.partition(lower, -k)[-k] - self.tolerance
+                alive = alive[keep]
+                upper = upper[keep]
+                parts = [(score[keep], weight[keep], slack[keep]) for score, weight, slack in parts]
+
+            order = np.argsort(-upper, kind="stable")
+            self.stats.incr("queries")
+            self.stats.incr("survivors", len(order))
+
+        # exact scores in order of the upper bound, until no bound can beat the k-th best
+        ids = []
+        scores = []
+        best = []
+        with self.stats.timer("exact"):
+            for start in range(0, len(order), self.chunk_size):
+                if k is not None and len(best) >= k and upper[order[start]] < best[0] - self.tolerance:
+                    break
+                chunk = order[start:start + self.chunk_size]
+                total = self._exact(rows, parts, chunk, alive[chunk], services, get_services)
+                self.stats.incr("refined", len(chunk))
+                for i, v in zip(alive[chunk].tolist(), total.tolist()):
+                    if v < threshold:
+                        continue
+                    ids.append(int(self.ids[i]))
+                    scores.append(v)
+                    if k is not None:
+                        if len(best) < k:
+                            heapq.heappush(best, v)
+                        elif v > best[0]:
+                            heapq.heapreplace(best, v)
+
+        matches = sorted(zip(ids, scores), key=lambda x: x[1], reverse=True)
+        return matches if k is None else matches[:k]
+
+    def _exact(self, rows, parts, chunk, chunk_rows, services, get_services):
+        # chunk: positions in parts, chunk_rows: the device rows at these positions
+        total = np.zeros(len(chunk))
+        for i, (row, (score, weight, _)) in enumerate(zip(rows, parts)):
+            score = score[chunk]
+            weight = weight[chunk]
+            for column in self.columns:
+                code = column.codes[row]
+                if column.deferred and code != column.none:
+                    score = score + column.weight * column.exact(code, column.codes[chunk_rows])
+            if self.services_weight and services is not None and services[i] and get_services is not None:
+                for j in np.flatnonzero(self.has_services[chunk_rows]):
+                    other = get_services(int(self.ids[chunk_rows[j]]))
+                    if other:
+                        score[j] += self.services_weight * similarity.gatt_services(services[i], other)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                total += np.nan_to_num(score / weight)
+        return total / len(rows)
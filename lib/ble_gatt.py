@@ -1,146 +1,403 @@
 from bleak import BleakClient
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+import itertools
+import threading
+import time
 
+from lib.gatt_attempts import attempt_tracker
+from lib.gatt_profiles import gatt_profiles
+from lib.metrics import metrics
 from lib.log import log
 
 class ble_gatt:
-    MAX_CONNECTION_TRIES = 3
-    finished_gatts = set()
-    gatt_tries = {}
-
-    def __init__(self, callback):
-        self.gatt_executor = ThreadPoolExecutor(20)
+    # Interrogates connectable devices on one long lived asyncio loop.
+    # Devices wait in a priority queue, at most max_connections are connected
+    # at the same time and each one gets device_timeout seconds. Up to
+    # read_depth reads are in flight per device, reading stops after
+    # read_budget seconds and every finished characteristic is handed to the
+    # callback right away. Failed devices are retried with exponential backoff,
+    # the attempts are saved to state_file, the learned GATT profiles to db.
+    # LE Limited / General Discoverable Mode
+    DISCOVERABLE_FLAGS = 0x01 | 0x02
+
+    def __init__(self, callback, max_connections=3, device_timeout=30, max_queue=1000, read_depth=4, read_budget=20, profiles=None,
+                 attempts=None, state_file=None, snapshot_interval=300, db=None):
         self.callback = callback
+        self.max_connections = max_connections
+        self.device_timeout = device_timeout
+        self.read_depth = read_depth
+        self.read_budget = read_budget
+        self.profiles = profiles if profiles is not None else gatt_profiles()
+        self.max_queue = max_queue
+        self.stats = metrics()
+
+        self.attempts = attempts if attempts is not None else attempt_tracker()
+        self.state_file = state_file
+        self.snapshot_interval = snapshot_interval
+        if state_file:
+            restored = self.attempts.restore(state_file)
+            log.debug(f"Restored {restored} GATT attempts from {state_file}")
+        self.db = db
+        if db is not None:
+            restored = self.profiles.restore(db)
+            log.debug(f"Restored {restored} GATT profiles")
+
+        self.seq = itertools.count()
+        self.queue = None
+        self.semaphore = None
+        self.tasks = set()
+        self.dispatcher = None
+        self.retrier = None
+
+        self.loop = None
+        self.thread = None
+        self.start()
+
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run_loop, daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self._setup(), self.loop).result()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+    async def _setup(self):
+        self.queue = asyncio.PriorityQueue(self.max_queue)
+        self.semaphore = asyncio.Semaphore(self.max_connections)
+        self.dispatcher = asyncio.create_task(self._dispatch())
+        self.retrier = asyncio.create_task(self._retry())
+
+    def priority(self, device):
+        # never seen first, then strong signal, then discoverable devices
+        seen = self.attempts.tries(device.address) > 0
+        rssi = device.rssi if device.rssi is not None else -127
+        try:
+            discoverable = int(device.advertisingflags[:2], 16) & self.DISCOVERABLE_FLAGS
+        except (TypeError, ValueError):
+            discoverable = 0
+        return (seen, -rssi, not discoverable)
 
     def add_possible_device(self, device):
-        # check if in finished_gatts first
-        if not device.address in self.finished_gatts:
+        # not done yet, not queued and not backing off
+        if self.attempts.should_try(device.address, self.profiles.fingerprint(device)):
             self.add_device(device)
 
     def add_device(self, device):
-        self.finished_gatts.add(device.address)
-        self.gatt_executor.submit(self._connect_gatt, device)
-
-    def _connect_gatt(self, device):
-        async def _reconnect(client):
-            if not client.is_connected:
-                await client.connect()
+        self.attempts.queued(device.address)
+        self.loop.call_soon_threadsafe(self._enqueue, device, time.monotonic())
 
-        def _dec_value(value):
-            # decode a byte value
-            if not value:
-                return None
-            elif value.isalnum():
-                return value.decode('utf-8', errors='replace')
+    def _enqueue(self, device, queued):
+        try:
+            self.queue.put_nowait((self.priority(device), next(self.seq), queued, device))
+            self.stats.gauge("queue_depth", self.queue.qsize())
+        except asyncio.QueueFull:
+            # allow it to be queued again when it is seen next time
+            self.attempts.forget(device.address)
+            self.stats.incr("dropped")
+
+    async def _retry(self):
+        last_snapshot = time.monotonic()
+        while True:
+            await asyncio.sleep(1)
+            for device in self.attempts.due():
+                self.stats.incr("retries")
+                self.attempts.queued(device.address)
+                self._enqueue(device, time.monotonic())
+
+            if (self.state_file or self.db is not None) and time.monotonic() - last_snapshot >= self.snapshot_interval:
+                last_snapshot = time.monotonic()
+                await self.loop.run_in_executor(None, self._snapshot)
+            self.stats.gauge("attempts", len(self.attempts))
+
+    def _snapshot(self):
+        if self.state_file:
+            self.attempts.snapshot(self.state_file)
+        if self.db is not None:
+            self.profiles.snapshot(self.db)
+
+    async def _dispatch(self):
+        while True:
+            await self.semaphore.acquire()
+            _, _, queued, device = await self.queue.get()
+            self.stats.gauge("queue_depth", self.queue.qsize())
+            self.stats.observe("queue_wait", time.monotonic() - queued)
+
+            task = asyncio.create_task(self._process(device))
+            self.tasks.add(task)
+            task.add_done_callback(self._done)
+
+    def _done(self, task):
+        self.tasks.discard(task)
+        self.semaphore.release()
+
+    async def _process(self, device):
+        address = device.address
+        result = GattResult()
+        fingerprint = self.profiles.fingerprint(device)
+        try:
+            profile = self.profiles.match(fingerprint)
+            await asyncio.wait_for(self._interrogate(device, result, profile), self.device_timeout)
+            if result.verified is not None:
+                self.profiles.verified(fingerprint, profile, result.verified)
+            if not result.connected:
+                self.stats.incr("not_connected")
+                self.attempts.failure(address, fingerprint, device)
             else:
-                return value.hex()
-
-        async def _get_char(client, uuid, try_again = True):
-            try:
-                if client.is_connected:
-                    value = await client.read_gatt_char(uuid)
-                    return _dec_value(value)
-            except Exception as e:
-                await _reconnect(client)
-                if try_again: # try again on error
-                    return await _get_char(client, uuid, False)
-            return None
-
-        async def _get_desc(client, handle, try_again = True):
-            try:
-                if client.is_connected:
-                    value = await client.read_gatt_descriptor(handle)
-                    return _dec_value(value)
-            except Exception as e:
-                await _reconnect(client)
-                if try_again: # try again on error
-                    return await _get_desc(client, handle, False)
-            return None
+                self.stats.incr("interrogated")
+                self.attempts.success(address, fingerprint)
+                if result.complete and not result.from_profile:
+                    self.profiles.learn(fingerprint, result.services, result.characteristics, result.descriptors)
+        except asyncio.TimeoutError:
+            log.debug(f"GATT interrogation of {address} exceeded {self.device_timeout}s")
+            self.stats.incr("timeouts")
+            self.attempts.failure(address, fingerprint, device)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.debug(f"Error connecting to {address}: {e}")
+            self.stats.incr("failed")
+            # TODO maybe not for all errors? maybe it just doesn't have any
+            self.attempts.failure(address, fingerprint, device)
 
-        async def run(address):
-            log.info(f"Connecting to {address}")
+        # everything which was not handed over while reading
+        self._emit(device, result.services, result.remaining(), result)
 
-            gatt_services = []
-            gatt_characteristics = []
-            gatt_descriptors = []
+    def _emit(self, device, services, characteristics, result):
+        descriptors = [d for c in characteristics for d in result.descriptors_of(c)]
+        result.emitted.update(id(c) for c in characteristics)
+        try:
+            self.callback(device, services, characteristics, descriptors)
+        except Exception as e:
+            log.error(f"Error in GATT callback: {e}")
 
+    @staticmethod
+    def _dec_value(value):
+        # decode a byte value
+        if not value:
+            return None
+        elif value.isalnum():
+            return value.decode('utf-8', errors='replace')
+        else:
+            return value.hex()
+
+    async def _verify(self, device, result, profile):
+        # cheap check of a profile match: only the services of the probes are
+        # discovered and the probes are read back by handle. None: not connected
+        address = device.address
+        log.info(f"Verifying the GATT profile of {address}")
+
+        client = BleakClient(address, services=profile.probe_services() if profile.probes else None)
+        start = time.monotonic()
+        await client.connect()
+        self.stats.observe("connect_time", time.monotonic() - start)
+
+        async def read(key):
             try:
-                async with BleakClient(address) as client:
-                    if not client.is_connected:
-                        log.debug(f"Error connecting to {address}: {e}")
-                        return None
-
-                    for svc in client.services.services.values():
-                        gatt_services.append(GattService(svc))
-
-                    for char in client.services.characteristics.values():
-                        gatt_characteristics.append(GattCharacteristic(char))
-
-                    for desc in client.services.descriptors.values():
-                        gatt_descriptors.append(GattDescriptor(desc))
-
-                    generic_access_characteristics = [
-                        ("00002a00-0000-1000-8000-00805f9b34fb", "Device Name"),
-                        ("00002a01-0000-1000-8000-00805f9b34fb", "Device Appearance"),
-                    ]
-
-                    create_generic_access = False
-                    for uuid, description in generic_access_characteristics:
-                        value = await _get_char(client, uuid)
-                        if value:
-                            create_generic_access = True
-
-                            char = GattCharacteristic(None)
-                            char.description = description
-                            char.uuid = uuid
-                            char.value = value
-                            # char.handle = None # TODO
-                            char.service_handle = 0
-                            gatt_characteristics.append(char)
-
-                    if create_generic_access:
-                        svc = GattService(None)
-                        svc.description = "Generic Access"
-                        svc.handle = 0
-                        svc.uuid = "00001800-0000-1000-8000-00805f9b34fb"
-                        gatt_services.append(svc)
-
-
-                    for char in gatt_characteristics:
-                        if 'read' in char.properties:
-                            char.value = await _get_char(client, char.uuid)
-
-                    for desc in gatt_descriptors:
-                        desc.value = await _get_desc(client, desc.handle)
-
-            except Exception as e:
-                log.debug(f"Error connecting to {address}: {e}")
+                value = await client.read_gatt_char(key)
+                self.stats.incr("reads")
+                return True, self._dec_value(value)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.stats.incr("read_errors")
+                return False, None
 
-                # TODO maybe not for all errors? maybe it just doesn't have any
-                # allow more tries because it failed unexpectedly
-                if not address in self.gatt_tries:
-                    self.gatt_tries[address] = 0
-                self.gatt_tries[address] += 1
-
-                if self.gatt_tries[address] < self.MAX_CONNECTION_TRIES:
-                    self.finished_gatts.remove(address) # retry
+        try:
+            if not client.is_connected:
+                log.debug(f"Error connecting to {address}")
+                return None
+            result.connected = True
 
-            self.callback(device, gatt_services, gatt_characteristics, gatt_descriptors)
+            if profile.probes:
+                for handle, uuid in profile.probes:
+                    char = client.services.get_characteristic(handle)
+                    if char is None or str(char.uuid) != uuid or not (await read(char))[0]:
+                        return False
+            else:
+                # nothing readable to probe, compare the whole tree
+                services = [GattService(s) for s in client.services.services.values()]
+                characteristics = [GattCharacteristic(c) for c in client.services.characteristics.values()]
+                if self.profiles.signature(services, characteristics) != profile.signature:
+                    return False
+
+            # same model as the cached one, only read the per device values
+            values = {}
+            for uuid in self.profiles.verify_uuids:
+                _, values[uuid] = await read(uuid)
+            if not client.is_connected:
+                return False
+            result.services, result.characteristics, result.descriptors = profile.instantiate(values)
+            result.from_profile = True
+            result.complete = True
+            self.stats.incr("profile_hits")
+            return True
+        finally:
+            await client.disconnect()
+
+    async def _interrogate(self, device, result, profile=None):
+        if profile is not None:
+            result.verified = await self._verify(device, result, profile)
+            if result.verified is not False:
+                return # matched or not reachable
+            # a different tree after all, interrogate it completely
+            result.connected = False
+
+        address = device.address
+        log.info(f"Connecting to {address}")
+
+        client = BleakClient(address)
+        start = time.monotonic()
+        await client.connect()
+        self.stats.observe("connect_time", time.monotonic() - start)
+
+        reads = asyncio.Semaphore(self.read_depth)
+        reconnect_lock = asyncio.Lock()
+        reconnected = False
+
+        async def reconnect():
+            # only once per device, a flaky attribute is skipped instead
+            nonlocal reconnected
+            async with reconnect_lock:
+                if client.is_connected or reconnected:
+                    return
+                reconnected = True
+                self.stats.incr("reconnects")
+                try:
+                    await client.connect()
+                except Exception as e:
+                    log.debug(f"Error reconnecting to {address}: {e}")
+
+        async def read(fun, key):
+            async with reads:
+                if not client.is_connected:
+                    return None
+                try:
+                    value = await fun(key)
+                    self.stats.incr("reads")
+                    return self._dec_value(value)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    self.stats.incr("read_errors")
+            await reconnect()
+            return None
 
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
+        async def read_characteristic(char):
+            if 'read' in char.properties:
+                char.value = await read(client.read_gatt_char, char.handle if char.handle is not None else char.uuid)
+            descriptors = result.descriptors_of(char)
+            values = await asyncio.gather(*[read(client.read_gatt_descriptor, d.handle) for d in descriptors])
+            for desc, value in zip(descriptors, values):
+                desc.value = value
+            # persist it now, the budget might run out before the other ones are done
+            self._emit(device, [s for s in result.services if s.handle == char.service_handle], [char], result)
+
+        tasks = []
         try:
-            loop.run_until_complete(run(device.address))
-        except asyncio.CancelledError:
-            pass
-        except Exception as e:
-            log.error(f"Error in scanning loop: {e}")
+            if not client.is_connected:
+                log.debug(f"Error connecting to {address}")
+                return
+            result.connected = True
+
+            start = time.monotonic()
+            deadline = start + self.read_budget
+            for svc in client.services.services.values():
+                result.services.append(GattService(svc))
+
+            for char in client.services.characteristics.values():
+                result.characteristics.append(GattCharacteristic(char))
+
+            for desc in client.services.descriptors.values():
+                result.descriptors.append(GattDescriptor(desc))
+
+            generic_access_characteristics = [
+                ("00002a00-0000-1000-8000-00805f9b34fb", "Device Name"),
+                ("00002a01-0000-1000-8000-00805f9b34fb", "Device Appearance"),
+            ]
+
+            values = await asyncio.gather(*[read(client.read_gatt_char, uuid) for uuid, _ in generic_access_characteristics])
+            create_generic_access = False
+            for (uuid, description), value in zip(generic_access_characteristics, values):
+                if value:
+                    create_generic_access = True
+
+                    char = GattCharacteristic(None)
+                    char.description = description
+                    char.uuid = uuid
+                    char.value = value
+                    # char.handle = None # TODO
+                    char.service_handle = 0
+                    result.characteristics.append(char)
+
+            if create_generic_access:
+                svc = GattService(None)
+                svc.description = "Generic Access"
+                svc.handle = 0
+                svc.uuid = "00001800-0000-1000-8000-00805f9b34fb"
+                result.services.append(svc)
+
+            tasks = [asyncio.create_task(read_characteristic(c)) for c in result.characteristics]
+            pending = None
+            if tasks:
+                _, pending = await asyncio.wait(tasks, timeout=max(0, deadline - time.monotonic()))
+                if pending:
+                    log.debug(f"GATT read budget of {self.read_budget}s exceeded for {address}, {len(pending)} characteristics left")
+                    self.stats.incr("budget_exceeded")
+            result.complete = client.is_connected and not (tasks and pending)
+
+            self.stats.observe("read_time", time.monotonic() - start)
         finally:
-            self.loop.close()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await client.disconnect()
+
+    async def _shutdown(self):
+        self.dispatcher.cancel()
+        self.retrier.cancel()
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(self.dispatcher, self.retrier, *self.tasks, return_exceptions=True)
+
+    def is_alive(self):
+        return self.thread is not None and self.thread.is_alive()
 
     def stop(self):
-        self.gatt_executor.shutdown(wait=True, cancel_futures=True)
+        if self.loop.is_running():
+            try:
+                asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result(timeout=10)
+            except Exception as e:
+                log.error(f"Error stopping GATT scheduler: {e}")
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=5)
+        self._snapshot()
+        log.debug(f"GATT scheduler stopped: {self.stats}")
+        log.debug(f"GATT profiles: {self.profiles.stats} (hit rate {self.profiles.hit_rate():.2f})")
+
+class GattResult:
+    # GATT tree of one device while it is read
+    def __init__(self):
+        self.services = []
+        self.characteristics = []
+        self.descriptors = []
+        self.emitted = set() # characteristics already handed to the callback
+        self.connected = False # connect() returned with a connection
+        self.verified = None # outcome of a profile verification, None: no verification connected
+        self.complete = False # every attribute was read
+        self.from_profile = False
+
+    def descriptors_of(self, char):
+        return [d for d in self.descriptors if d.characteristic_handle == char.handle]
+
+    def remaining(self):
+        return [c for c in self.characteristics if id(c) not in self.emitted]
 
 class GattService:
     def __init__(self, service):
@@ -150,7 +407,7 @@ class GattService:
         self.characteristics = []
 
         if isinstance(service, tuple):
-            (_, self.uuid, self.description, self.handle) = service
+            (_, self.uuid, self.description, self.handle) = service[:4]
         elif service:
             self.uuid = service.uuid
             self.description = service.description
@@ -173,7 +430,7 @@ class GattCharacteristic:
         self.descriptors = []
 
         if isinstance(char, tuple):
-            (_, self.uuid, self.value, self.description, self.handle, self.properties) = char
+            (_, self.uuid, self.value, self.description, self.handle, self.properties) = char[:6]
             self.properties = self.properties.split(", ")
         elif char:
             self.uuid = char.uuid
@@ -198,12 +455,12 @@ class GattDescriptor:
         self.value = None
 
         if isinstance(desc, tuple):
-            (_, self.uuid, self.value, self.description, self.handle) = desc
+            (_, self.uuid, self.value, self.description, self.handle) = desc[:5]
         elif desc:
             self.description = desc.description
             self.handle = desc.handle
             self.uuid = desc.uuid
-            self.desc = desc.characteristic_handle
+            self.characteristic_handle = desc.characteristic_handle
 
     def __str__(self):
         return f"{self.uuid}: {self.description} ({self.handle}) = {self.value}"
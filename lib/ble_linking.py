@@ -0,0 +1,256 @@
+import re
+import zlib
+import numpy as np
+
+from lib.db import table_ble_cluster, table_ble_cluster_link, index_ble_cluster
+from lib.metrics import metrics
+from lib.text_similarity import trigrams
+from lib.log import log
+
+# Links BLE devices across address changes without comparing all pairs:
+# every device gets a MinHash signature of its UUIDs, service data keys,
+# manufacturer payload shingles and name trigrams, devices which share a
+# band of the signature land in the same LSH bucket and only those pairs are
+# scored with ble_features.pair_scores. Links above the threshold and
+# devices sharing an address are merged into clusters with union-find.
+
+PRIME = (1 << 31) - 1
+NO_TOKEN = np.uint32(0xFFFFFFFF)
+
+servicedata_key = re.compile(r"'([^']*)':")
+address_alias = re.compile(r"^([0-9A-Fa-f]{2}-){5}[0-9A-Fa-f]{2}$")
+
+def _shingles(payloads, size):
+    # byte shingles of every payload of a comma separated hex list
+    res = set()
+    for payload in str(payloads).split(","):
+        payload = payload.strip()
+        if len(payload) <= 2 * size:
+            res.add(payload)
+        else:
+            res.update(payload[i:i + 2 * size] for i in range(0, len(payload) - 2 * size + 1, 2))
+    return res
+
+class union_find:
+    def __init__(self, n):
+        self.parent = list(range(n))
+
+    def find(self, x):
+        parent = self.parent
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(self, a, b):
+        ra, rb = self.find(a), self.find(b)
+        if ra == rb:
+            return False
+        if ra < rb:
+            self.parent[rb] = ra
+        else:
+            self.parent[ra] = rb
+        return True
+
+    def roots(self):
+        return np.array([self.find(x) for x in range(len(self.parent))], dtype=np.int64)
+
+class ble_linker:
+    # max_df: tokens carried by more than this share of the devices (company
+    # headers, common names) are dropped, they would only fill the buckets.
+    # Tokens of at most min_df devices are always kept, small databases would
+    # lose every shared token otherwise. Buckets with more than max_bucket
+    # devices are skipped.
+    tokenizers = {
+        "uuids": lambda v, size: {"u:" + u for u in str(v).split(",") if u},
+        "servicedata": lambda v, size: {"s:" + k for k in servicedata_key.findall(str(v))},
+        "manufacturer_binary": lambda v, size: {"m:" + s for s in _shingles(v, size)},
+        "name": lambda v, size: {"n:" + t for t in trigrams(str(v))},
+        "name2": lambda v, size: {"n:" + t for t in trigrams(str(v))},
+        "alias": lambda v, size: set() if address_alias.match(str(v)) else {"n:" + t for t in trigrams(str(v))},
+    }
+
+    def __init__(self, features, num_perm=32, bands=8, max_bucket=50, max_df=0.01, min_df=50, shingle=3,
+                 chunk_size=100000, seed=1):
+        if num_perm % bands:
+            raise ValueError("num_perm has to be a multiple of bands")
+        self.features = features
+        self.num_perm = num_perm
+        self.bands = bands
+        self.max_bucket = max_bucket
+        self.max_df = max_df
+        self.min_df = min_df
+        self.shingle = shingle
+        self.chunk_size = chunk_size
+
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, PRIME, num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, PRIME, num_perm, dtype=np.uint64)
+        self.band_mult = rng.integers(1, 1 << 63, num_perm // bands, dtype=np.uint64) | np.uint64(1)
+
+        self.stats = metrics()
+        self.labels = None
+        self.links = None
+
+    def _vocab_tokens(self):
+        # per column: token ids of every vocabulary value
+        token_ids = {}
+        columns = []
+        for column in self.features.columns:
+            tokenize = self.tokenizers.get(column.name)
+            if tokenize is None:
+                continue
+            owners = []
+            tokens = []
+            for i, v in enumerate(column.vocab):
+                if column.empty[i]:
+                    continue
+                for t in tokenize(v, self.shingle):
+                    owners.append(i)
+                    tokens.append(token_ids.setdefault(t, len(token_ids)))
+            columns.append((column, np.array(owners, dtype=np.int64), np.array(tokens, dtype=np.int64)))
+        return token_ids, columns
+
+    def signatures(self):
+        # -> (N x num_perm MinHash signatures, mask of the devices with tokens)
+        n = len(self.features)
+        token_ids, columns = self._vocab_tokens()
+
+        # document frequency over devices, a device counts once per column
+        df = np.zeros(len(token_ids))
+        for column, owners, tokens in columns:
+            rows_per_value = np.bincount(column.codes, minlength=column.none + 1)
+            df += np.bincount(tokens, weights=rows_per_value[owners], minlength=len(token_ids))
+        stop = df > max(self.max_df * n, self.min_df)
+        self.stats.incr("tokens", len(token_ids))
+        self.stats.incr("stop_tokens", int(stop.sum()))
+
+        base = np.zeros(len(token_ids), dtype=np.uint64)
+        for t, i in token_ids.items():
+            base[i] = zlib.crc32(t.encode())
+
+        signature = np.full((n, self.num_perm), NO_TOKEN, dtype=np.uint32)
+        for column, owners, tokens in columns:
+            keep = ~stop[tokens]
+            owners, tokens = owners[keep], tokens[keep]
+            if not len(owners):
+                continue
+            # MinHash of every vocabulary value, owners are sorted
+            starts = np.flatnonzero(np.r_[True, owners[1:] != owners[:-1]])
+            vocab_sig = np.full((column.none + 1, self.num_perm), NO_TOKEN, dtype=np.uint32)
+            x = base[tokens]
+            for p in range(self.num_perm):
+                h = (self.a[p] * x + self.b[p]) % PRIME
+                vocab_sig[owners[starts], p] = np.minimum.reduceat(h, starts)
+            for start in range(0, n, self.chunk_size):
+                part = signature[start:start + self.chunk_size]
+                np.minimum(part, vocab_sig[column.codes[start:start + self.chunk_size]], out=part)
+
+        valid = (signature != NO_TOKEN).any(axis=1)
+        return signature, valid
+
+    def candidates(self, signature, valid):
+        # -> unique row pairs (I < J) sharing at least one band
+        rows = np.flatnonzero(valid)
+        r = self.num_perm // self.bands
+        pairs = []
+        for band in range(self.bands):
+            keys = (signature[rows, band * r:(band + 1) * r].astype(np.uint64) * self.band_mult).sum(axis=1)
+            order = np.argsort(keys, kind="stable")
+            keys = keys[order]
+            members = rows[order]
+
+            # bucket sizes, every pair of a bucket is at most max_bucket - 1 apart
+            starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+            sizes = np.diff(np.r_[starts, len(keys)])
+            size = np.repeat(sizes, sizes)
+            small = size <= self.max_bucket
+            self.stats.incr("buckets", int((sizes > 1).sum()))
+            self.stats.incr("oversized_buckets", int((sizes > self.max_bucket).sum()))
+
+            for d in range(1, min(self.max_bucket, len(keys))):
+                same = (keys[:-d] == keys[d:]) & small[:-d]
+                if not same.any():
+                    break
+                pairs.append(np.stack((members[:-d][same], members[d:][same]), axis=1))
+
+        if not pairs:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        pairs = np.concatenate(pairs)
+        pairs.sort(axis=1)
+        pairs = np.unique(pairs[:, 0] * len(self.features) + pairs[:, 1])
+        return pairs // len(self.features), pairs % len(self.features)
+
+    def link(self, threshold=0.8, skip=("address", "address2"), get_services=None):
+        # -> cluster label (smallest device id) of every row
+        n = len(self.features)
+        with self.stats.timer("signatures"):
+            signature, valid = self.signatures()
+        with self.stats.timer("candidates"):
+            I, J = self.candidates(signature, valid)
+        del signature
+        self.stats.incr("candidates", len(I))
+
+        with self.stats.timer("scoring"):
+            scores = np.zeros(0)
+            parts = []
+            for start in range(0, len(I), self.chunk_size):
+                parts.append(self.features.pair_scores(I[start:start + self.chunk_size], J[start:start + self.chunk_size], skip, get_services))
+            if parts:
+                scores = np.concatenate(parts)
+        keep = scores >= threshold
+        self.links = (I[keep], J[keep], scores[keep])
+        self.stats.incr("links", int(keep.sum()))
+
+        with self.stats.timer("clustering"):
+            uf = union_find(n)
+            for i, j in zip(self.links[0].tolist(), self.links[1].tolist()):
+                uf.union(i, j)
+            # the same address is the same device
+            if "address" in self.features.by_name:
+                codes = self.features.by_name["address"].codes
+                none = self.features.by_name["address"].none
+                order = np.argsort(codes, kind="stable")
+                same = (codes[order][1:] == codes[order][:-1]) & (codes[order][1:] != none)
+                for i, j in zip(order[:-1][same].tolist(), order[1:][same].tolist()):
+                    uf.union(i, j)
+            roots = uf.roots()
+            # rows are sorted by id, the root is the smallest row of the cluster
+            self.labels = self.features.ids[roots]
+        clusters = len(np.unique(roots))
+        self.stats.incr("clusters", clusters)
+        log.debug(f"Linked {n} devices into {clusters} clusters: {self.stats}")
+        return self.labels
+
+    def clusters(self, min_size=2):
+        # -> {cluster id: [device ids]}
+        ids = self.features.ids
+        order = np.argsort(self.labels, kind="stable")
+        labels = self.labels[order]
+        starts = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]])
+        res = {}
+        for start, end in zip(starts.tolist(), np.r_[starts[1:], len(labels)].tolist()):
+            if end - start >= min_size:
+                res[int(labels[start])] = ids[order[start:end]].tolist()
+        return res
+
+    def save(self, db, chunk_size=10000):
+        # replaces the stored clusters, single devices are not stored
+        clusters = self.clusters()
+        members = [{"device_id": d, "cluster_id": c} for c, devices in clusters.items() for d in devices]
+        ids = self.features.ids
+        I, J, scores = self.links
+        links = [{"device_id1": int(ids[i]), "device_id2": int(ids[j]), "similarity": float(s)}
+                 for i, j, s in zip(I.tolist(), J.tolist(), scores.tolist())]
+        for table in (table_ble_cluster, table_ble_cluster_link, index_ble_cluster):
+            db.execute_silent(table)
+        with db.transaction():
+            db.execute_silent("DELETE FROM ble_cluster")
+            db.execute_silent("DELETE FROM ble_cluster_link")
+            for start in range(0, len(members), chunk_size):
+                db.execute_silent("INSERT INTO ble_cluster (device_id, cluster_id) VALUES (:device_id, :cluster_id)",
+                                  members[start:start + chunk_size])
+            for start in range(0, len(links), chunk_size):
+                db.execute_silent("INSERT INTO ble_cluster_link (device_id1, device_id2, similarity) VALUES (:device_id1, :device_id2, :similarity)",
+                                  links[start:start + chunk_size])
+        log.debug(f"Saved {len(members)} devices in {len(clusters)} clusters and {len(links)} links")
@@ -0,0 +1,281 @@
+import asyncio
+import json
+import os
+import random
+import struct
+import threading
+import time
+import zlib
+
+from bleak.backends.device import BLEDevice
+from bleak.backends.scanner import AdvertisementData
+
+from lib.log import log
+
+# Recorded advert streams and fake scanner backends, ble_scanner can use
+# them instead of BleakScanner to run everything without a radio.
+#
+# File layout: header line b"BLEREC<version>\n", then one record per advert:
+#   length(u32) json([time, address, name, details, advertisement fields])
+# JSON has no bytes and only string keys, both are written as tagged
+# objects: {"b": hex} for bytes, {"d": [[key, value], ...]} for dicts.
+
+MAGIC = b"BLEREC"
+VERSION = 2 # 1: marshal records, depend on the Python version
+_length = struct.Struct("<I")
+
+adv_fields = ("local_name", "manufacturer_data", "service_data", "service_uuids", "tx_power", "rssi")
+
+def _plain(value):
+    # dbus / bleak types are converted to JSON types
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, (bytes, bytearray)):
+        return {"b": value.hex()}
+    if isinstance(value, dict):
+        return {"d": [[_plain(k), _plain(v)] for k, v in value.items()]}
+    if isinstance(value, (list, tuple, set)):
+        return [_plain(v) for v in value]
+    return str(value)
+
+def _restore(value):
+    if isinstance(value, list):
+        return [_restore(v) for v in value]
+    if isinstance(value, dict):
+        if "b" in value:
+            return bytes.fromhex(value["b"])
+        return {_restore(k): _restore(v) for k, v in value["d"]}
+    return value
+
+def header_line():
+    return MAGIC + str(VERSION).encode() + b"\n"
+
+def read_header(f, path):
+    line = f.readline(len(MAGIC) + 8)
+    if not line.startswith(MAGIC) or not line.endswith(b"\n"):
+        raise ValueError(f"{path} is not an advert recording")
+    version = line[len(MAGIC):-1]
+    if version != str(VERSION).encode():
+        raise ValueError(f"{path} is an advert recording of version {version.decode(errors='replace')}, only version {VERSION} can be read, record it again")
+    return VERSION
+
+def to_record(device, advertisement, now=None):
+    adv = None
+    if advertisement is not None:
+        adv = tuple(_plain(getattr(advertisement, f)) for f in adv_fields)
+    return (time.time() if now is None else now, device.address, device.name, _plain(device.details), adv)
+
+def from_record(record):
+    # -> (time, BLEDevice, AdvertisementData)
+    t, address, name, details, adv = _restore(record)
+    advertisement = None
+    if adv is not None:
+        fields = dict(zip(adv_fields, adv))
+        advertisement = AdvertisementData(platform_data=(), **fields)
+    return t, BLEDevice(address, name, details), advertisement
+
+class advert_recorder:
+    # append only recorder, can be used as ble_scanner callback (and passes the adverts on)
+    def __init__(self, path, callback=None, flush_every=100):
+        self.path = path
+        self.callback = callback
+        self.flush_every = flush_every
+        self.count = 0
+        self._lock = threading.Lock()
+
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        if not new:
+            # only appended to recordings of the same version
+            with open(path, "rb") as f:
+                read_header(f, path)
+        self.file = open(path, "ab")
+        if new:
+            self.file.write(header_line())
+
+    def __call__(self, device, advertisement=None, adapter=None):
+        self.record(device, advertisement)
+        if self.callback:
+            if adapter is None:
+                self.callback(device, advertisement)
+            else:
+                self.callback(device, advertisement, adapter)
+
+    def record(self, device, advertisement=None):
+        data = json.dumps(to_record(device, advertisement), separators=(",", ":")).encode()
+        with self._lock:
+            self.file.write(_length.pack(len(data)))
+            self.file.write(data)
+            self.count += 1
+            if self.count % self.flush_every == 0:
+                self.file.flush()
+
+    def close(self):
+        with self._lock:
+            self.file.close()
+        log.debug(f"Recorded {self.count} adverts to {self.path}")
+
+def read_records(path):
+    with open(path, "rb") as f:
+        read_header(f, path)
+        while True:
+            header = f.read(_length.size)
+            if len(header) < _length.size:
+                return
+            length, = _length.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return # cut off while recording
+            yield json.loads(data)
+
+class fake_scanner:
+    # same interface as BleakScanner for ble_scanner: feeds adverts from a generator
+    def __init__(self, backend, detection_callback, bluez=None, **kwargs):
+        self.backend = backend
+        self.callback = detection_callback
+        self.adapter = (bluez or {}).get("adapter")
+        self.task = None
+
+    async def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.backend.run(self.callback, self.adapter))
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+class replay_backend:
+    # replays a recording with the recorded timing divided by speed (speed=None: as fast as possible)
+    def __init__(self, path, speed=1.0, loop=False):
+        self.path = path
+        self.speed = speed
+        self.loop = loop
+        self.records = None
+        self.done = False
+        self.sent = 0
+
+    def __call__(self, detection_callback, **kwargs):
+        return fake_scanner(self, detection_callback, **kwargs)
+
+    async def run(self, callback, adapter=None):
+        # recorded adverts keep the adapter they were recorded on
+        if self.records is None:
+            # resumes where it stopped, ble_scanner restarts the scanner
+            self.records = read_records(self.path)
+        start = None
+        first = None
+        while True:
+            for record in self.records:
+                t, device, advertisement = from_record(record)
+                if self.speed:
+                    if first is None:
+                        start, first = time.monotonic(), t
+                    delay = (t - first) / self.speed - (time.monotonic() - start)
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                elif self.sent % 1000 == 0:
+                    await asyncio.sleep(0)
+                self.sent += 1
+                callback(device, advertisement)
+            if not self.loop:
+                break
+            self.records = read_records(self.path)
+            start = first = None
+        self.done = True
+
+class synthetic_backend:
+    # emulates devices adverts: random addresses rotate every rotation seconds.
+    # Every scanner created from it is a simulated adapter which hears the same
+    # devices, with its own signal offset and loss rate.
+    def __init__(self, devices=100, rate=10.0, rotation=900, random_share=0.8, seed=None, limit=None, loss=0.0):
+        self.devices = devices
+        self.rate = rate # adverts per second and device
+        self.rotation = rotation
+        self.random_share = random_share
+        self.limit = limit
+        self.loss = loss
+        self.random = random.Random(seed)
+        self.sent = 0
+        self.done = False
+        self.models = [self.__model(i) for i in range(devices)]
+
+    def __call__(self, detection_callback, **kwargs):
+        return fake_scanner(self, detection_callback, **kwargs)
+
+    def __model(self, i):
+        r = self.random
+        rotating = r.random() < self.random_share
+        return {
+            "index": i,
+            "rotating": rotating,
+            "address": self.__address(rotating),
+            "rotated": time.monotonic() - r.random() * self.rotation,
+            "name": None if rotating and r.random() < 0.7 else f"Device {i % 50}",
+            "company": r.choice([76, 6, 117, 224, 301]),
+            "payload": bytes(r.randrange(256) for _ in range(r.choice([4, 8, 16]))),
+            "uuids": r.choice([[], ["0000fe9f-0000-1000-8000-00805f9b34fb"], ["0000180f-0000-1000-8000-00805f9b34fb"]]),
+            "rssi": r.randrange(-95, -40),
+        }
+
+    def __address(self, rotating):
+        b = [self.random.randrange(256) for _ in range(6)]
+        if rotating:
+            b[0] = (b[0] & 0x3F) | 0x40 # resolvable private address
+        return ":".join(f"{x:02X}" for x in b)
+
+    def advert(self, model, adapter=None):
+        adapter = adapter or "hci0"
+        now = time.monotonic()
+        if model["rotating"] and now - model["rotated"] >= self.rotation:
+            model["address"] = self.__address(True)
+            model["rotated"] = now
+        model["rssi"] = max(-100, min(-30, model["rssi"] + self.random.randint(-3, 3)))
+        # adapters are placed differently, some hear a device better than others
+        offset = zlib.crc32(f"{adapter}:{model['index']}".encode()) % 21 - 10 if adapter != "hci0" else 0
+        rssi = max(-100, min(-30, model["rssi"] + offset))
+
+        manufacturer_data = {model["company"]: model["payload"]}
+        props = {
+            "Address": model["address"],
+            "AddressType": "random" if model["rotating"] else "public",
+            "Alias": model["name"] or model["address"].replace(":", "-"),
+            "Paired": False,
+            "Bonded": False,
+            "Trusted": False,
+            "Blocked": False,
+            "LegacyPairing": False,
+            "RSSI": rssi,
+            "Connected": False,
+            "UUIDs": model["uuids"],
+            "ManufacturerData": manufacturer_data,
+            "AdvertisingFlags": b"\x06",
+            "ServicesResolved": False,
+            "Adapter": f"/org/bluez/{adapter}",
+        }
+        if model["name"]:
+            props["Name"] = model["name"]
+        details = {"path": f"/org/bluez/{adapter}/dev_{model['address'].replace(':', '_')}", "props": props}
+
+        device = BLEDevice(model["address"], model["name"], details)
+        advertisement = AdvertisementData(
+            local_name=model["name"], manufacturer_data=manufacturer_data, service_data={},
+            service_uuids=model["uuids"], tx_power=None, rssi=rssi, platform_data=(),
+        )
+        return device, advertisement
+
+    async def run(self, callback, adapter=None):
+        interval = 1 / (self.rate * self.devices)
+        start = time.monotonic()
+        sent = 0
+        while self.limit is None or self.sent < self.limit:
+            model = self.models[self.random.randrange(self.devices)]
+            if not self.loss or self.random.random() >= self.loss:
+                callback(*self.advert(model, adapter))
+                self.sent += 1
+            sent += 1
+            delay = start + sent * interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            elif sent % 1000 == 0:
+                await asyncio.sleep(0)
+        self.done = True
@@ -1,38 +1,171 @@
 from bleak import BleakScanner
+from bleak.args.bluez import AdvertisementDataType, BlueZScannerArgs, OrPattern
 import threading
 import time
 import asyncio
 
 from lib.ble_device import ble_device
+from lib.metrics import metrics
 from lib.log import log
 
+class adapter_scan:
+    # scanner state of one adapter (None: default adapter)
+    def __init__(self, adapter):
+        self.adapter = adapter
+        self.scanner = None
+        self.last_advert = None
+        self.stopped_at = None # when discovery was last stopped, for the dead time
+
 class ble_scanner:
+    # mode "continuous": discovery stays armed, it is only restarted after a failure
+    #                    (or when no advert arrived for stall_timeout seconds).
+    #                    With scan_window < scan_interval the scanner is paused for
+    #                    scan_interval - scan_window after every window (duty cycle).
+    # mode "cycle":      the old behaviour, start/stop every scan_window seconds.
+    #
+    # With adapters (e.g. ["hci0", "hci1"]) one scanner per adapter runs on the
+    # same loop and the callback gets the adapter as third argument.
     callback = None
     uuids = None
 
-    def __init__(self, callback):
+    # passive scanning on BlueZ needs advertisement monitor patterns,
+    # these match every advert which carries the common flag values
+    passive_flags = [b"\x02", b"\x04", b"\x05", b"\x06", b"\x1a", b"\x1e"]
+
+    def __init__(self, callback, mode="continuous", scanning_mode="active", scan_window=None,
+                 scan_interval=None, stall_timeout=None, report_interval=60, backend=None, adapters=None):
         self.callback = callback
+        # BleakScanner or a fake one from lib.ble_replay
+        self.backend = backend if backend is not None else BleakScanner
         self.loop = None
+        self.task = None
+        self.thread = None
 
-    async def _scan(self):
-        if self.uuids:
-            scanner = BleakScanner(self.callback, uuids=self.uuids)
+        self.mode = mode
+        self.scanning_mode = scanning_mode
+        self.scan_window = scan_window if scan_window is not None else 1.0
+        self.scan_interval = scan_interval if scan_interval is not None else self.scan_window
+        self.stall_timeout = stall_timeout
+        self.report_interval = report_interval
+
+        self.adapters = adapters
+        self.stats = metrics()
+        self._report_time = time.monotonic()
+        self._report_count = 0
+
+    def _detection_callback(self, scan, device, advertisement):
+        scan.last_advert = time.monotonic()
+        self.stats.incr("adverts")
+        if scan.adapter is None:
+            self.callback(device, advertisement)
         else:
-            scanner = BleakScanner(self.callback)
+            self.stats.incr(f"adverts_{scan.adapter}")
+            self.callback(device, advertisement, scan.adapter)
+
+    def _scanner(self, scan):
+        bluez = BlueZScannerArgs()
+        if scan.adapter is not None:
+            bluez["adapter"] = scan.adapter
+        if self.scanning_mode == "passive":
+            bluez["or_patterns"] = [OrPattern(0, AdvertisementDataType.FLAGS, f) for f in self.passive_flags]
+        kwargs = {"scanning_mode": self.scanning_mode, "bluez": bluez}
+        if self.uuids:
+            kwargs["service_uuids"] = self.uuids
+        return self.backend(lambda device, advertisement: self._detection_callback(scan, device, advertisement), **kwargs)
+
+    async def _start(self, scan):
+        await scan.scanner.start()
+        now = time.monotonic()
+        if scan.stopped_at is not None:
+            self.stats.observe("dead_time", now - scan.stopped_at)
+            scan.stopped_at = None
+        scan.last_advert = now
+
+    async def _stop(self, scan):
+        try:
+            await scan.scanner.stop()
+        finally:
+            scan.stopped_at = time.monotonic()
+
+    def _report(self):
+        now = time.monotonic()
+        elapsed = now - self._report_time
+        if elapsed < self.report_interval:
+            return
 
+        adverts = self.stats.get("adverts")
+        rate = (adverts - self._report_count) / elapsed
+        self.stats.gauge("adverts_per_second", rate)
+        self._report_time = now
+        self._report_count = adverts
+        log.debug(f"BLE scanner: {rate:.1f} adverts/s, {self.stats}")
+
+    def _stalled(self, scan):
+        return self.stall_timeout and time.monotonic() - scan.last_advert > self.stall_timeout
+
+    async def _scan_continuous(self, scan):
+        duty_cycled = self.scan_window < self.scan_interval
+        failures = 0
         while True:
             try:
-                await scanner.start()
-                await asyncio.sleep(1)
-                await scanner.stop()
+                await self._start(scan)
+                failures = 0
+                window_end = time.monotonic() + self.scan_window
+                while not duty_cycled or time.monotonic() < window_end:
+                    await asyncio.sleep(min(1, self.scan_window) if duty_cycled else 1)
+                    self._report()
+                    if self._stalled(scan):
+                        log.info(f"BLE Discovery on {scan.adapter or 'default adapter'} stalled, no adverts for {self.stall_timeout}s, restarting")
+                        self.stats.incr("stalls")
+                        break
+                await self._stop(scan)
+                if duty_cycled:
+                    await asyncio.sleep(self.scan_interval - self.scan_window)
+                else:
+                    self.stats.incr("restarts")
             except asyncio.CancelledError:
                 break
             except Exception as e:
+                failures += 1
+                self.stats.incr("failures")
+                log.info(f"BLE Discovery on {scan.adapter or 'default adapter'} failed: {e}")
+                try:
+                    await self._stop(scan)
+                except Exception:
+                    pass
+                await asyncio.sleep(min(2 ** failures, 30))
+
+    async def _scan_cycle(self, scan):
+        while True:
+            try:
+                await self._start(scan)
+                await asyncio.sleep(self.scan_window)
+                await self._stop(scan)
+                self._report()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                self.stats.incr("failures")
                 log.info(f"BLE Discovery failed: {e}")
                 await asyncio.sleep(1)
                 continue
 
-        await scanner.stop()
+    async def _scan_adapter(self, scan):
+        scan.scanner = self._scanner(scan)
+        try:
+            if self.mode == "cycle":
+                await self._scan_cycle(scan)
+            else:
+                await self._scan_continuous(scan)
+        finally:
+            try:
+                await scan.scanner.stop()
+            except Exception:
+                pass
+
+    async def _scan(self):
+        scans = [adapter_scan(a) for a in (self.adapters or [None])]
+        await asyncio.gather(*[self._scan_adapter(scan) for scan in scans])
 
     def scan(self):
         def run_loop():
@@ -40,7 +173,8 @@ class ble_scanner:
             asyncio.set_event_loop(self.loop)
 
             try:
-                self.loop.run_until_complete(self._scan())
+                self.task = self.loop.create_task(self._scan())
+                self.loop.run_until_complete(self.task)
             except asyncio.CancelledError:
                 pass
             except Exception as e:
@@ -48,17 +182,18 @@ class ble_scanner:
             finally:
                 self.loop.close()
 
-        t = threading.Thread(target=run_loop, daemon=True)
-        t.start()
+        self.thread = threading.Thread(target=run_loop, daemon=True)
+        self.thread.start()
 
-    def stop(self):
-        if self.loop:
-            asyncio.run_coroutine_threadsafe(self._shutdown_loop(self.loop), self.loop)
+    def is_alive(self):
+        return self.thread is not None and self.thread.is_alive()
 
-    async def _shutdown_loop(self, loop):
-        for task in asyncio.all_tasks(loop):
-            if not task.done():
-                task.cancel()
-        await asyncio.gather(*tasks, return_exceptions=True)
-
-        loop.stop()
+    def stop(self):
+        if self.loop and self.task and not self.loop.is_closed():
+            try:
+                self.loop.call_soon_threadsafe(self.task.cancel)
+            except RuntimeError:
+                pass # loop already closed
+        if self.thread:
+            self.thread.join(timeout=5)
+        log.debug(f"BLE scanner stopped: {self.stats}")
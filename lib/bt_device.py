@@ -1,21 +1,26 @@
 import datetime
+import operator
 from lib.ieee import IEEE
 
 class bt_device:
     ieee = IEEE()
+
+    # column order of the bluetooth_device table
+    db_fields = ("id", "address", "name", "device_class", "manufacturer", "version", "hci_version",
+                 "lmp_version", "device_type", "device_id", "extra_hci_info")
+    attributes = db_fields[1:]
+    __slots__ = db_fields + ("rssi", "adapter", "timestamp", "geolocation", "timings", "services")
+
+    _get_attributes = operator.attrgetter(*attributes)
+
     def __init__(self, device):
         # input from database
-        self.id = device[0]
-        self.address = device[1]
-        self.name = device[2]
-        self.device_class = device[3]
-        self.manufacturer = device[4]
-        self.version = device[5]
-        self.hci_version = device[6]
-        self.lmp_version = device[7]
-        self.device_type = device[8]
-        self.device_id = device[9]
-        self.extra_hci_info = device[10]
+        (
+            self.id, self.address, self.name, self.device_class, self.manufacturer, self.version,
+            self.hci_version, self.lmp_version, self.device_type, self.device_id, self.extra_hci_info
+        ) = device[:11]
+        self.rssi = None
+        self.adapter = None
         self.timestamp = str(datetime.datetime.now().replace(microsecond=0)) # timestamp in seconds
         self.geolocation = None
 
@@ -31,17 +36,31 @@ class bt_device:
     def parse_manufacturer(self):
         return self.ieee.search_address(self.address)
 
+    @classmethod
+    def update_manufacturers(cls, devices):
+        # batch version of update_manufacturer
+        missing = [d for d in devices if not d.manufacturer]
+        for dev, res in zip(missing, cls.ieee.search_addresses([d.address for d in missing])):
+            if res:
+                dev.manufacturer = res
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(row)
+
     def __getitem__(self, item):
-        # not nice but makes things so much easier
-        return eval(f"self.{item}")
+        return getattr(self, item)
 
     def get_attributes(self):
-        return ["address", "name", "device_class", "manufacturer", "version", "hci_version", "lmp_version", "device_type", "device_id", "extra_hci_info"]
+        return list(self.attributes)
 
     def __parse_timings(self, timings):
         ret = []
         for t in timings:
-            time = datetime.datetime.strptime(t[0], "%Y-%m-%d %H:%M:%S")
+            if isinstance(t[0], int): # epoch seconds from the sighting tables
+                time = datetime.datetime.fromtimestamp(t[0])
+            else:
+                time = datetime.datetime.strptime(t[0], "%Y-%m-%d %H:%M:%S")
             geo = t[1]
             ret.append((time, geo))
 
@@ -81,35 +100,31 @@ class bt_device:
         return ret_str
 
     def to_dict(self):
-        res = {}
-        for a in self.get_attributes():
-            res[a] = self[a]
-        return res
+        return dict(zip(self.attributes, self._get_attributes(self)))
 
 class BT_service:
+    # column order of the bluetooth_service table
+    db_fields = ("id", "host", "name", "service_classes", "profiles", "description", "provider",
+                 "service_id", "protocol", "port")
+    attributes = db_fields[1:]
+    __slots__ = db_fields + ("timings",)
+
     def __init__(self, service):
-        self.id = service[0]
-        self.host = service[1]
-        self.name = service[2]
-        self.service_classes = service[3]
-        self.profiles = service[4]
-        self.description = service[5]
-        self.provider = service[6]
-        self.service_id = service[7]
-        self.protocol = service[8]
-        self.port = service[9]
+        (
+            self.id, self.host, self.name, self.service_classes, self.profiles, self.description,
+            self.provider, self.service_id, self.protocol, self.port
+        ) = service[:10]
 
         self.timings = []
 
     def __getitem__(self, item):
-        # not nice but makes things so much easier
-        return eval(f"self.{item}")
+        return getattr(self, item)
 
     def __eq__(self, other):
         return self.id == other.id
 
     def get_attributes(self):
-        return ["host", "name", "service_classes", "profiles", "description", "provider", "service_id", "protocol", "port"]
+        return list(self.attributes)
 
     def __str__(self):
         ret_str = ""
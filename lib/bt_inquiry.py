@@ -0,0 +1,220 @@
+import struct
+
+# Classic Bluetooth inquiry without paging: results with RSSI and extended
+# inquiry response (EIR) data straight from the HCI events. The parsers only
+# work on bytes / text, so captured output can be fed to them offline.
+
+EVT_INQUIRY_COMPLETE = 0x01
+EVT_INQUIRY_RESULT = 0x02
+EVT_INQUIRY_RESULT_WITH_RSSI = 0x22
+EVT_EXTENDED_INQUIRY_RESULT = 0x2F
+EVT_CMD_COMPLETE = 0x0E
+EVT_CMD_STATUS = 0x0F
+
+HCI_EVENT_PKT = 0x04
+
+# inquiry modes of Write Inquiry Mode
+INQUIRY_MODE_STANDARD = 0
+INQUIRY_MODE_RSSI = 1
+INQUIRY_MODE_EXTENDED = 2
+
+# hcitool info lines -> bt_device fields, the first key contained in a line
+# wins. "Version" also matches the "HCI Version" and "LMP Version" lines, so
+# these end up in version and hci_version / lmp_version stay empty, like in
+# the stored rows (the fields are part of the bluetooth_device content hash).
+hcitool_fields = [
+    ("Class", "device_class"),
+    ("Manufacturer", "manufacturer"),
+    ("Version", "version"),
+    ("Device Type", "device_type"),
+    ("Device ID", "device_id"),
+]
+
+def format_address(data):
+    # little endian bdaddr -> "AA:BB:CC:DD:EE:FF"
+    return ":".join(f"{b:02X}" for b in reversed(data[:6]))
+
+def format_class(data):
+    return "0x" + bytes(reversed(data[:3])).hex()
+
+def format_uuid(data):
+    if len(data) == 16:
+        h = bytes(reversed(data)).hex()
+        return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
+    return f"{int.from_bytes(data, 'little'):08x}-0000-1000-8000-00805f9b34fb"
+
+def parse_eir(data):
+    # AD structures: length(1) type(1) payload(length - 1), a length of 0 ends the data
+    res = {}
+    pos = 0
+    while pos < len(data):
+        length = data[pos]
+        if length == 0 or pos + 1 + length > len(data):
+            break
+        ad_type = data[pos + 1]
+        payload = bytes(data[pos + 2:pos + 1 + length])
+        pos += 1 + length
+
+        if ad_type in (0x08, 0x09): # shortened / complete local name
+            if ad_type == 0x09 or "name" not in res:
+                res["name"] = payload.decode("utf-8", errors="replace").rstrip("\0")
+        elif ad_type in (0x02, 0x03, 0x04, 0x05, 0x06, 0x07): # 16 / 32 / 128 bit service uuids
+            size = {0x02: 2, 0x03: 2, 0x04: 4, 0x05: 4, 0x06: 16, 0x07: 16}[ad_type]
+            uuids = res.setdefault("uuids", [])
+            for i in range(0, len(payload) - size + 1, size):
+                uuids.append(format_uuid(payload[i:i + size]))
+        elif ad_type == 0x0A and payload: # tx power level
+            res["tx_power"] = struct.unpack("b", payload[:1])[0]
+        elif ad_type == 0x10 and len(payload) >= 8: # device id
+            source, vendor, product, version = struct.unpack("<HHHH", payload[:8])
+            res["device_id"] = f"{source:04x}:{vendor:04x}:{product:04x}:{version:04x}"
+        elif ad_type == 0xFF and len(payload) >= 2: # manufacturer specific data
+            company = struct.unpack("<H", payload[:2])[0]
+            res.setdefault("manufacturer_data", {})[company] = payload[2:]
+        elif ad_type == 0x01 and payload:
+            res["flags"] = payload[0]
+    return res
+
+def parse_event(packet):
+    # HCI event packet (with packet type byte) -> list of inquiry results,
+    # None for the end of the inquiry, [] for unrelated events
+    if len(packet) < 3 or packet[0] != HCI_EVENT_PKT:
+        return []
+    event, plen = packet[1], packet[2]
+    body = packet[3:3 + plen]
+
+    if event == EVT_INQUIRY_COMPLETE:
+        return None
+
+    results = []
+    if event in (EVT_INQUIRY_RESULT, EVT_INQUIRY_RESULT_WITH_RSSI, EVT_EXTENDED_INQUIRY_RESULT) and body:
+        count = body[0]
+        # responses are packed one after another like the bluez inquiry_info structs
+        size = {EVT_INQUIRY_RESULT: 14, EVT_INQUIRY_RESULT_WITH_RSSI: 14, EVT_EXTENDED_INQUIRY_RESULT: 254}[event]
+        for i in range(count):
+            r = body[1 + i * size:1 + (i + 1) * size]
+            if len(r) < 14:
+                break
+            result = {
+                "address": format_address(r[0:6]),
+                "class_of_device": format_class(r[8:11]) if event != EVT_INQUIRY_RESULT else format_class(r[9:12]),
+                "rssi": None,
+                "eir": None,
+            }
+            if event != EVT_INQUIRY_RESULT:
+                result["rssi"] = struct.unpack("b", r[13:14])[0]
+            if event == EVT_EXTENDED_INQUIRY_RESULT:
+                result["eir"] = parse_eir(r[14:])
+            results.append(result)
+    return results
+
+def parse_hcidump(output):
+    # `hcidump -R` capture -> [(direction, packet)], "<" sent to and ">" received
+    # from the controller. Packets continue on indented lines.
+    res = []
+    for line in output.splitlines():
+        if line[:2] in ("< ", "> "):
+            res.append((line[0], bytearray.fromhex(line[2:])))
+        elif line.startswith(" ") and res:
+            res[-1][1].extend(bytes.fromhex(line))
+    return [(direction, bytes(packet)) for direction, packet in res]
+
+def parse_hcitool_info(output):
+    # `hcitool info <address>` -> dict of bt_device fields, unknown lines go to extra_hci_info
+    res = {"device_class": None, "manufacturer": None, "version": None, "hci_version": None,
+           "lmp_version": None, "device_type": None, "device_id": None}
+    extra = ""
+    for line in output.splitlines():
+        for key, field in hcitool_fields:
+            if key in line:
+                res[field] = line.split(f"{key}: ")[-1].strip()
+                break
+        else:
+            extra = f"{extra}\n{line}"
+    res["extra_hci_info"] = extra
+    return res
+
+def parse_hcitool_inq(output):
+    # `hcitool inq`: address, clock offset and class per line
+    res = []
+    for line in output.splitlines():
+        parts = [p.strip() for p in line.strip().split("\t") if p.strip()]
+        if not parts or parts[0].count(":") != 5:
+            continue
+        result = {"address": parts[0].upper(), "class_of_device": None, "clock_offset": None}
+        for p in parts[1:]:
+            key, _, value = p.partition(": ")
+            if key == "class":
+                result["class_of_device"] = value
+            elif key == "clock offset":
+                result["clock_offset"] = value
+        res.append(result)
+    return res
+
+def parse_hcitool_scan(output):
+    # `hcitool scan`: address and name per line
+    res = []
+    for line in output.splitlines():
+        address, _, name = line.strip().partition("\t")
+        if address.count(":") == 5:
+            res.append((address.upper(), name.strip() or None))
+    return res
+
+def eir_info(result, manufacturers=None):
+    # inquiry result -> bt_device fields known without paging
+    eir = result.get("eir") or {}
+    info = {
+        "name": eir.get("name"),
+        "device_class": result.get("class_of_device"),
+        "rssi": result.get("rssi"),
+        "device_id": eir.get("device_id"),
+        "uuids": eir.get("uuids"),
+        "manufacturer": None,
+    }
+    company_ids = list(eir.get("manufacturer_data", {}))
+    if company_ids:
+        names = []
+        for company in company_ids:
+            name = manufacturers.find_by_value(company) if manufacturers else None
+            names.append(f"{name} ({company})" if name else str(company))
+        info["manufacturer"] = ", ".join(names)
+    return info
+
+def _rank(result):
+    return (bool(result["eir"]), result["rssi"] if result["rssi"] is not None else -127)
+
+def inquiry(dev_id=0, duration=8, max_responses=255, timeout=None):
+    # runs one inquiry in extended mode on the raw hci socket (needs CAP_NET_RAW)
+    import bluetooth._bluetooth as bluez
+
+    sock = bluez.hci_open_dev(dev_id)
+    old_filter = sock.getsockopt(bluez.SOL_HCI, bluez.HCI_FILTER, 14)
+    try:
+        flt = bluez.hci_filter_new()
+        bluez.hci_filter_all_events(flt)
+        bluez.hci_filter_set_ptype(flt, bluez.HCI_EVENT_PKT)
+        sock.setsockopt(bluez.SOL_HCI, bluez.HCI_FILTER, flt)
+
+        bluez.hci_send_cmd(sock, bluez.OGF_HOST_CTL, bluez.OCF_WRITE_INQUIRY_MODE,
+                           struct.pack("B", INQUIRY_MODE_EXTENDED))
+
+        # general inquiry access code 0x9e8b33, duration in units of 1.28s
+        cmd = struct.pack("BBBBB", 0x33, 0x8b, 0x9e, max(1, min(int(duration / 1.28), 0x30)), max_responses)
+        bluez.hci_send_cmd(sock, bluez.OGF_LINK_CTL, bluez.OCF_INQUIRY, cmd)
+
+        sock.settimeout(timeout if timeout is not None else duration + 5)
+        results = {}
+        while True:
+            packet = sock.recv(300)
+            parsed = parse_event(packet)
+            if parsed is None:
+                break
+            for result in parsed:
+                # keep the result with EIR data and the strongest signal
+                old = results.get(result["address"])
+                if old is None or _rank(result) > _rank(old):
+                    results[result["address"]] = result
+        return list(results.values())
+    finally:
+        sock.setsockopt(bluez.SOL_HCI, bluez.HCI_FILTER, old_filter)
+        sock.close()
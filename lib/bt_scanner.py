@@ -6,15 +6,154 @@ from concurrent.futures import ThreadPoolExecutor
 
 from lib.log import log
 from lib.bt_device import bt_device
+from lib.bt_inquiry import inquiry, eir_info, parse_hcitool_info
+from lib.manufacturers import Manufacturer
+from lib.bounded_cache import bounded_cache
+from lib.metrics import metrics
 from lib.db import BluetoothDatabase
 
 class bt_scanner:
-    def __init__(self, db: BluetoothDatabase):
+    # Discovered devices go through the stages name -> sdp -> hci. Every stage
+    # has its own workers and caches its result per address for cache_ttl
+    # seconds, a stage with a cached result is skipped. An address is only
+    # once in the pipeline and at most max_pending addresses are in it.
+    #
+    # mode "page": discovery with name lookups, every stage pages the device.
+    # mode "eir":  inquiry with RSSI and extended inquiry response, a stage
+    #              only runs when the inquiry did not already deliver its fields.
+    stages = ("name", "sdp", "hci")
+
+    def __init__(self, db: BluetoothDatabase, max_pending=256, cache_ttl=3600, cache_size=4096,
+                 name_workers=2, sdp_workers=2, hci_workers=1, mode="page", dev_id=0,
+                 required_fields=("device_class", "manufacturer"), pause=3):
         self.db = db
         self.scanning = True
-        self.executor = ThreadPoolExecutor(max_workers=10)
+        self.max_pending = max_pending
+        self.mode = mode
+        self.dev_id = dev_id
+        self.required_fields = required_fields
+        self.pause = pause # seconds between two discovery rounds, the pipeline pages in between
+        self.manu = Manufacturer()
+
+        self.workers = {"name": name_workers, "sdp": sdp_workers, "hci": hci_workers}
+        self.executors = {}
+        self.caches = {s: bounded_cache(cache_size, cache_ttl) for s in self.stages}
+        self.in_flight = set()
+        self.thread = None
+        self._lock = threading.Lock()
+        self.stats = metrics()
+
+    def enqueue(self, address, name=None, info=None):
+        self.stats.incr("discovered")
+        with self._lock:
+            if address in self.in_flight:
+                self.stats.incr("skipped")
+                return False
+            if len(self.in_flight) >= self.max_pending:
+                self.stats.incr("dropped")
+                return False
+            self.in_flight.add(address)
+            self.stats.gauge("pending", len(self.in_flight))
+
+        if name:
+            # discovery already resolved it
+            self.caches["name"].put(address, name)
+        job = {"address": address, "name": name, "info": info or {}}
+        self._next(job, 0)
+        return True
+
+    def _next(self, job, i):
+        # hand the job to the first stage without cached result
+        try:
+            while i < len(self.stages):
+                stage = self.stages[i]
+                if self._satisfied(stage, job):
+                    self.stats.incr(f"{stage}_skipped")
+                    i += 1
+                    continue
+                cached = self.caches[stage].get(job["address"])
+                if cached is None:
+                    self.executors[stage].submit(self._run_stage, job, i)
+                    return
+                job[stage] = cached
+                i += 1
+            self._finish(job)
+        except Exception as e:
+            # e.g. stopped, the executors are shut down or gone
+            log.debug(f"Bluetooth enrichment of {job['address']} aborted: {e}")
+            self._done(job)
+
+    def _satisfied(self, stage, job):
+        # fields which came with the inquiry don't need a paging connection
+        info = job["info"]
+        if stage == "name":
+            return bool(job.get("name"))
+        if stage == "sdp":
+            return bool(info.get("uuids"))
+        return bool(info) and all(info.get(f) for f in self.required_fields)
+
+    def _run_stage(self, job, i):
+        stage = self.stages[i]
+        self.stats.incr(f"{stage}_runs")
+        with self.stats.timer(f"{stage}_time"):
+            try:
+                res = getattr(self, f"lookup_{stage}")(job["address"], job.get("name"))
+            except Exception as e:
+                log.debug(f"Bluetooth {stage} stage failed for {job['address']}: {e}")
+                res = None
+        if res is not None:
+            self.caches[stage].put(job["address"], res)
+        else:
+            self.stats.incr(f"{stage}_failed")
+        job[stage] = res
+        self._next(job, i + 1)
+
+    def _done(self, job):
+        with self._lock:
+            self.in_flight.discard(job["address"])
+            self.stats.gauge("pending", len(self.in_flight))
+
+    def _finish(self, job):
+        try:
+            address = job["address"]
+            name = job.get("name")
+            fields = job.get("hci") or (None,) * (len(bt_device.attributes) - 2)
+            device = bt_device([None, address, name, *fields])
+            device.add_services(job.get("sdp") or [])
+
+            # fill what paging did not deliver from the inquiry
+            info = job["info"]
+            for field in ("device_class", "manufacturer", "device_id"):
+                if not device[field] and info.get(field):
+                    setattr(device, field, info[field])
+            if not device.extra_hci_info and info.get("uuids"):
+                device.extra_hci_info = "EIR UUIDs: " + ", ".join(info["uuids"])
+            device.rssi = info.get("rssi")
+            device.adapter = info.get("adapter")
+            self.db.insert_bluetooth_device(device)
+            self.stats.incr("inserted")
+        finally:
+            self._done(job)
+
+    def lookup_name(self, address, name=None):
+        return bluetooth.lookup_name(address, timeout=5)
+
+    def lookup_sdp(self, address, name=None):
+        # [] is a valid result, None is not cached
+        return self.get_services(address)
+
+    def lookup_hci(self, address, name=None):
+        device = self.get_hci_info(address, name)
+        if device is None:
+            return None
+        # everything after address and name
+        fields = tuple(device[a] for a in bt_device.attributes[2:])
+        if not any(fields[:-1]):
+            return None # not reachable, try again next time
+        return fields
 
     def get_device_info(self, address, name):
+        # all stages at once, without the pipeline
         log.debug(f"Fetching detailed information for Bluetooth device: {address}")
 
         try:
@@ -22,6 +161,18 @@ class bt_scanner:
         except Exception as e:
             log.debug(f"Error retrieving Bluetooth device name for {address}: {e}")
 
+        services = self.get_services(address) or []
+
+        # Fetch the device class and other information using `hcitool`
+        device = self.get_hci_info(address, name)
+        if device is None:
+            device = bt_device([None, address, name] + [None] * (len(bt_device.attributes) - 2))
+
+        device.add_services(services)
+
+        self.db.insert_bluetooth_device(device)
+
+    def get_services(self, address):
         services = []
         try:
             found_services = bluetooth.find_service(address=address)
@@ -44,52 +195,38 @@ class bt_scanner:
                 log.debug("No Bluetooth services found.")
         except Exception as e:
             log.debug(f"Error retrieving services for Bluetooth device {address}: {e}")
-
-        # Fetch the device class and other information using `hcitool`
-        device = self.get_hci_info(address, name)
-
-        device.add_services(services)
-
-        self.db.insert_bluetooth_device(device)
+            return None
+        return services
 
     def get_hci_info(self, address, name):
         try:
             result = subprocess.run(['hcitool', 'info', address], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            output = result.stdout.decode()
-
-            device_class = None
-            manufacturer = None
-            version = None
-            hci_version = None
-            lmp_version = None
-            device_type = None
-            device_id = None
-            extra_info = ""
-
-            # Extract relevant information from the hcitool output
-            for line in output.splitlines():
-                if "Class" in line:
-                    device_class = line.split("Class: ")[-1].strip() if "Class" in line else None
-                elif "Manufacturer" in line:
-                    manufacturer = line.split("Manufacturer: ")[-1].strip() if "Manufacturer" in line else None
-                elif "Version" in line:
-                    version = line.split("Version: ")[-1].strip() if "Version" in line else None
-                elif "HCI Version" in line:
-                    hci_version = line.split("HCI Version: ")[-1].strip() if "HCI Version" in line else None
-                elif "LMP Version" in line:
-                    lmp_version = line.split("LMP Version: ")[-1].strip() if "LMP Version" in line else None
-                elif "Device Type" in line:
-                    device_type = line.split("Device Type: ")[-1].strip() if "Device Type" in line else None
-                elif "Device ID" in line:
-                    device_id = line.split("Device ID: ")[-1].strip() if "Device ID" in line else None
-                else:
-                    extra_info = f"{extra_info}\n{line}"
-
-            return bt_device([None, address, name, device_class, manufacturer, version, hci_version, lmp_version, device_type, device_id, extra_info])
+            info = parse_hcitool_info(result.stdout.decode())
+            return bt_device([None, address, name] + [info[a] for a in bt_device.attributes[2:]])
 
         except Exception as e:
             log.debug(f"Error fetching Bluetooth device info via HCI for {address}: {e}")
-            return None, None, None, None, None, None, None, None
+            return None
+
+    def inquire_bluetooth_devices(self):
+        while self.scanning:
+            log.debug("Inquiry for Bluetooth devices...")
+
+            try:
+                results = inquiry(self.dev_id, duration=6)
+            except Exception as e:
+                log.info(f"Bluetooth Inquiry failed: {e}")
+                time.sleep(1)
+                continue
+
+            log.debug(f"Found {len(results)} Bluetooth device(s)")
+            for result in results:
+                info = eir_info(result, self.manu)
+                info["adapter"] = f"hci{self.dev_id}"
+                log.info(f"Bluetooth Device Address: {result['address']} | Device Name: {info['name']} | RSSI: {info['rssi']}")
+                self.enqueue(result["address"], info["name"], info)
+
+            time.sleep(self.pause)
 
     def scan_bluetooth_devices(self):
         while self.scanning:
@@ -107,19 +244,32 @@ class bt_scanner:
                 log.debug(f"Found {len(devices)} Bluetooth device(s):")
                 for addr, name in devices:
                     log.info(f"Bluetooth Device Address: {addr} | Device Name: {name}")
-                    self.executor.submit(self.get_device_info, addr, name)
+                    self.enqueue(addr, name)
             else:
                 log.debug("No Bluetooth devices found.")
 
-            # TODO
-            time.sleep(3)
+            time.sleep(self.pause)
 
     def scan(self):
-        scan_thread = threading.Thread(target=self.scan_bluetooth_devices)
-        scan_thread.daemon = True
-        scan_thread.start()
+        self.scanning = True
+        # fresh executors on every start, stop() shuts them down
+        self.executors = {s: ThreadPoolExecutor(max_workers=self.workers[s], thread_name_prefix=f"bt_{s}") for s in self.stages}
+        target = self.inquire_bluetooth_devices if self.mode == "eir" else self.scan_bluetooth_devices
+        self.thread = threading.Thread(target=target)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def is_alive(self):
+        return self.thread is not None and self.thread.is_alive()
 
     def stop(self):
         self.scanning = False
-        log.debug("Bluetooth Scanning stopped.")
+        for executor in self.executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+        self.executors = {}
+        # cancelled jobs never reach _done, their addresses would stay pending after a restart
+        with self._lock:
+            self.in_flight.clear()
+            self.stats.gauge("pending", 0)
+        log.debug(f"Bluetooth Scanning stopped: {self.stats}")
 
@@ -1,29 +1,153 @@
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import sessionmaker
+from contextlib import contextmanager
+import datetime
+import hashlib
 import pickle
 import time
 import threading
 
 from lib.bt_device import bt_device
 from lib.ble_device import ble_device
+from lib.bounded_cache import bounded_cache
+from lib.metrics import metrics
 from lib.log import log
 
 export_all_objects = False
 
 class DB:
-    def __init__(self, path):
+    # SQLite storage profiles
+    # cache_size: negative values are KiB, mmap_size: bytes, busy_timeout: ms
+    profiles = {
+        "default": {
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "cache_size": -16000,
+            "mmap_size": 64 * 1024 * 1024,
+            "busy_timeout": 5000,
+        },
+        # Raspberry Pi nodes
+        "low_memory": {
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "cache_size": -2000,
+            "mmap_size": 0,
+            "busy_timeout": 5000,
+        },
+        # stats scripts, large read-mostly queries. Keeps the journal mode of
+        # the file, which may be a copy or belong to a node writing it
+        "analysis": {
+            "journal_mode": None,
+            "synchronous": "NORMAL",
+            "cache_size": -256000,
+            "mmap_size": 1024 * 1024 * 1024,
+            "busy_timeout": 30000,
+        },
+        # behaviour before storage profiles existed
+        "legacy": {
+            "journal_mode": "DELETE",
+            "synchronous": "FULL",
+            "cache_size": -2000,
+            "mmap_size": 0,
+            "busy_timeout": 5000,
+        },
+    }
+
+    # WITH can lead into INSERT/UPDATE/DELETE, it runs on the write connection
+    read_statements = ("SELECT", "EXPLAIN")
+    # PRAGMAs without side effects, others (optimize, wal_checkpoint, ...) write
+    read_pragmas = ("table_info", "table_xinfo", "table_list", "index_list", "index_info", "index_xinfo",
+                    "foreign_key_list", "database_list", "compile_options", "page_count", "page_size")
+
+    def __init__(self, path, profile="default", read_pool_size=4):
+        self.path = path
+        if isinstance(profile, str):
+            profile = self.profiles[profile]
+        self.profile = dict(self.profiles["default"], **profile)
+        self.read_pool_size = read_pool_size
+        self.stats = metrics()
+
+        # a single write connection, writers are serialized by self._write_lock
         self.engine = create_engine(
             f"sqlite:///{path}",
             echo=False,
-            pool_size=10,
-            max_overflow=20,
+            pool_size=1,
+            max_overflow=0,
             connect_args={"check_same_thread": False}
         )
+        event.listen(self.engine, "connect", lambda con, _: self.__configure(con, read_only=False))
         self.Session = sessionmaker(bind=self.engine)
+        self._write_lock = threading.Lock()
+        self._local = threading.local()
+
+        # the read pool is opened on first use, after the writer created the file
+        self.read_engine = None
+        self.ReadSession = None
+        self._read_lock = threading.Lock()
+
+        with self.engine.connect():
+            pass
 
     def __del__(self):
         self.close()
 
+    def __configure(self, con, read_only):
+        cursor = con.cursor()
+        if not read_only and self.profile["journal_mode"]:
+            cursor.execute(f"PRAGMA journal_mode={self.profile['journal_mode']}")
+        cursor.execute(f"PRAGMA synchronous={self.profile['synchronous']}")
+        cursor.execute(f"PRAGMA cache_size={int(self.profile['cache_size'])}")
+        cursor.execute(f"PRAGMA mmap_size={int(self.profile['mmap_size'])}")
+        cursor.execute(f"PRAGMA busy_timeout={int(self.profile['busy_timeout'])}")
+        if read_only:
+            cursor.execute("PRAGMA query_only=ON")
+        cursor.close()
+
+    def __read_sessionmaker(self):
+        if self.ReadSession is None:
+            with self._read_lock:
+                if self.ReadSession is None:
+                    self.read_engine = create_engine(
+                        f"sqlite:///file:{self.path}?mode=ro&uri=true",
+                        echo=False,
+                        pool_size=self.read_pool_size,
+                        max_overflow=0,
+                        connect_args={"check_same_thread": False}
+                    )
+                    event.listen(self.read_engine, "connect", lambda con, _: self.__configure(con, read_only=True))
+                    self.ReadSession = sessionmaker(bind=self.read_engine)
+        return self.ReadSession
+
+    def __is_read(self, query):
+        statement = query.lstrip().split(None, 1)
+        if not statement:
+            return False
+        keyword = statement[0].upper()
+        if keyword in self.read_statements:
+            return True
+        if keyword != "PRAGMA" or "=" in query:
+            return False
+        # PRAGMA [schema.]name[(arg)]
+        name = statement[1].split("(", 1)[0].rsplit(".", 1)[-1].strip().rstrip(";").lower() if len(statement) > 1 else ""
+        return name in self.read_pragmas
+
+    def lock_stats(self):
+        snap = self.stats.snapshot()
+        return {
+            "lock_wait": snap["timings"].get("lock_wait"),
+            "lock_retries": snap["counters"].get("lock_retries", 0),
+            "lock_retry_wait": snap["counters"].get("lock_retry_wait", 0),
+        }
+
+    @contextmanager
+    def __write_session(self):
+        start = time.monotonic()
+        with self._write_lock:
+            self.stats.observe("lock_wait", time.monotonic() - start)
+            with self.Session() as session:
+                yield session
+
     def get_tables(self):
         tables = self.execute("SELECT name FROM sqlite_master WHERE type='table'")
         return [t[0] for t in tables]
@@ -37,57 +161,98 @@ class DB:
             try:
                 return session.execute(query, *args)
             except OperationalError as e:
-                print("retry")
                 if "database is locked" in str(e):
+                    log.debug(f"database is locked, retrying {query}")
+                    self.stats.incr("lock_retries")
+                    self.stats.incr("lock_retry_wait", 0.05)
                     time.sleep(0.05)
                 else:
                     raise e
         log.info(f"Failed executing {query}")
         return None
 
+    @contextmanager
+    def transaction(self):
+        # group all statements of this thread into one commit
+        if getattr(self._local, "session", None) is not None:
+            # nested transaction: join the outer one
+            yield self._local.session
+            return
+
+        with self.__write_session() as session:
+            self._local.session = session
+            try:
+                yield session
+                session.commit()
+            except Exception:
+                session.rollback()
+                raise
+            finally:
+                self._local.session = None
+
+    @contextmanager
+    def __session(self, query):
+        # yields (session, autocommit)
+        session = getattr(self._local, "session", None)
+        if session is not None:
+            yield session, False
+        elif self.__is_read(query):
+            with self.__read_sessionmaker()() as session:
+                yield session, False
+        else:
+            with self.__write_session() as session:
+                yield session, True
+
     def execute(self, query, *args):
-        with self.Session() as session:
+        with self.__session(query) as (session, autocommit):
             result = self.__execute(session, text(query), *args)
             if result:
-                session.commit()
-                res = result.fetchall()
+                res = result.fetchall() if result.returns_rows else None
+                if autocommit:
+                    session.commit()
                 if res:
                     return [tuple(r) for r in res if r]
         return None
 
-    def execute_silent(self, query):
-        with self.Session() as session:
-            result = self.__execute(session, text(query))
-            if result:
+    def execute_silent(self, query, *args):
+        with self.__session(query) as (session, autocommit):
+            result = self.__execute(session, text(query), *args)
+            if result and autocommit:
                 session.commit()
 
     def execute_rowid(self, query, *args):
-        with self.Session() as session:
+        with self.__session(query) as (session, autocommit):
             result = self.__execute(session, text(query), *args)
             if result:
-                session.commit()
+                if autocommit:
+                    session.commit()
                 return result.lastrowid
         return None
 
     def execute_single(self, query, *args):
-        with self.Session() as session:
+        with self.__session(query) as (session, autocommit):
             result = self.__execute(session, text(query), *args)
             if result:
-                session.commit()
-                res = result.fetchone()
+                res = result.fetchone() if result.returns_rows else None
+                if autocommit:
+                    session.commit()
                 if res:
                     return tuple(res)
         return None
 
     def close(self):
-        if self.engine:
+        if getattr(self, "read_engine", None):
+            self.read_engine.dispose()
+            self.read_engine = None
+        if getattr(self, "engine", None):
             self.engine.dispose()
             self.engine = None
 
 table_time = """CREATE TABLE IF NOT EXISTS time (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             timestamp TIMESTAMP,
-            geolocation TEXT
+            geolocation TEXT,
+            hash TEXT
             );"""
 
 table_bluetooth_device_time = """CREATE TABLE IF NOT EXISTS bluetooth_device_time (
@@ -118,7 +283,8 @@ table_bluetooth_device = """CREATE TABLE IF NOT EXISTS bluetooth_device (
                          device_type TEXT,
                          device_id TEXT,
                          extra_hci_info TEXT,
-                         services TEXT
+                         services TEXT,
+                         hash TEXT
                          );"""
 
 table_ble_device = """CREATE TABLE IF NOT EXISTS ble_device (
@@ -146,14 +312,16 @@ table_ble_device = """CREATE TABLE IF NOT EXISTS ble_device (
                     servicesresolved BOOLEAN,
                     class_of_device BLOB,
                     modalias TEXT,
-                    icon TEXT
+                    icon TEXT,
+                    hash TEXT
                     ) """
 
 table_ble_service = """CREATE TABLE IF NOT EXISTS ble_service (
                         id INTEGER PRIMARY KEY AUTOINCREMENT,
                         uuid TEXT,
                         description TEXT,
-                        handle INTEGER
+                        handle INTEGER,
+                        hash TEXT
                         );"""
 
 table_ble_characteristic = """CREATE TABLE IF NOT EXISTS ble_characteristic (
@@ -162,7 +330,8 @@ table_ble_characteristic = """CREATE TABLE IF NOT EXISTS ble_characteristic (
                         value TEXT,
                         description TEXT,
                         handle INTEGER,
-                        properties TEXT
+                        properties TEXT,
+                        hash TEXT
                         );"""
 
 table_ble_descriptor = """CREATE TABLE IF NOT EXISTS ble_descriptor (
@@ -170,7 +339,8 @@ table_ble_descriptor = """CREATE TABLE IF NOT EXISTS ble_descriptor (
                         uuid TEXT,
                         value TEXT,
                         description TEXT,
-                        handle INTEGER
+                        handle INTEGER,
+                        hash TEXT
                         );"""
 
 table_ble_device_char = """CREATE TABLE IF NOT EXISTS ble_device_char (
@@ -207,7 +377,8 @@ table_bluetooth_service = """CREATE TABLE IF NOT EXISTS bluetooth_service (
                           provider TEXT,
                           service_id TEXT,
                           protocol TEXT,
-                          port INTEGER
+                          port INTEGER,
+                          hash TEXT
                           );"""
 
 table_bluetooth_device_service = """CREATE TABLE IF NOT EXISTS bluetooth_device_service (
@@ -219,12 +390,165 @@ table_bluetooth_device_service = """CREATE TABLE IF NOT EXISTS bluetooth_device_
                                  FOREIGN KEY (time_id) REFERENCES time (id)
                                  );"""
 
+table_location = """CREATE TABLE IF NOT EXISTS location (
+                 id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 name TEXT UNIQUE
+                 );"""
+
+# one row per device and second, ts is in epoch seconds
+table_ble_sighting = """CREATE TABLE IF NOT EXISTS ble_sighting (
+                     device_id INTEGER NOT NULL,
+                     ts INTEGER NOT NULL,
+                     rssi INTEGER,
+                     location_id INTEGER,
+                     adapter TEXT,
+                     FOREIGN KEY (device_id) REFERENCES ble_device (id),
+                     FOREIGN KEY (location_id) REFERENCES location (id),
+                     PRIMARY KEY (device_id, ts)
+                     ) WITHOUT ROWID;"""
+
+table_bluetooth_sighting = """CREATE TABLE IF NOT EXISTS bluetooth_sighting (
+                           device_id INTEGER NOT NULL,
+                           ts INTEGER NOT NULL,
+                           rssi INTEGER,
+                           location_id INTEGER,
+                           adapter TEXT,
+                           FOREIGN KEY (device_id) REFERENCES bluetooth_device (id),
+                           FOREIGN KEY (location_id) REFERENCES location (id),
+                           PRIMARY KEY (device_id, ts)
+                           ) WITHOUT ROWID;"""
+
+# signal of every adapter for ble_sighting rows heard by several adapters,
+# ble_sighting itself keeps the strongest one
+table_ble_sighting_adapter = """CREATE TABLE IF NOT EXISTS ble_sighting_adapter (
+                             device_id INTEGER NOT NULL,
+                             ts INTEGER NOT NULL,
+                             adapter TEXT NOT NULL,
+                             rssi INTEGER,
+                             FOREIGN KEY (device_id) REFERENCES ble_device (id),
+                             PRIMARY KEY (device_id, ts, adapter)
+                             ) WITHOUT ROWID;"""
+
+# GATT trees learned by gatt_profiles, per advertisement fingerprint (json)
+table_gatt_profile = """CREATE TABLE IF NOT EXISTS gatt_profile (
+                     fingerprint TEXT PRIMARY KEY,
+                     tree TEXT NOT NULL,
+                     confirmations INTEGER NOT NULL,
+                     mismatches INTEGER NOT NULL,
+                     updated INTEGER NOT NULL
+                     );"""
+
+# device clusters of ble_linking: devices linked across address changes
+table_ble_cluster = """CREATE TABLE IF NOT EXISTS ble_cluster (
+                    device_id INTEGER PRIMARY KEY,
+                    cluster_id INTEGER NOT NULL,
+                    FOREIGN KEY (device_id) REFERENCES ble_device (id)
+                    );"""
+
+table_ble_cluster_link = """CREATE TABLE IF NOT EXISTS ble_cluster_link (
+                         device_id1 INTEGER NOT NULL,
+                         device_id2 INTEGER NOT NULL,
+                         similarity REAL,
+                         PRIMARY KEY (device_id1, device_id2)
+                         ) WITHOUT ROWID;"""
+
+index_ble_cluster = "CREATE INDEX IF NOT EXISTS ble_cluster_cluster ON ble_cluster (cluster_id, device_id);"
+
+# columns added after the tables were first created
+added_columns = {
+    "ble_sighting": {"adapter": "TEXT"},
+    "bluetooth_sighting": {"adapter": "TEXT"},
+}
+
+# the primary key covers per device time ranges, these cover global time windows
+index_ble_sighting_ts = "CREATE INDEX IF NOT EXISTS ble_sighting_ts ON ble_sighting (ts, device_id, rssi, location_id);"
+index_bluetooth_sighting_ts = "CREATE INDEX IF NOT EXISTS bluetooth_sighting_ts ON bluetooth_sighting (ts, device_id, rssi, location_id);"
+
+# link tables of the time table, replaced by the sighting tables (see tools/migrate_sightings.py)
+legacy_sightings = {
+    "ble_device_time": "ble_sighting",
+    "bluetooth_device_time": "bluetooth_sighting",
+}
+
+def unmigrated_sightings(db):
+    # link tables with sightings while the sighting table is still empty
+    tables = db.get_tables()
+    res = []
+    for link_table, sighting_table in legacy_sightings.items():
+        if link_table not in tables or not db.execute_single(f"SELECT 1 FROM {link_table} LIMIT 1"):
+            continue
+        if sighting_table not in tables or not db.execute_single(f"SELECT 1 FROM {sighting_table} LIMIT 1"):
+            res.append(link_table)
+    return res
+
+def warn_unmigrated(db):
+    tables = unmigrated_sightings(db)
+    if tables:
+        log.warning(f"{db.path} has sightings in {', '.join(tables)} only, timings are missing until "
+                    f"they are converted: python -m tools.migrate_sightings {db.path}")
+    return tables
+
+def to_epoch(timestamp):
+    # naive timestamps are local time, like datetime.now() used by the scanners
+    if timestamp is None:
+        return None
+    if isinstance(timestamp, (int, float)):
+        return int(timestamp)
+    if isinstance(timestamp, str):
+        timestamp = datetime.datetime.fromisoformat(timestamp)
+    return int(timestamp.timestamp())
+
+# deduplicated tables and the columns their content hash is built from
+unique_tables = {
+    "time": ["timestamp", "geolocation"],
+    "bluetooth_device": ["address", "name", "device_class", "manufacturer", "version", "hci_version",
+                         "lmp_version", "device_type", "device_id", "extra_hci_info", "services"],
+    "ble_device": ["name", "name2", "address", "address2", "addresstype", "alias", "appearance",
+                   "paired", "bonded", "trusted", "blocked", "legacypairing", "connected", "uuids",
+                   "manufacturers", "manufacturer_binary", "servicedata", "advertisingflags",
+                   "advertisingdata", "txpower", "servicesresolved", "class_of_device", "modalias", "icon"],
+    "ble_service": ["uuid", "description", "handle"],
+    "ble_characteristic": ["uuid", "value", "description", "handle", "properties"],
+    "ble_descriptor": ["uuid", "value", "description", "handle"],
+    "bluetooth_service": ["host", "name", "service_classes", "profiles", "description", "provider",
+                          "service_id", "protocol", "port"],
+}
+
+# hot tables whose hash -> id mapping is kept in memory
+cached_tables = ("ble_device", "time", "ble_service", "ble_characteristic", "bluetooth_service")
+
+# link tables are still deduplicated by a select, these make it an index lookup
+link_indexes = [
+    "CREATE INDEX IF NOT EXISTS ble_device_time_link ON ble_device_time (device_id, time_id);",
+    "CREATE INDEX IF NOT EXISTS bluetooth_device_time_link ON bluetooth_device_time (device_id, time_id);",
+    "CREATE INDEX IF NOT EXISTS bluetooth_device_service_link ON bluetooth_device_service (device_id, service_id, time_id);",
+]
+
+def content_hash(table, columns: dict):
+    # values are normalized to what SQLite gives back, so hashes of new rows
+    # match the ones backfilled from existing rows
+    values = []
+    for col in unique_tables[table]:
+        val = columns.get(col)
+        if val is None:
+            values.append("\0")
+        else:
+            if isinstance(val, bool):
+                val = int(val)
+            values.append(str(val))
+    return hashlib.sha1("\x1f".join(values).encode("utf-8", "surrogatepass")).hexdigest()
+
 
 class BluetoothDatabase:
-    def __init__(self, file_path="db.db"):
-        self.db = DB(file_path)
+    def __init__(self, file_path="db.db", profile="default", cache_size=4096, cache_ttl=600):
+        self.db = DB(file_path, profile)
+        self.caches = {table: bounded_cache(cache_size, cache_ttl) for table in cached_tables}
+        self.locations = {}
         self.create_bluetooth_tables()
         self.create_ble_tables()
+        self.migrate_hashes()
+        self.migrate_columns()
+        warn_unmigrated(self.db)
 
     def create_bluetooth_tables(self):
         try:
@@ -233,6 +557,9 @@ class BluetoothDatabase:
             self.db.execute_silent(table_bluetooth_device)
             self.db.execute_silent(table_bluetooth_service)
             self.db.execute_silent(table_bluetooth_device_service)
+            self.db.execute_silent(table_location)
+            self.db.execute_silent(table_bluetooth_sighting)
+            self.db.execute_silent(index_bluetooth_sighting_ts)
 
             log.debug("bluetooth tables created successfully.")
         except Exception as e:
@@ -248,11 +575,85 @@ class BluetoothDatabase:
             self.db.execute_silent(table_ble_descriptor)
             self.db.execute_silent(table_ble_device_char)
             self.db.execute_silent(table_ble_char_desc)
+            self.db.execute_silent(table_location)
+            self.db.execute_silent(table_ble_sighting)
+            self.db.execute_silent(index_ble_sighting_ts)
+            self.db.execute_silent(table_ble_sighting_adapter)
+            self.db.execute_silent(table_gatt_profile)
+            self.db.execute_silent(table_ble_cluster)
+            self.db.execute_silent(table_ble_cluster_link)
+            self.db.execute_silent(index_ble_cluster)
 
             log.debug("ble tables created successfully.")
         except Exception as e:
             log.error(f"Error creating BLE tables: {e}")
 
+    @contextmanager
+    def transaction(self):
+        try:
+            with self.db.transaction() as session:
+                yield session
+        except Exception:
+            # cached ids might point to rows that were rolled back
+            self.clear_cache()
+            raise
+
+    def clear_cache(self):
+        for cache in self.caches.values():
+            cache.clear()
+        self.locations.clear()
+
+    def cache_stats(self):
+        return {table: cache.stats() for table, cache in self.caches.items()}
+
+    def migrate_columns(self):
+        for table, columns in added_columns.items():
+            try:
+                existing = [c.lower() for c in self.db.get_columns(table)]
+                for column, column_type in columns.items():
+                    if column not in existing:
+                        log.info(f"adding column {column} to {table}")
+                        self.db.execute_silent(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+            except Exception as e:
+                log.error(f"Error migrating {table}: {e}")
+
+    def migrate_hashes(self, chunk_size=10000):
+        # add the content hash to databases created before it existed
+        for table in unique_tables:
+            try:
+                if "hash" not in [c.lower() for c in self.db.get_columns(table)]:
+                    log.info(f"adding content hash column to {table}")
+                    self.db.execute_silent(f"ALTER TABLE {table} ADD COLUMN hash TEXT")
+
+                self.db.execute_silent(f"CREATE UNIQUE INDEX IF NOT EXISTS {table}_hash ON {table} (hash)")
+                self.__backfill_hashes__(table, chunk_size)
+            except Exception as e:
+                log.error(f"Error migrating {table}: {e}")
+
+        for index in link_indexes:
+            self.db.execute_silent(index)
+
+    def __backfill_hashes__(self, table, chunk_size):
+        columns = unique_tables[table]
+        while True:
+            rows = self.db.execute(f"SELECT id, {', '.join(columns)} FROM {table} WHERE hash IS NULL LIMIT {chunk_size}")
+            if not rows:
+                return
+
+            updates = []
+            seen = set()
+            for row in rows:
+                h = content_hash(table, dict(zip(columns, row[1:])))
+                if h in seen or self.db.execute_single(f"SELECT id FROM {table} WHERE hash = :hash", {"hash": h}):
+                    # duplicate rows of older databases are kept, new inserts resolve to the first one
+                    h = f"{h}:{row[0]}"
+                seen.add(h)
+                updates.append({"id": row[0], "hash": h})
+
+            with self.db.transaction():
+                self.db.execute_silent(f"UPDATE {table} SET hash = :hash WHERE id = :id", updates)
+            log.info(f"backfilled {len(updates)} hashes in {table}")
+
     def __create_where_clause__(self, columns: dict):
         clauses = []
         params = {}
@@ -275,8 +676,33 @@ class BluetoothDatabase:
 
         return None
 
+    def __upsert__(self, table, columns: dict):
+        # single indexed round trip: insert, or return the id of the existing row
+        h = content_hash(table, columns)
+        cache = self.caches.get(table)
+        if cache is not None:
+            row_id = cache.get(h)
+            if row_id is not None:
+                return row_id
+
+        columns = dict(columns, hash=h)
+        res = self.db.execute_single(f"""INSERT INTO {table} ({", ".join(columns.keys())})
+                               VALUES ({", ".join([f":{c}" for c in columns.keys()])})
+                               ON CONFLICT(hash) DO UPDATE SET hash = excluded.hash
+                               RETURNING id;""",
+                               columns)
+        if not res:
+            return None
+
+        if cache is not None:
+            cache.put(h, res[0])
+        return res[0]
+
     def __insert_unique__(self, table, columns: dict):
         try:
+            if table in unique_tables:
+                return self.__upsert__(table, columns)
+
             data = self.__select_exactly__(table, columns)
             if (data is None or len(data) <= 0):
                 return self.db.execute_rowid(f"""INSERT OR IGNORE INTO {table} ({", ".join([col for col in columns.keys()])})
@@ -290,22 +716,64 @@ class BluetoothDatabase:
 
         return None
 
+    def get_location_id(self, name):
+        if name is None:
+            return None
+
+        location_id = self.locations.get(name)
+        if location_id is None:
+            res = self.db.execute_single("""INSERT INTO location (name) VALUES (:name)
+                                         ON CONFLICT(name) DO UPDATE SET name = excluded.name
+                                         RETURNING id;""", {"name": name})
+            if res:
+                location_id = res[0]
+                self.locations[name] = location_id
+        return location_id
+
+    def __insert_sighting__(self, table, device_id, timestamp, rssi, geolocation, adapter=None):
+        if device_id is None:
+            return
+
+        # keep the strongest signal (and the adapter which saw it) if a device is seen several times in the same second
+        self.db.execute_silent(f"""INSERT INTO {table} (device_id, ts, rssi, location_id, adapter)
+                               VALUES (:device_id, :ts, :rssi, :location_id, :adapter)
+                               ON CONFLICT(device_id, ts) DO UPDATE SET
+                               adapter = CASE WHEN rssi IS NULL OR excluded.rssi > rssi THEN coalesce(excluded.adapter, adapter) ELSE adapter END,
+                               rssi = CASE WHEN rssi IS NULL OR excluded.rssi > rssi THEN excluded.rssi ELSE rssi END,
+                               location_id = coalesce(excluded.location_id, location_id);""",
+                               {
+                                   "device_id": device_id,
+                                   "ts": to_epoch(timestamp),
+                                   "rssi": rssi,
+                                   "location_id": self.get_location_id(geolocation),
+                                   "adapter": adapter,
+                               })
+
+    def __insert_adapter_sightings__(self, device_id, timestamp, rssi_by_adapter):
+        if device_id is None:
+            return
+        ts = to_epoch(timestamp)
+        self.db.execute_silent("""INSERT INTO ble_sighting_adapter (device_id, ts, adapter, rssi)
+                               VALUES (:device_id, :ts, :adapter, :rssi)
+                               ON CONFLICT(device_id, ts, adapter) DO UPDATE SET
+                               rssi = CASE WHEN rssi IS NULL OR excluded.rssi > rssi THEN excluded.rssi ELSE rssi END;""",
+                               [{"device_id": device_id, "ts": ts, "adapter": adapter, "rssi": rssi}
+                                for adapter, rssi in rssi_by_adapter.items()])
+
     def insert_bluetooth_device(self, device: bt_device):
         log.info(f"found Bluetooth device: {device.address} {device.name}")
-        time_data = {"timestamp": device.timestamp,
-                     "geolocation": device.geolocation,
-                     }
-
-        time_id = self.__insert_unique__("time", time_data)
-
         device_id = self.__insert_unique__("bluetooth_device", device.to_dict())
 
-        device_time_data = {
-                "device_id": device_id,
-                "time_id": time_id,
-                }
+        self.__insert_sighting__("bluetooth_sighting", device_id, device.timestamp,
+                                 getattr(device, "rssi", None), device.geolocation, getattr(device, "adapter", None))
+
+        if device.services:
+            # services are still linked to a time row
+            time_data = {"timestamp": device.timestamp,
+                         "geolocation": device.geolocation,
+                         }
 
-        self.__insert_unique__("bluetooth_device_time", device_time_data)
+            time_id = self.__insert_unique__("time", time_data)
 
         for service in device.services:
             # flatten lists in service
@@ -324,23 +792,14 @@ class BluetoothDatabase:
 
     def insert_ble_device(self, device: ble_device):
         log.info(f"found BLE device: {device.address} {device.name}")
-        time_data = {"timestamp": device.timestamp,
-                     "geolocation": device.geolocation,
-                     }
-
-        time_id = self.__insert_unique__("time", time_data)
-
         device_data = device.to_dict()
         device_data.pop("rssi")
 
         device_id = self.__insert_unique__("ble_device", device_data)
 
-        device_time_data = {
-                "device_id": device_id,
-                "time_id": time_id,
-                }
-
-        self.__insert_unique__("ble_device_time", device_time_data)
+        self.__insert_sighting__("ble_sighting", device_id, device.timestamp, device.rssi, device.geolocation, device.adapter)
+        if device.rssi_by_adapter:
+            self.__insert_adapter_sightings__(device_id, device.timestamp, device.rssi_by_adapter)
 
         log.debug(f"BLE Device {device.name} ({device.address}) inserted into the database.")
 
@@ -398,6 +857,21 @@ class BluetoothDatabase:
 
                                 self.__insert_unique__("ble_char_desc", device_desc)
 
+    def save_gatt_profiles(self, rows):
+        if not rows:
+            return
+        self.db.execute_silent("""INSERT INTO gatt_profile (fingerprint, tree, confirmations, mismatches, updated)
+                               VALUES (:fingerprint, :tree, :confirmations, :mismatches, :updated)
+                               ON CONFLICT(fingerprint) DO UPDATE SET
+                               tree = excluded.tree, confirmations = excluded.confirmations,
+                               mismatches = excluded.mismatches, updated = excluded.updated;""", rows)
+
+    def load_gatt_profiles(self, limit):
+        # the most recently updated ones, oldest first
+        rows = self.db.execute("""SELECT fingerprint, tree, confirmations, mismatches FROM
+                               (SELECT * FROM gatt_profile ORDER BY updated DESC LIMIT :limit)
+                               ORDER BY updated;""", {"limit": limit})
+        return rows or []
 
     def close(self):
         self.db.close()
@@ -0,0 +1,133 @@
+import queue
+import threading
+import time
+
+from lib.db import BluetoothDatabase
+from lib.metrics import metrics
+from lib.log import log
+
+class db_writer:
+    # Write-behind stage in front of BluetoothDatabase.
+    # The scanner callbacks only enqueue records, a single writer thread
+    # flushes them in batched transactions (by size or by time).
+    POLICIES = ("block", "drop_new", "drop_old")
+
+    def __init__(self, db: BluetoothDatabase, max_queue=10000, batch_size=500, flush_interval=1.0, policy="block", block_timeout=None):
+        if policy not in self.POLICIES:
+            raise ValueError(f"unknown backpressure policy: {policy}")
+
+        self.db = db
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.policy = policy
+        self.block_timeout = block_timeout # only used by "block", None waits forever
+        self.stats = metrics()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    # same interface as BluetoothDatabase so it can be handed to the scanners
+    def insert_ble_device(self, device):
+        self.put(self.db.insert_ble_device, device)
+
+    def insert_bluetooth_device(self, device):
+        self.put(self.db.insert_bluetooth_device, device)
+
+    def insert_ble_services(self, device, services, characteristics, descriptors):
+        self.put(self.db.insert_ble_services, device, services, characteristics, descriptors)
+
+    def put(self, fun, *args):
+        item = (time.monotonic(), fun, args)
+
+        if self.policy == "block":
+            try:
+                self.queue.put(item, timeout=self.block_timeout)
+            except queue.Full:
+                self.stats.incr("dropped_new")
+                return False
+        elif self.policy == "drop_new":
+            try:
+                self.queue.put_nowait(item)
+            except queue.Full:
+                self.stats.incr("dropped_new")
+                return False
+        else: # drop_old
+            while True:
+                try:
+                    self.queue.put_nowait(item)
+                    break
+                except queue.Full:
+                    try:
+                        self.queue.get_nowait()
+                        self.stats.incr("dropped_old")
+                    except queue.Empty:
+                        pass
+
+        self.stats.incr("enqueued")
+        self.stats.gauge("queue_depth", self.queue.qsize())
+        return True
+
+    def _collect(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    item = self.queue.get(timeout=timeout)
+                else:
+                    item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(item)
+        return batch
+
+    def _flush(self, batch):
+        start = time.monotonic()
+        written = len(batch)
+        try:
+            with self.db.transaction():
+                for _, fun, args in batch:
+                    fun(*args)
+        except Exception as e:
+            log.warning(f"Error flushing {len(batch)} records, retrying them one by one: {e}")
+            for _, fun, args in batch:
+                try:
+                    fun(*args)
+                except Exception as e:
+                    log.warning(f"Error writing record: {e}")
+                    self.stats.incr("failed")
+                    written -= 1
+
+        now = time.monotonic()
+        self.stats.observe("flush_latency", now - start)
+        self.stats.observe("batch_size", len(batch))
+        self.stats.observe("queue_latency", now - batch[0][0])
+        self.stats.incr("written", written)
+        self.stats.gauge("queue_depth", self.queue.qsize())
+
+    def _run(self):
+        while not self.stopping.is_set() or not self.queue.empty():
+            batch = self._collect()
+            if batch:
+                self._flush(batch)
+
+    def start(self):
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def is_alive(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def stop(self, timeout=None):
+        # drain everything queued so far, returns False if the deadline was hit
+        if not self.thread:
+            return True
+        self.stopping.set()
+        self.thread.join(timeout)
+        drained = not self.thread.is_alive()
+        if not drained:
+            log.warning(f"Database writer did not drain in time ({self.queue.qsize()} records left)")
+        log.debug(f"Database writer stopped: {self.stats}")
+        return drained
@@ -1,8 +1,7 @@
-import yaml
+from lib.registry import registry
 
 class CoD: # Class of Device
     _instance = None
-    yaml_file = "Assigned Numbers/class_of_device.yaml"
 
     def __new__(cls):
         if cls._instance is None:
@@ -11,11 +10,14 @@ class CoD: # Class of Device
         return cls._instance
 
     def _initialize(self):
-        self.data = self.__load_yaml(self.yaml_file)
-
-    def __load_yaml(self, yaml_file):
-        with open(yaml_file, 'r') as file:
-            return yaml.safe_load(file)
+        self._data = None
+
+    @property
+    def data(self):
+        # loaded on first use
+        if self._data is None:
+            self._data = registry.get().json("class_of_device")
+        return self._data
 
     def parse_services(self, service_indices):
         res = []
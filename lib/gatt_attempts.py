@@ -0,0 +1,167 @@
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+
+from lib.bounded_cache import bounded_cache
+from lib.log import log
+
+QUEUED = "queued"
+DONE = "done"
+FAILED = "failed"
+
+class attempt_tracker:
+    # State of the GATT attempts per address. Entries expire after ttl seconds
+    # and at most max_size are kept, failed devices are retried after
+    # base_delay * 2^(tries - 1) seconds from a delayed queue.
+    # A model which never accepts connections is backed off as a whole once its
+    # fingerprint failed fp_min_failures times without any success. Only
+    # fingerprints with UUIDs or a name pattern count, a manufacturer and
+    # payload prefix alone (e.g. all Apple devices) is shared by unrelated devices.
+    def __init__(self, max_tries=3, base_delay=30, max_delay=3600, ttl=7 * 24 * 3600,
+                 max_size=100000, max_retries=10000, fp_min_failures=5):
+        self.max_tries = max_tries
+        self.fp_min_failures = fp_min_failures
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.ttl = ttl
+        self.max_retries = max_retries
+
+        self.entries = bounded_cache(max_size, ttl)
+        self.retries = [] # heap of (due, seq, address)
+        self.retry_devices = {} # address -> device
+        self.seq = itertools.count()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _fingerprint_key(fingerprint):
+        # (manufacturers, payload prefixes, uuids, name pattern), see gatt_profiles.fingerprint
+        if fingerprint is None or not (fingerprint[2] or fingerprint[3]):
+            return None
+        return "fp:" + repr(fingerprint)
+
+    def tries(self, address):
+        entry = self.entries.get(address)
+        return entry["tries"] if entry is not None else 0
+
+    def should_try(self, address, fingerprint=None):
+        now = time.time()
+        entry = self.entries.get(address)
+        if entry is not None and (entry["state"] != FAILED or entry["next"] > now):
+            return False
+
+        key = self._fingerprint_key(fingerprint)
+        fp_entry = self.entries.get(key) if key is not None else None
+        if fp_entry is not None and fp_entry["next"] > now:
+            return False
+        return True
+
+    def queued(self, address):
+        entry = self.entries.get(address) or {"tries": 0, "next": 0}
+        self.entries.put(address, dict(entry, state=QUEUED, updated=time.time()))
+
+    def forget(self, address):
+        # not attempted after all (e.g. queue full)
+        entry = self.entries.get(address)
+        if entry is not None and entry["tries"]:
+            self.entries.put(address, dict(entry, state=FAILED))
+        else:
+            self.entries.pop(address)
+
+    def success(self, address, fingerprint=None):
+        now = time.time()
+        entry = self.entries.get(address) or {"tries": 0}
+        self.entries.put(address, {"state": DONE, "tries": entry["tries"], "next": 0, "updated": now})
+        key = self._fingerprint_key(fingerprint)
+        if key is not None:
+            # the model does accept connections, no backoff for it any more
+            self.entries.put(key, {"state": DONE, "tries": 0, "next": 0, "updated": now})
+
+    def _backoff(self, tries):
+        return min(self.base_delay * 2 ** (tries - 1), self.max_delay)
+
+    def failure(self, address, fingerprint=None, device=None):
+        now = time.time()
+        entry = self.entries.get(address) or {"tries": 0}
+        tries = entry["tries"] + 1
+
+        if tries >= self.max_tries:
+            self.entries.put(address, {"state": DONE, "tries": tries, "next": 0, "updated": now})
+        else:
+            due = now + self._backoff(tries)
+            self.entries.put(address, {"state": FAILED, "tries": tries, "next": due, "updated": now})
+            if device is not None:
+                self._schedule(address, device, due)
+
+        key = self._fingerprint_key(fingerprint)
+        if key is not None:
+            fp_entry = self.entries.get(key) or {"state": FAILED, "tries": 0}
+            if fp_entry["state"] == DONE:
+                return
+            fp_tries = fp_entry["tries"] + 1
+            due = now + self._backoff(fp_tries - self.fp_min_failures + 1) if fp_tries >= self.fp_min_failures else 0
+            self.entries.put(key, {"state": FAILED, "tries": fp_tries, "next": due, "updated": now})
+
+    def _schedule(self, address, device, due):
+        with self._lock:
+            if address not in self.retry_devices and len(self.retry_devices) >= self.max_retries:
+                return
+            self.retry_devices[address] = device
+            heapq.heappush(self.retries, (due, next(self.seq), address))
+
+    def due(self, now=None):
+        # devices whose backoff is over
+        now = time.time() if now is None else now
+        res = []
+        with self._lock:
+            while self.retries and self.retries[0][0] <= now:
+                _, _, address = heapq.heappop(self.retries)
+                entry = self.entries.get(address)
+                if entry is not None and entry["state"] == FAILED and entry["next"] > now:
+                    continue # failed again since, a later retry is queued
+                device = self.retry_devices.pop(address, None)
+                if device is not None:
+                    res.append(device)
+        return [d for d in res if self.should_try(d.address)]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def snapshot(self, path):
+        now = time.time()
+        entries = [(k, v) for k, v in self.entries.items() if now - v["updated"] < self.ttl]
+        tmp = f"{path}.tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump({"time": now, "entries": entries}, f)
+            os.replace(tmp, path)
+        except OSError as e:
+            log.warning(f"Could not save GATT attempts to {path}: {e}")
+
+    def restore(self, path):
+        # retries of failed devices are due again once they are advertised
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return 0
+        except (OSError, ValueError) as e:
+            log.warning(f"Could not load GATT attempts from {path}: {e}")
+            return 0
+
+        now = time.time()
+        restored = 0
+        for key, entry in data.get("entries", []):
+            if now - entry["updated"] >= self.ttl:
+                continue
+            if entry["state"] == QUEUED:
+                # interrupted by the restart, try again
+                if entry["tries"]:
+                    entry = dict(entry, state=FAILED)
+                else:
+                    continue
+            self.entries.put(key, entry)
+            restored += 1
+        return restored
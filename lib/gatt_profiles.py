@@ -0,0 +1,207 @@
+import copy
+import json
+import re
+import threading
+import time
+
+from lib.bounded_cache import bounded_cache
+from lib.metrics import metrics
+from lib.log import log
+
+class GattProfile:
+    # GATT tree learned from a full interrogation, shared by all devices with the same fingerprint
+    def __init__(self, signature, services, characteristics, descriptors, probes=()):
+        self.signature = signature
+        self.services = services
+        self.characteristics = characteristics
+        self.descriptors = descriptors
+        self.probes = list(probes) # [(handle, uuid)] of readable characteristics, read back on a verification
+        self.confirmations = 1
+        self.mismatches = 0
+
+    def probe_services(self):
+        # services a verification has to discover: the ones of the probes and generic access
+        handles = {h for h, _ in self.probes}
+        service_handles = {c.service_handle for c in self.characteristics if c.handle in handles}
+        uuids = {str(s.uuid) for s in self.services if s.handle in service_handles}
+        return sorted(uuids | {gatt_profiles.generic_access})
+
+    def instantiate(self, values=None):
+        # copies of the tree which can be handed to the callback, values:
+        # characteristic uuid -> value read from this device. The values of
+        # the learned device are not copied, they may be per unit (serials,
+        # names, settings) and would make all devices of a model look equal.
+        values = values or {}
+        services = [copy.copy(s) for s in self.services]
+        characteristics = [copy.copy(c) for c in self.characteristics]
+        descriptors = [copy.copy(d) for d in self.descriptors]
+        for char in characteristics:
+            char.value = values.get(char.uuid)
+        for desc in descriptors:
+            desc.value = None
+        return services, characteristics, descriptors
+
+class gatt_profiles:
+    # Devices of the same model (same manufacturer id, static payload prefix,
+    # advertised UUIDs and name pattern) expose the same GATT tree. Once a tree
+    # was seen min_confirmations times for a fingerprint, a new device only gets
+    # a connection to compare the discovered services and a read of its name.
+
+    # per device values, read again on a verification
+    verify_uuids = ["00002a00-0000-1000-8000-00805f9b34fb"] # Device Name
+    generic_access = "00001800-0000-1000-8000-00805f9b34fb"
+    # readable characteristics of a learned tree which a verification reads back
+    # by handle, instead of discovering and comparing the whole tree
+    probe_count = 3
+
+    name_pattern = re.compile(r"[0-9A-Fa-f]{4,}|\d+")
+
+    def __init__(self, max_size=10000, prefix_bytes=2, min_confirmations=3, max_mismatch_rate=0.2):
+        self.prefix_bytes = prefix_bytes
+        self.min_confirmations = min_confirmations
+        self.max_mismatch_rate = max_mismatch_rate
+        self.profiles = bounded_cache(max_size)
+        self.changed = set() # fingerprints not saved yet
+        self._lock = threading.Lock()
+        self.stats = metrics()
+
+    def fingerprint(self, device):
+        prefixes = None
+        if device.manufacturer_binary:
+            prefixes = ",".join(b[:self.prefix_bytes * 2] for b in device.manufacturer_binary.split(","))
+        uuids = ",".join(sorted(device.uuids.split(","))) if device.uuids else None
+        name = self.name_pattern.sub("#", device.name) if device.name else None
+        if not (device.manufacturers or uuids or name):
+            return None # nothing to tell this device apart from any other one
+        return (device.manufacturers, prefixes, uuids, name)
+
+    @staticmethod
+    def signature(services, characteristics):
+        # shape of the tree, values are ignored
+        return (
+            tuple(sorted(str(s.uuid) for s in services)),
+            tuple(sorted((str(c.uuid), ",".join(sorted(c.properties))) for c in characteristics)),
+        )
+
+    def match(self, fingerprint):
+        # profile if it is trusted enough to skip the full interrogation
+        if fingerprint is None:
+            return None
+        profile = self.profiles.get(fingerprint)
+        if profile is None:
+            self.stats.incr("misses")
+            return None
+        checks = profile.confirmations + profile.mismatches
+        if profile.confirmations < self.min_confirmations or profile.mismatches / checks > self.max_mismatch_rate:
+            self.stats.incr("untrusted")
+            return None
+        self.stats.incr("hits")
+        return profile
+
+    def probes(self, characteristics):
+        readable = sorted((c.handle, str(c.uuid)) for c in characteristics
+                          if c.handle is not None and "read" in c.properties and str(c.uuid) not in self.verify_uuids)
+        return readable[:self.probe_count]
+
+    def learn(self, fingerprint, services, characteristics, descriptors):
+        if fingerprint is None or not services:
+            return
+        # the generic access entries without handle are created from the reads, not discovered
+        discovered = [c for c in characteristics if c.handle is not None]
+        signature = self.signature([s for s in services if s.handle], discovered)
+        with self._lock:
+            self.changed.add(fingerprint)
+            profile = self.profiles.get(fingerprint)
+            if profile is not None and profile.signature == signature:
+                profile.confirmations += 1
+                return
+            if profile is not None:
+                self.stats.incr("replaced")
+                mismatches = profile.mismatches + 1
+            else:
+                mismatches = 0
+            profile = GattProfile(signature, services, characteristics, descriptors, self.probes(discovered))
+            profile.mismatches = mismatches
+            self.profiles.put(fingerprint, profile)
+            self.stats.incr("learned")
+
+    def verified(self, fingerprint, profile, ok):
+        with self._lock:
+            self.changed.add(fingerprint)
+            if ok:
+                profile.confirmations += 1
+                self.stats.incr("verified")
+            else:
+                profile.mismatches += 1
+                self.stats.incr("verify_failed")
+
+    def hit_rate(self):
+        hits = self.stats.get("verified")
+        lookups = hits + self.stats.get("verify_failed") + self.stats.get("misses") + self.stats.get("untrusted")
+        return hits / lookups if lookups else 0.0
+
+    @staticmethod
+    def _tree(profile):
+        return {
+            "services": [[str(s.uuid), s.description, s.handle] for s in profile.services],
+            "characteristics": [[str(c.uuid), c.description, c.handle, list(c.properties), c.service_handle]
+                                for c in profile.characteristics],
+            "descriptors": [[str(d.uuid), d.description, d.handle, d.characteristic_handle] for d in profile.descriptors],
+            "probes": profile.probes,
+        }
+
+    def _profile(self, tree):
+        # ble_gatt imports this module
+        from lib.ble_gatt import GattService, GattCharacteristic, GattDescriptor
+        services, characteristics, descriptors = [], [], []
+        for uuid, description, handle in tree["services"]:
+            svc = GattService(None)
+            svc.uuid, svc.description, svc.handle = uuid, description, handle
+            services.append(svc)
+        for uuid, description, handle, properties, service_handle in tree["characteristics"]:
+            char = GattCharacteristic(None)
+            char.uuid, char.description, char.handle, char.properties, char.service_handle = uuid, description, handle, properties, service_handle
+            characteristics.append(char)
+        for uuid, description, handle, characteristic_handle in tree["descriptors"]:
+            desc = GattDescriptor(None)
+            desc.uuid, desc.description, desc.handle, desc.characteristic_handle = uuid, description, handle, characteristic_handle
+            descriptors.append(desc)
+        discovered = [c for c in characteristics if c.handle is not None]
+        signature = self.signature([s for s in services if s.handle], discovered)
+        probes = [tuple(p) for p in tree["probes"]]
+        return GattProfile(signature, services, characteristics, descriptors, probes)
+
+    def snapshot(self, db):
+        # saves the profiles changed since the last snapshot
+        with self._lock:
+            changed, self.changed = self.changed, set()
+            current = dict(self.profiles.items())
+            rows = []
+            for fingerprint in changed:
+                profile = current.get(fingerprint)
+                if profile is not None:
+                    rows.append({"fingerprint": json.dumps(fingerprint), "tree": json.dumps(self._tree(profile)),
+                                 "confirmations": profile.confirmations, "mismatches": profile.mismatches,
+                                 "updated": int(time.time())})
+        try:
+            db.save_gatt_profiles(rows)
+        except Exception as e:
+            log.warning(f"Could not save {len(rows)} GATT profiles: {e}")
+            with self._lock:
+                self.changed |= changed
+            return 0
+        return len(rows)
+
+    def restore(self, db):
+        restored = 0
+        for fingerprint, tree, confirmations, mismatches in db.load_gatt_profiles(self.profiles.max_size):
+            try:
+                profile = self._profile(json.loads(tree))
+            except (ValueError, KeyError, TypeError) as e:
+                log.debug(f"Skipping GATT profile {fingerprint}: {e}")
+                continue
+            profile.confirmations = confirmations
+            profile.mismatches = mismatches
+            self.profiles.put(tuple(json.loads(fingerprint)), profile)
+            restored += 1
+        return restored
@@ -1,5 +1,6 @@
-import numpy as np
-import pandas as pd
+from functools import lru_cache
+
+from lib.registry import registry
 
 # import requests
 # import re
@@ -20,11 +21,10 @@ def maclookupAPI(address):
 
 class IEEE:
     _instance = None
-    folder = "Assigned Numbers/IEEE"
-    # MAC Address Block sizes: large, medium, small
-    file_large = f"{folder}/oui.csv"
-    file_medium = f"{folder}/mam.csv"
-    file_small = f"{folder}/oui36.csv"
+    # MAC Address Block sizes (hex digits): small, medium, large
+    lens = [9, 7, 6]
+
+    cache_size = 4096
 
     def __new__(cls):
         if cls._instance is None:
@@ -33,25 +33,48 @@ class IEEE:
         return cls._instance
 
     def _initialize(self):
-        self.data = pd.concat([self.__load_csv(self.file_large),
-                               self.__load_csv(self.file_medium),
-                               self.__load_csv(self.file_small),
-                               ])
-        self.lens = sorted({len(a) for a in self.data['Assignment']}, reverse = True)
-
-    def __load_csv(self, file):
-        return pd.read_csv(file)
-
-    def search_address(self, address):
-        # search for address, return company name
-        address = address.replace(":", "").replace("-", "")
+        # one compiled registry table per prefix length (oui6, oui7, oui9),
+        # opened on the first lookup. Recently seen addresses are cached.
+        self.search_address = lru_cache(maxsize=self.cache_size)(self.__search_address)
+
+    @staticmethod
+    def normalize(address):
+        return address.replace(":", "").replace("-", "").upper()
+
+    def __search_address(self, address):
+        # longest prefix match, return company name
+        if not address:
+            return None
+        address = self.normalize(address)
+        reg = registry.get()
         for l in self.lens:
-            addr_part = address[0:l]
-            res = self.data[self.data['Assignment'] == addr_part]
-            if len(res) > 0:
-                return res['Organization Name'].iloc[0]
+            if len(address) < l:
+                continue
+            try:
+                prefix = int(address[0:l], 16)
+            except ValueError:
+                return None
+            res = reg.lookup(f"oui{l}", prefix)
+            if res is not None:
+                return res
+        return None
 
-    def search_company(self, company):
-        # search for company name
-        return self.data[self.data['Organization Name'].str.contains(company) == True]
+    def search_addresses(self, addresses):
+        # resolve a whole column of addresses, returns a list in the same order
+        resolved = {}
+        res = []
+        for address in addresses:
+            if address not in resolved:
+                resolved[address] = self.search_address(address)
+            res.append(resolved[address])
+        return res
 
+    def search_company(self, company):
+        # search for company name, returns [(assignment, organization)]
+        res = []
+        reg = registry.get()
+        for l in self.lens:
+            for assignment, organization in reg.items(f"oui{l}"):
+                if company in organization:
+                    res.append((f"{assignment:0{l}X}", organization))
+        return res
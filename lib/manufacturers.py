@@ -1,8 +1,10 @@
-import yaml
+from functools import lru_cache
+
+from lib.registry import registry
 
 class Manufacturer:
     _instance = None
-    yaml_file = "Assigned Numbers/company_identifiers.yaml"
+    cache_size = 65536
 
     def __new__(cls):
         if cls._instance is None:
@@ -11,25 +13,68 @@ class Manufacturer:
         return cls._instance
 
     def _initialize(self):
-        self.data = self.__load_yaml(self.yaml_file)
+        # indexes are built from the registry on the first lookup
+        self._by_value = None
+        self._by_name = None
+        # memoization of whole manufacturer strings like "76,6"
+        self._parse_str = lru_cache(maxsize=self.cache_size)(self.__parse_list)
+
+    def __build_index(self):
+        by_value = {}
+        by_name = {}
+        for value, name in registry.get().items("company"):
+            by_value[value] = name
+            by_name.setdefault(name, []).append(value)
+        self._by_name = by_name
+        self._by_value = by_value
+
+    @property
+    def by_value(self):
+        # id -> name
+        if self._by_value is None:
+            self.__build_index()
+        return self._by_value
 
-    def __load_yaml(self, yaml_file):
-        with open(yaml_file, 'r') as file:
-            return yaml.safe_load(file)
+    @property
+    def by_name(self):
+        # name -> [ids]
+        if self._by_name is None:
+            self.__build_index()
+        return self._by_name
 
     def find_by_value(self, value):
         if value:
-            for identifier in self.data['company_identifiers']:
-                if identifier['value'] == value:
-                    return identifier['name']
+            return self.by_value.get(value)
         return None
 
+    def find_by_name(self, name):
+        return self.by_name.get(name, [])
+
+    def __parse_list(self, data):
+        res = [self.find_by_value(int(l)) for l in data.split(",")]
+        return ", ".join([r for r in res if r])
+
     def parse(self, data):
         if data:
             if isinstance(data, str):
-                data = data.split(",")
+                return self._parse_str(data)
             res = [self.find_by_value(int(l)) for l in data]
             return ", ".join([r for r in res if r])
         else:
             return None
 
+    def parse_many(self, values):
+        # resolve a whole column of manufacturer strings, repeated strings are parsed once
+        resolved = {}
+        res = []
+        for data in values:
+            key = data if isinstance(data, str) or data is None else tuple(data)
+            if key not in resolved:
+                try:
+                    resolved[key] = self.parse(data)
+                except ValueError:
+                    # already parsed (older databases)
+                    resolved[key] = None
+            res.append(resolved[key])
+        return res
+
@@ -0,0 +1,69 @@
+import threading
+import time
+from contextlib import contextmanager
+
+class metrics:
+    # thread safe counters, gauges and timings for the long running components
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.timings = {}
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def observe(self, name, value):
+        with self._lock:
+            t = self.timings.get(name)
+            if t is None:
+                self.timings[name] = {"count": 1, "total": value, "max": value, "last": value}
+            else:
+                t["count"] += 1
+                t["total"] += value
+                t["last"] = value
+                if value > t["max"]:
+                    t["max"] = value
+
+    @contextmanager
+    def timer(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start)
+
+    def get(self, name, default=0):
+        with self._lock:
+            if name in self.counters:
+                return self.counters[name]
+            return self.gauges.get(name, default)
+
+    def snapshot(self):
+        with self._lock:
+            timings = {}
+            for name, t in self.timings.items():
+                timings[name] = dict(t, avg=t["total"] / t["count"])
+            return {
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "timings": timings,
+            }
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.timings.clear()
+
+    def __str__(self):
+        snap = self.snapshot()
+        parts = [f"{k}={v}" for k, v in snap["counters"].items()]
+        parts += [f"{k}={v}" for k, v in snap["gauges"].items()]
+        parts += [f"{k}(avg={t['avg']:.4f} max={t['max']:.4f} n={t['count']})" for k, t in snap["timings"].items()]
+        return " ".join(parts)
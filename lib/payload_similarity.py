@@ -0,0 +1,137 @@
+import numpy as np
+from functools import lru_cache
+
+# Bitwise similarity of advertised payloads (manufacturer_binary,
+# advertisingflags): a value is a comma separated list of hex payloads,
+# payloads are compared by position and byte by byte from their start, bytes
+# only one of them has count as different bits.
+
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+@lru_cache(maxsize=65536)
+def _parse_str(value):
+    payloads = []
+    for part in value.split(","):
+        part = part.strip()
+        if len(part) % 2:
+            part = "0" + part
+        try:
+            payloads.append(bytes.fromhex(part))
+        except ValueError:
+            return None
+    return tuple(payloads)
+
+def parse_payloads(value):
+    # "0215aabb,1005" -> (b"\x02\x15\xaa\xbb", b"\x10\x05"), None if it isn't hex
+    if value is None:
+        return None
+    if isinstance(value, (bytes, bytearray)):
+        return (bytes(value),)
+    return _parse_str(str(value))
+
+def payload_similarity(a, b):
+    # share of equal bits of two payloads
+    if a == b:
+        return 1.0
+    n = min(len(a), len(b))
+    diff = (int.from_bytes(a[:n], "big") ^ int.from_bytes(b[:n], "big")).bit_count()
+    diff += 8 * abs(len(a) - len(b))
+    return 1 - diff / (8 * max(len(a), len(b)))
+
+def payloads_similarity(value1, value2):
+    # mean payload similarity, payloads only one value has count as 0
+    p1 = parse_payloads(value1)
+    p2 = parse_payloads(value2)
+    if not p1 or not p2:
+        return 0
+    return sum(payload_similarity(a, b) for a, b in zip(p1, p2)) / max(len(p1), len(p2))
+
+class payload_matrix:
+    # The payloads of many values in one flat byte array, with the start and
+    # length of every (value, payload position). A comparison densifies a chunk
+    # of values at a time to a zero padded (values x payloads x bytes) array,
+    # only as many bytes as the shorter payloads of a pair have, and compares
+    # with XOR and a popcount table. Values which are empty or not hex have no
+    # payloads and a similarity of 0.
+    chunk_bytes = 1 << 20 # size of a densified chunk
+
+    def __init__(self, values):
+        parsed = [parse_payloads(v) if v else None for v in values]
+        self.valid = np.array([bool(p) for p in parsed], dtype=bool)
+        width = max([len(p) for p in parsed if p] or [1])
+
+        self.counts = np.array([len(p) if p else 0 for p in parsed], dtype=np.int64)
+        self.lengths = np.zeros((len(parsed), width), dtype=np.int64)
+        self.starts = np.zeros((len(parsed), width), dtype=np.int64)
+        chunks = []
+        offset = 0
+        for i, p in enumerate(parsed):
+            for j, x in enumerate(p or ()):
+                self.starts[i, j] = offset
+                self.lengths[i, j] = len(x)
+                offset += len(x)
+                chunks.append(x)
+        # one zero byte at the end pads the dense chunks
+        self.data = np.frombuffer(b"".join(chunks) + b"\0", dtype=np.uint8)
+        self.pad = offset
+        self.longest = self.lengths.max(axis=-1)
+        self.positions = np.arange(width)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def _dense(self, rows, size):
+        # the first size bytes of the payloads of rows, zero padded
+        offsets = np.arange(size)
+        index = np.where(offsets < self.lengths[rows][..., None], self.starts[rows][..., None] + offsets, self.pad)
+        return self.data[index]
+
+    def _step(self, size):
+        # values per chunk
+        return max(1, self.chunk_bytes // (len(self.positions) * max(size, 1)))
+
+    def _compare(self, data1, lengths1, counts1, data2, lengths2, counts2):
+        shorter = np.minimum(lengths1, lengths2)
+        longer = np.maximum(lengths1, lengths2)
+        same_part = np.arange(data1.shape[-1]) < shorter[..., None]
+        diff = (POPCOUNT[data1 ^ data2] * same_part).sum(axis=-1, dtype=np.int64)
+        diff += 8 * (longer - shorter)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            res = np.where(longer > 0, 1 - diff / (8 * longer), 1.0)
+        both = (self.positions < counts1[..., None]) & (self.positions < counts2[..., None])
+        res = np.where(both, res, 0).sum(axis=-1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.nan_to_num(res / np.maximum(counts1, counts2))
+
+    def similarity(self, i):
+        # value i against all values, no pair shares more bytes than value i has
+        res = np.zeros(len(self))
+        if not self.valid[i]:
+            return res
+        size = int(self.lengths[i].max())
+        query = self._dense(i, size)
+        step = self._step(size)
+        for start in range(0, len(self), step):
+            rows = slice(start, start + step)
+            # a long query only needs as many bytes as the chunk has
+            chunk_size = min(size, int(self.longest[rows].max()))
+            res[rows] = self._compare(self._dense(rows, chunk_size), self.lengths[rows], self.counts[rows],
+                                      query[:, :chunk_size], self.lengths[i], self.counts[i])
+        res[~self.valid] = 0
+        return res
+
+    def pair_similarity(self, a, b):
+        # values a[k] against b[k]
+        a = np.asarray(a)
+        b = np.asarray(b)
+        res = np.zeros(len(a))
+        shared = np.minimum(self.lengths[a], self.lengths[b]).max(axis=-1, initial=0)
+        step = self._step(int(shared.max(initial=0)))
+        for start in range(0, len(a), step):
+            chunk = slice(start, start + step)
+            rows_a, rows_b = a[chunk], b[chunk]
+            size = int(shared[chunk].max())
+            res[chunk] = self._compare(self._dense(rows_a, size), self.lengths[rows_a], self.counts[rows_a],
+                                       self._dense(rows_b, size), self.lengths[rows_b], self.counts[rows_b])
+        res[~(self.valid[a] & self.valid[b])] = 0
+        return res
@@ -0,0 +1,238 @@
+import bisect
+import csv
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+
+from lib.log import log
+
+# Compiled "Assigned Numbers" registries.
+#
+# Layout of registry.bin (little endian):
+#   header:    magic(8) version(u32) sections(u32) fingerprint(32)
+#   directory: per section name(16) kind(u8) offset(u64) length(u64)
+#   table:     n(u64) keys(n * u64) offsets((n + 1) * u32) strings(utf-8)
+#   json:      utf-8 json document
+# Sections start 8 byte aligned so the key arrays can be cast in place.
+
+TABLE = 1
+JSON = 2
+
+class registry:
+    VERSION = 1
+    MAGIC = b"BTREGIST"
+
+    folder = "Assigned Numbers"
+    cache_file = f"{folder}/registry.bin"
+    sources = [
+        "company_identifiers.yaml",
+        "class_of_device.yaml",
+        "member_uuids.yaml",
+        "mesh_model_uuids.yaml",
+        "IEEE/oui.csv",
+        "IEEE/mam.csv",
+        "IEEE/oui36.csv",
+    ]
+
+    _header = struct.Struct("<8sII32s")
+    _entry = struct.Struct("<16sBQQ")
+
+    _instance = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def get(cls):
+        # loaded on first use, rebuilt if the sources changed
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        return cls._instance
+
+    def __init__(self):
+        self.sections = {}
+        self.tables = {}
+        self.buffer = None
+        self._file = None
+
+        fingerprint = self.fingerprint()
+        if not self.__load(fingerprint):
+            data = self.build(fingerprint)
+            if not self.__load(fingerprint):
+                # cache folder not writable, use the compiled data from memory
+                self.__open(data)
+
+    @classmethod
+    def fingerprint(cls):
+        h = hashlib.sha256(f"{cls.VERSION}".encode())
+        for source in cls.sources:
+            st = os.stat(f"{cls.folder}/{source}")
+            h.update(f"{source}:{st.st_size}:{st.st_mtime_ns}".encode())
+        return h.digest()
+
+    def __load(self, fingerprint):
+        try:
+            with open(self.cache_file, "rb") as f:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return False
+
+        try:
+            magic, version, _, stored = self._header.unpack_from(buffer, 0)
+            if magic != self.MAGIC or version != self.VERSION or stored != fingerprint:
+                buffer.close()
+                return False
+            self.__open(buffer)
+        except (struct.error, ValueError) as e:
+            # truncated or damaged, it is rebuilt
+            log.warning(f"Invalid {self.cache_file}: {e}")
+            buffer.close()
+            return False
+
+        self._file = buffer
+        return True
+
+    def __open(self, buffer):
+        # reads and checks the directory, raises struct.error or ValueError if the buffer is too short
+        size = len(buffer)
+        _, _, count, _ = self._header.unpack_from(buffer, 0)
+        pos = self._header.size
+        if pos + count * self._entry.size > size:
+            raise ValueError(f"directory of {count} sections exceeds {size} bytes")
+        sections = {}
+        for _ in range(count):
+            name, kind, offset, length = self._entry.unpack_from(buffer, pos)
+            pos += self._entry.size
+            name = name.rstrip(b"\0").decode()
+            if offset + length > size:
+                raise ValueError(f"section {name} exceeds {size} bytes")
+            if kind == TABLE:
+                n, = struct.unpack_from("<Q", buffer, offset)
+                strings = 8 + 12 * n + 4
+                if strings > length or struct.unpack_from("<I", buffer, offset + strings - 4)[0] > length - strings:
+                    raise ValueError(f"table {name} exceeds its section")
+            sections[name] = (kind, offset, length)
+        self.sections = sections
+        self.tables = {}
+        self.buffer = memoryview(buffer)
+
+    def __table(self, section):
+        table = self.tables.get(section)
+        if table is None:
+            kind, offset, _ = self.sections[section]
+            n, = struct.unpack_from("<Q", self.buffer, offset)
+            keys_start = offset + 8
+            offsets_start = keys_start + 8 * n
+            strings_start = offsets_start + 4 * (n + 1)
+            table = (
+                self.buffer[keys_start:offsets_start].cast("Q"),
+                self.buffer[offsets_start:strings_start].cast("I"),
+                strings_start,
+            )
+            self.tables[section] = table
+        return table
+
+    def lookup(self, section, key):
+        keys, offsets, strings = self.__table(section)
+        i = bisect.bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            return bytes(self.buffer[strings + offsets[i]:strings + offsets[i + 1]]).decode()
+        return None
+
+    def items(self, section):
+        keys, offsets, strings = self.__table(section)
+        blob = bytes(self.buffer[strings:strings + offsets[len(keys)]])
+        for i, key in enumerate(keys):
+            yield key, blob[offsets[i]:offsets[i + 1]].decode()
+
+    def json(self, section):
+        _, offset, length = self.sections[section]
+        return json.loads(bytes(self.buffer[offset:offset + length]))
+
+    # build step
+
+    @classmethod
+    def __load_yaml(cls, file):
+        import yaml # only needed to compile the registries
+        with open(f"{cls.folder}/{file}", 'r') as f:
+            return yaml.safe_load(f)
+
+    @classmethod
+    def __load_oui(cls):
+        tables = {}
+        for source in ["IEEE/oui.csv", "IEEE/mam.csv", "IEEE/oui36.csv"]:
+            with open(f"{cls.folder}/{source}", newline='') as f:
+                for row in csv.DictReader(f):
+                    assignment = row['Assignment'].upper()
+                    table = tables.setdefault(f"oui{len(assignment)}", {})
+                    table.setdefault(int(assignment, 16), row['Organization Name'])
+        return tables
+
+    @staticmethod
+    def __pack_table(table):
+        keys = sorted(table)
+        strings = [table[k].encode() for k in keys]
+        offsets = [0]
+        for s in strings:
+            offsets.append(offsets[-1] + len(s))
+        return b"".join([
+            struct.pack("<Q", len(keys)),
+            struct.pack(f"<{len(keys)}Q", *keys),
+            struct.pack(f"<{len(offsets)}I", *offsets),
+            *strings,
+        ])
+
+    @classmethod
+    def compile(cls):
+        companies = cls.__load_yaml("company_identifiers.yaml")['company_identifiers']
+        members = cls.__load_yaml("member_uuids.yaml")['uuids']
+        mesh_models = cls.__load_yaml("mesh_model_uuids.yaml")['mesh_model_uuids']
+
+        sections = {
+            "company": (TABLE, {c['value']: c['name'] for c in reversed(companies)}),
+            "member_uuids": (TABLE, {u['uuid']: u['name'] for u in reversed(members)}),
+            "mesh_models": (TABLE, {m['uuid']: m['name'] for m in reversed(mesh_models)}),
+            "class_of_device": (JSON, cls.__load_yaml("class_of_device.yaml")),
+        }
+        for name, table in cls.__load_oui().items():
+            sections[name] = (TABLE, table)
+        return sections
+
+    @classmethod
+    def build(cls, fingerprint=None):
+        if fingerprint is None:
+            fingerprint = cls.fingerprint()
+
+        blobs = []
+        for name, (kind, data) in cls.compile().items():
+            if kind == TABLE:
+                blob = cls.__pack_table(data)
+            else:
+                blob = json.dumps(data).encode()
+            blobs.append((name, kind, blob))
+
+        pos = cls._header.size + cls._entry.size * len(blobs)
+        directory = []
+        body = []
+        for name, kind, blob in blobs:
+            padding = -pos % 8
+            body.append(b"\0" * padding)
+            pos += padding
+            directory.append(cls._entry.pack(name.encode(), kind, pos, len(blob)))
+            body.append(blob)
+            pos += len(blob)
+
+        data = b"".join([cls._header.pack(cls.MAGIC, cls.VERSION, len(blobs), fingerprint), *directory, *body])
+
+        tmp = f"{cls.cache_file}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, cls.cache_file)
+            log.info(f"compiled {len(blobs)} registries into {cls.cache_file} ({len(data)} bytes)")
+        except OSError as e:
+            log.warning(f"Could not write {cls.cache_file}: {e}")
+        return data
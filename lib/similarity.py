@@ -1,4 +1,5 @@
-from difflib import SequenceMatcher
+from lib.text_similarity import TextSimilarity
+from lib.payload_similarity import payloads_similarity
 
 DEBUG = False
 class similarity:
@@ -42,9 +43,10 @@ class similarity:
         text1 = str(text1)
         text2 = str(text2)
 
+        res = TextSimilarity().ratio(text1, text2)
         if DEBUG:
-            print(f"text: '{text1}' : {text2} -> {SequenceMatcher(None, text1, text2).ratio()}")
-        return SequenceMatcher(None, text1, text2).ratio()
+            print(f"text: '{text1}' : {text2} -> {res}")
+        return res
 
     @staticmethod
     def list(list1, list2):
@@ -67,28 +69,33 @@ class similarity:
 
     @staticmethod
     def hex(hex1, hex2):
+        # comma separated hex payloads, compared bitwise per payload
         if not hex1 or not hex2:
             return 0
 
-        bin1 = bin(int(hex1, 16))[2:]
-        bin2 = bin(int(hex2, 16))[2:]
-        return similarity.binary(bin1, bin2)
+        res = payloads_similarity(hex1, hex2)
+        if DEBUG:
+            print(f"hex: {hex1} : {hex2} -> {res}")
+        return res
 
     @staticmethod
     def binary(binary1, binary2):
-        # This will compare strings like "001001"
+        # This will compare strings like "001001", bytes are compared as payloads
         if not binary1 or not binary2:
             return 0
 
+        if isinstance(binary1, (bytes, bytearray)) or isinstance(binary2, (bytes, bytearray)):
+            return payloads_similarity(binary1, binary2)
+
         # match binary length
         total_bits = max(len(binary1), len(binary2))
-        binary1 = binary1.rjust(total_bits, '0')
-        binary2 = binary2.rjust(total_bits, '0')
-
-        matching_bits = 0
-        for b1, b2 in zip(binary1, binary2):
-            if b1 == b2:
-                matching_bits += 1
+        try:
+            matching_bits = total_bits - (int(binary1, 2) ^ int(binary2, 2)).bit_count()
+        except ValueError:
+            # not a bit string, compare the characters
+            binary1 = binary1.rjust(total_bits, '0')
+            binary2 = binary2.rjust(total_bits, '0')
+            matching_bits = sum(1 for b1, b2 in zip(binary1, binary2) if b1 == b2)
 
         if DEBUG:
             print(f"binary: {binary1} : {binary2} -> {matching_bits / total_bits}")
@@ -199,3 +206,13 @@ class similarity:
         sim_val = calc_res(res, max(len(services1), len(services2)))
         return sim_val
 
+# relative cost of one comparison, used to order attributes cheap first
+checker_costs = {
+    similarity.exact: 1,
+    similarity.numeric: 1,
+    similarity.hex: 3,
+    similarity.uuids: 3,
+    similarity.list: 3,
+    similarity.text: 5,
+    similarity.gatt_services: 50,
+}
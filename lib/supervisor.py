@@ -0,0 +1,154 @@
+import signal
+import threading
+import time
+
+from lib.metrics import metrics
+from lib.log import log
+
+class component:
+    # one supervised part of the scanner, alive() tells if its thread still runs
+    def __init__(self, name, start, stop, alive, stats=None, restart=True):
+        self.name = name
+        self.start = start
+        self.stop = stop
+        self.alive = alive
+        self.stats = stats
+        self.restart = restart
+
+        self.running = False
+        self.restarts = 0
+        self.failures = 0 # consecutive, reset once it ran stable_time
+        self.started = None
+        self.next_restart = None
+
+class supervisor:
+    # Keeps the main thread blocked on an Event (woken by SIGINT/SIGTERM),
+    # checks the components every check_interval seconds, restarts dead ones
+    # with exponential backoff and logs a summary every summary_interval.
+    # Components start in the order they were added and stop in reverse,
+    # so the sources are stopped before the database writer is drained.
+    def __init__(self, check_interval=5, summary_interval=300, base_delay=1, max_delay=300,
+                 stable_time=600, shutdown_timeout=30):
+        self.check_interval = check_interval
+        self.summary_interval = summary_interval
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.stable_time = stable_time
+        self.shutdown_timeout = shutdown_timeout
+
+        self.components = []
+        self.stopping = threading.Event()
+        self.stats = metrics()
+        self._last_counts = {}
+        self._last_summary = None
+
+    def add(self, name, start, stop, alive, stats=None, restart=True):
+        c = component(name, start, stop, alive, stats, restart)
+        self.components.append(c)
+        return c
+
+    def _handle_signal(self, signum, frame):
+        log.debug(f"\nReceived signal {signal.Signals(signum).name}, stopping.")
+        self.stopping.set()
+
+    def _start(self, c):
+        c.start()
+        c.running = True
+        c.started = time.monotonic()
+
+    def start(self):
+        for c in self.components:
+            self._start(c)
+
+    def check(self):
+        now = time.monotonic()
+        for c in self.components:
+            if c.next_restart is not None:
+                if now >= c.next_restart:
+                    self._restart(c)
+                continue
+
+            if c.alive():
+                if c.failures and now - c.started >= self.stable_time:
+                    c.failures = 0
+                continue
+
+            log.warning(f"Component {c.name} died")
+            self.stats.incr(f"{c.name}_died")
+            c.running = False
+            if c.restart:
+                c.failures += 1
+                delay = min(self.base_delay * 2 ** (c.failures - 1), self.max_delay)
+                c.next_restart = now + delay
+                log.info(f"Restarting {c.name} in {delay}s")
+
+    def _restart(self, c):
+        c.next_restart = None
+        try:
+            try:
+                c.stop()
+            except Exception as e:
+                log.debug(f"Error stopping {c.name}: {e}")
+            self._start(c)
+            c.restarts += 1
+            self.stats.incr(f"{c.name}_restarts")
+            log.info(f"Restarted {c.name}")
+        except Exception as e:
+            log.error(f"Restarting {c.name} failed: {e}")
+            c.failures += 1
+            c.next_restart = time.monotonic() + min(self.base_delay * 2 ** (c.failures - 1), self.max_delay)
+
+    def summary(self):
+        now = time.monotonic()
+        elapsed = now - self._last_summary if self._last_summary else None
+        self._last_summary = now
+
+        lines = []
+        for c in self.components:
+            state = "running" if c.alive() else ("restarting" if c.next_restart else "dead")
+            line = f"{c.name}: {state}, {c.restarts} restarts"
+            if c.stats is not None:
+                snapshot = c.stats.snapshot()
+                rates = []
+                for key, value in snapshot["counters"].items():
+                    last = self._last_counts.get((c.name, key))
+                    self._last_counts[(c.name, key)] = value
+                    if elapsed and last is not None:
+                        rates.append(f"{key} {(value - last) / elapsed:.1f}/s")
+                line += f" | {c.stats}"
+                if rates:
+                    line += f" | {', '.join(rates)}"
+            lines.append(line)
+        log.info("Scanner health:\n  " + "\n  ".join(lines))
+
+    def run(self):
+        # blocks until SIGINT / SIGTERM or stop()
+        signal.signal(signal.SIGINT, self._handle_signal)
+        signal.signal(signal.SIGTERM, self._handle_signal)
+
+        self.start()
+        self.summary()
+        while not self.stopping.wait(self.check_interval):
+            self.check()
+            if time.monotonic() - self._last_summary >= self.summary_interval:
+                self.summary()
+        self.shutdown()
+
+    def stop(self):
+        self.stopping.set()
+
+    def shutdown(self):
+        # every component gets what is left of shutdown_timeout
+        deadline = time.monotonic() + self.shutdown_timeout
+        for c in reversed(self.components):
+            if not c.running:
+                continue
+            remaining = max(0.0, deadline - time.monotonic())
+            try:
+                res = c.stop(remaining)
+                if res is False:
+                    log.warning(f"{c.name} did not finish within the shutdown deadline")
+            except Exception as e:
+                log.error(f"Error stopping {c.name}: {e}")
+            c.running = False
+        self.summary()
@@ -0,0 +1,113 @@
+import sys
+import numpy as np
+from difflib import SequenceMatcher
+from functools import lru_cache
+
+from lib.metrics import metrics
+
+# Similarity of names, aliases, ... as SequenceMatcher ratio. Compared pairs
+# are memoized (the ratio is not symmetric, the pair order is kept) and the
+# trigram index finds the strings similar to a query without comparing it
+# to every string.
+
+def ratio(text1, text2):
+    return SequenceMatcher(None, text1, text2).ratio()
+
+def trigrams(text):
+    # padded like pg_trgm, so short strings and word starts get trigrams too
+    text = f"  {text.lower()} "
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+class TextSimilarity:
+    _instance = None
+    cache_size = 65536 # pairs, a pair of two long names keeps both strings alive
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._initialize()
+        return cls._instance
+
+    def _initialize(self):
+        self._ratio = lru_cache(maxsize=self.cache_size)(ratio)
+
+    def ratio(self, text1, text2):
+        return self._ratio(text1, text2)
+
+    def cache_info(self):
+        return self._ratio.cache_info()
+
+    def cache_clear(self):
+        self._ratio.cache_clear()
+
+class trigram_index:
+    # Unique, interned strings with their trigram postings. search() counts
+    # the shared trigrams of every string in one bincount, drops strings
+    # which can't reach the threshold by length (ratio <= 2 * min / sum of
+    # the lengths) or character counts (quick_ratio) and only computes the
+    # ratio for the rest. Strings without min_shared common trigrams are not
+    # found, with min_shared=0 only the exact filters are used.
+    def __init__(self, texts=()):
+        self.ids = {} # text -> id
+        self.texts = [] # id -> text
+        self.lengths = []
+        self.postings = {} # trigram -> [ids]
+        self._arrays = {} # trigram -> np.array of the postings, built by search
+        self._lengths = None
+        self.stats = metrics()
+        for text in texts:
+            self.add(text)
+
+    def __len__(self):
+        return len(self.texts)
+
+    def add(self, text):
+        text = str(text)
+        i = self.ids.get(text)
+        if i is None:
+            text = sys.intern(text)
+            i = self.ids[text] = len(self.texts)
+            self.texts.append(text)
+            self.lengths.append(len(text))
+            for gram in trigrams(text):
+                self.postings.setdefault(gram, []).append(i)
+                self._arrays.pop(gram, None)
+            self._lengths = None
+        return i
+
+    def _postings(self, gram):
+        arr = self._arrays.get(gram)
+        if arr is None:
+            arr = self._arrays[gram] = np.array(self.postings[gram], dtype=np.int32)
+        return arr
+
+    def search(self, query, threshold=0.6, limit=None, min_shared=1):
+        # -> [(text, ratio(query, text))] with a ratio >= threshold, best first
+        query = str(query)
+        lists = [self._postings(g) for g in trigrams(query) if g in self.postings]
+        self.stats.incr("searches")
+        if not lists and min_shared > 0:
+            return []
+        if self._lengths is None:
+            self._lengths = np.array(self.lengths, dtype=np.float64)
+
+        shared = np.bincount(np.concatenate(lists) if lists else np.zeros(0, dtype=np.int32), minlength=len(self.texts))
+        candidates = np.flatnonzero(shared >= min_shared)
+        lengths = self._lengths[candidates]
+        candidates = candidates[2 * np.minimum(lengths, len(query)) >= threshold * (lengths + len(query))]
+        # most shared trigrams first, the likely matches are compared first
+        candidates = candidates[np.argsort(-shared[candidates], kind="stable")]
+        self.stats.incr("candidates", len(candidates))
+
+        memo = TextSimilarity()
+        res = []
+        for i in candidates.tolist():
+            text = self.texts[i]
+            if SequenceMatcher(None, query, text).quick_ratio() < threshold:
+                continue
+            self.stats.incr("compared")
+            score = memo.ratio(query, text)
+            if score >= threshold:
+                res.append((text, score))
+        res.sort(key=lambda x: x[1], reverse=True)
+        return res[:limit] if limit else res
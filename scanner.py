@@ -1,37 +1,51 @@
+import sys
+
 from lib.db import BluetoothDatabase
+from lib.db_writer import db_writer
 from lib.bt_scanner import bt_scanner
 from lib.ble_scanner import ble_scanner
+from lib.ble_coalescer import ble_coalescer
+from lib.ble_replay import advert_recorder
 from lib.ble_device import ble_device
 from lib.ble_gatt import ble_gatt
-from lib.log import log
+from lib.supervisor import supervisor
 
-def ble_callback(device, _):
-    dev = ble_device(device)
+def ble_callback(record):
+    dev = ble_device(record)
     gatt.add_possible_device(dev)
 
-    db.insert_ble_device(dev)
+    writer.insert_ble_device(dev)
 
 def gatt_callback(device, services, characteristics, descriptors):
-    db.insert_ble_services(device, services, characteristics, descriptors)
+    writer.insert_ble_services(device, services, characteristics, descriptors)
 
 if __name__ == "__main__":
     db_path = "db.db"
     db = BluetoothDatabase(db_path)
-    bt_scanr = bt_scanner(db)
-    ble_scanr = ble_scanner(ble_callback)
-    gatt = ble_gatt(gatt_callback)
-
-    # Start scanning
-    ble_scanr.scan()
-    bt_scanr.scan()
+    writer = db_writer(db)
+    bt_scanr = bt_scanner(writer)
+    coalescer = ble_coalescer(ble_callback)
+    # --record <file>: keep the raw advert stream for replays / benchmarks
+    recorder = None
+    if "--record" in sys.argv:
+        recorder = advert_recorder(sys.argv[sys.argv.index("--record") + 1], callback=coalescer)
+    # --adapters hci0,hci1: one scanner per adapter, merged by the coalescer
+    adapters = None
+    if "--adapters" in sys.argv:
+        adapters = sys.argv[sys.argv.index("--adapters") + 1].split(",")
+    ble_scanr = ble_scanner(recorder or coalescer, adapters=adapters)
+    gatt = ble_gatt(gatt_callback, state_file="gatt_state.json", db=db)
 
-    try:
-        while True:
-            pass
-    except KeyboardInterrupt:
-        # Handle Ctrl+C
-        log.debug("\nScanning interrupted by user.")
-        ble_scanr.stop()
-        bt_scanr.stop()
-        gatt.stop()
+    sup = supervisor()
+    # started in this order, stopped in reverse: the writer is drained last
+    sup.add("writer", writer.start, lambda timeout=None: writer.stop(timeout=timeout), writer.is_alive, writer.stats)
+    sup.add("gatt", gatt.start, lambda timeout=None: gatt.stop(), gatt.is_alive, gatt.stats)
+    sup.add("coalescer", coalescer.start, lambda timeout=None: coalescer.stop(), coalescer.is_alive, coalescer.stats)
+    sup.add("ble_scanner", ble_scanr.scan, lambda timeout=None: ble_scanr.stop(), ble_scanr.is_alive, ble_scanr.stats)
+    sup.add("bt_scanner", bt_scanr.scan, lambda timeout=None: bt_scanr.stop(), bt_scanr.is_alive, bt_scanr.stats)
 
+    # blocks until Ctrl+C / SIGTERM
+    sup.run()
+    if recorder:
+        recorder.close()
+    db.close()
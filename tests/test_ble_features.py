@@ -0,0 +1,88 @@
+import random
+
+import pytest
+
+from lib.db import BluetoothDatabase
+from lib.ble_device import ble_device
+from lib.similarity import similarity
+from ble_stats import ble_stats
+
+def is_none_val(val):
+    return not val or (isinstance(val, (list, set, dict)) and len(val) <= 0)
+
+def reference_similarity(attributes, original_attributes, device):
+    # the attribute by attribute loop ble_features replaces
+    score = 0
+    total = 0
+    for attr, weight, checker in attributes:
+        if attr in original_attributes and getattr(device, attr, None) is not None:
+            value1 = original_attributes[attr]
+            value2 = device[attr]
+            if is_none_val(value1) and is_none_val(value2):
+                continue
+            if not (is_none_val(value1) or is_none_val(value2)):
+                score += weight * similarity.calculate_similarity(value1, value2, checker)
+            total += weight
+    return score / total if total > 0 else 0
+
+def address(r):
+    return ":".join(f"{r.randrange(256):02X}" for _ in range(6))
+
+@pytest.fixture(scope="module")
+def stats(tmp_path_factory):
+    r = random.Random(3)
+    addresses = [address(r) for _ in range(300)]
+    rows = []
+    for _ in range(1000):
+        a = r.choice(addresses)
+        name = r.choice([None, None, f"Dev {r.randrange(30)}", "Galaxy Buds"])
+        rows.append(dict(name=name, name2=name, address=a, address2=a, addresstype=r.choice(["random", "public"]),
+                         alias=name or a.replace(":", "-"), appearance=r.choice([None, "960", "961"]),
+                         legacypairing=r.choice([0, 1, None]), uuids=r.choice([None, "a,b", "a", "b,c,d"]),
+                         manufacturers=r.choice([None, "76", "6", "117"]),
+                         manufacturer_binary=r.choice([None, "0215aabb", "1005", "0215aabb,1005", "0f%04x" % r.randrange(65536)]),
+                         servicedata=r.choice([None, "{'x': '01'}", "{'x': '02'}"]), advertisingflags=r.choice([None, "06", "1a"]),
+                         modalias=r.choice([None, "usb:v1", "usb:v2"]), icon=r.choice([None, "phone", "computer"])))
+    db = BluetoothDatabase(str(tmp_path_factory.mktemp("db") / "test.db"))
+    columns = list(rows[0])
+    db.db.execute_silent(f"INSERT INTO ble_device ({', '.join(columns)}) VALUES ({', '.join(':' + c for c in columns)})", rows)
+    yield ble_stats(db.db)
+    db.close()
+
+def test_scores_match_the_reference(stats):
+    features = stats.get_features()
+    devices = [ble_device.from_row(row, parse=False) for row in stats.db.execute("SELECT * FROM ble_device")]
+    ble_device.update_manufacturers(devices)
+    for device_id in (1, 250, 777):
+        query = devices[device_id - 1]
+        original = {attr: query[attr] for attr, _, _ in stats.attributes if query[attr] is not None}
+        expected = {d.id: reference_similarity(stats.attributes, original, d) for d in devices}
+        got = dict(features.top([features.row(device_id)], k=None))
+        assert {i for i, v in expected.items() if v > 0} <= set(got)
+        assert max(abs(expected[i] - v) for i, v in got.items()) < 1e-9
+
+def test_top_k_matches_full_scan(stats):
+    features = stats.get_features()
+    for device_id in (1, 17, 500, 999):
+        row = features.row(device_id)
+        full = features.top([row], k=None)
+        for k in (1, 5, 20):
+            top = features.top([row], k=k)
+            assert [round(s, 9) for _, s in top] == [round(s, 9) for _, s in full[:k]]
+
+def test_threshold_matches_full_scan(stats):
+    features = stats.get_features()
+    row = features.row(42)
+    full = features.top([row], k=None)
+    for threshold in (0.3, 0.8):
+        res = features.top([row], k=None, threshold=threshold)
+        assert sorted(i for i, _ in res) == sorted(i for i, s in full if s >= threshold)
+
+def test_cascade_prunes_between_the_stages(stats):
+    # not only the exact address match up front and GATT at the end
+    features = stats.get_features(reload=True)
+    stages = [c.name for c in features.cascade()]
+    stats.find_similar_devices(7, top_k=5)
+    counters = stats.evaluation_stats()
+    assert sum(counters.get(f"pruned_{name}", 0) for name in stages[1:]) > 0
+    assert counters[f"evaluated_{stages[-1]}"] < counters[f"evaluated_{stages[1]}"]
@@ -0,0 +1,108 @@
+from pathlib import Path
+
+from lib.bt_device import bt_device
+from lib.bt_inquiry import (parse_hcidump, parse_event, parse_hcitool_info, parse_hcitool_inq, parse_hcitool_scan,
+                            eir_info)
+from lib.db import content_hash
+
+fixtures = Path(__file__).parent / "fixtures"
+
+def fixture(name):
+    return (fixtures / name).read_text()
+
+def legacy_hcitool_info(output):
+    # parsing of get_hci_info before the parsers moved to lib/bt_inquiry.py
+    fields = dict.fromkeys(["device_class", "manufacturer", "version", "hci_version", "lmp_version", "device_type", "device_id"])
+    extra_info = ""
+    for line in output.splitlines():
+        if "Class" in line:
+            fields["device_class"] = line.split("Class: ")[-1].strip()
+        elif "Manufacturer" in line:
+            fields["manufacturer"] = line.split("Manufacturer: ")[-1].strip()
+        elif "Version" in line:
+            fields["version"] = line.split("Version: ")[-1].strip()
+        elif "Device Type" in line:
+            fields["device_type"] = line.split("Device Type: ")[-1].strip()
+        elif "Device ID" in line:
+            fields["device_id"] = line.split("Device ID: ")[-1].strip()
+        else:
+            extra_info = f"{extra_info}\n{line}"
+    fields["extra_hci_info"] = extra_info
+    return fields
+
+def inquiry_results():
+    results = []
+    for direction, packet in parse_hcidump(fixture("hcidump_inquiry.txt")):
+        if direction != ">":
+            continue
+        parsed = parse_event(packet)
+        if parsed is None:
+            return results, True
+        results.extend(parsed)
+    return results, False
+
+def test_hcidump_packets():
+    packets = parse_hcidump(fixture("hcidump_inquiry.txt"))
+    assert [d for d, _ in packets] == ["<", ">", ">", ">", ">", ">", ">"]
+    # the extended inquiry result continues over several lines
+    assert len(packets[4][1]) == 3 + 255
+
+def test_inquiry_events():
+    results, complete = inquiry_results()
+    assert complete
+    assert [r["address"] for r in results] == ["00:1A:7D:DA:71:13", "F4:F5:D8:12:34:56", "F4:F5:D8:12:34:56"]
+
+    standard, with_rssi, extended = results
+    assert standard["class_of_device"] == "0x240404"
+    assert standard["rssi"] is None and standard["eir"] is None
+    assert with_rssi["class_of_device"] == "0x5a020c"
+    assert with_rssi["rssi"] == -67
+    assert extended["rssi"] == -61
+    assert extended["eir"] == {
+        "name": "Pixel 7",
+        "uuids": ["0000110a-0000-1000-8000-00805f9b34fb", "0000110b-0000-1000-8000-00805f9b34fb"],
+        "tx_power": -4,
+        "device_id": "0002:18d1:4ee7:0100",
+        "manufacturer_data": {0xE0: b"\x01\x02"},
+    }
+
+def test_unrelated_events():
+    assert parse_event(bytes.fromhex("04 0E 04 01 05 0C 00")) == []
+    assert parse_event(bytes.fromhex("02 0E 04")) == []
+    assert parse_event(b"\x04") == []
+
+def test_eir_info():
+    results, _ = inquiry_results()
+    info = eir_info(results[2])
+    assert info["name"] == "Pixel 7"
+    assert info["device_class"] == "0x5a020c"
+    assert info["rssi"] == -61
+    assert info["manufacturer"] == "224"
+
+def test_hcitool_info():
+    info = parse_hcitool_info(fixture("hcitool_info.txt"))
+    assert info["manufacturer"] == "Cambridge Silicon Radio (10)"
+    assert info["version"] == "4.2 (0x8) LMP Subversion: 0x220e"
+    assert info["lmp_version"] is None
+    assert "Device Name: JBL Flip 4" in info["extra_hci_info"]
+
+def test_hcitool_info_keeps_the_content_hash():
+    output = fixture("hcitool_info.txt")
+    address = "00:1A:7D:DA:71:13"
+    fields = bt_device.attributes[2:]
+    new = bt_device([None, address, "JBL Flip 4"] + [parse_hcitool_info(output)[f] for f in fields])
+    old = bt_device([None, address, "JBL Flip 4"] + [legacy_hcitool_info(output)[f] for f in fields])
+    assert content_hash("bluetooth_device", new.to_dict()) == content_hash("bluetooth_device", old.to_dict())
+
+def test_hcitool_inq():
+    assert parse_hcitool_inq(fixture("hcitool_inq.txt")) == [
+        {"address": "00:1A:7D:DA:71:13", "class_of_device": "0x240404", "clock_offset": "0x4a3c"},
+        {"address": "F4:F5:D8:12:34:56", "class_of_device": "0x5a020c", "clock_offset": "0x1b2f"},
+    ]
+
+def test_hcitool_scan():
+    assert parse_hcitool_scan(fixture("hcitool_scan.txt")) == [
+        ("00:1A:7D:DA:71:13", "JBL Flip 4"),
+        ("F4:F5:D8:12:34:56", "Pixel 7"),
+        ("AA:BB:CC:DD:EE:FF", None),
+    ]
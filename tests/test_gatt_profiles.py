@@ -0,0 +1,97 @@
+import asyncio
+from types import SimpleNamespace
+
+import lib.ble_gatt
+from lib.ble_gatt import ble_gatt
+from lib.db import BluetoothDatabase
+from lib.gatt_profiles import gatt_profiles
+
+battery = "0000180f-0000-1000-8000-00805f9b34fb"
+battery_level = "00002a19-0000-1000-8000-00805f9b34fb"
+vendor = "0000fe9f-0000-1000-8000-00805f9b34fb"
+vendor_control = "0000fe01-0000-1000-8000-00805f9b34fb"
+vendor_status = "0000fe02-0000-1000-8000-00805f9b34fb"
+
+def tree(status_uuid=vendor_status):
+    services = {1: SimpleNamespace(uuid=battery, description="Battery Service", handle=1),
+                10: SimpleNamespace(uuid=vendor, description="Vendor", handle=10)}
+    characteristics = {
+        2: SimpleNamespace(uuid=battery_level, description="Battery Level", handle=2, properties=["read", "notify"], service_handle=1),
+        11: SimpleNamespace(uuid=vendor_control, description="Control", handle=11, properties=["write"], service_handle=10),
+        13: SimpleNamespace(uuid=status_uuid, description="Status", handle=13, properties=["read"], service_handle=10),
+    }
+    descriptors = {3: SimpleNamespace(uuid="00002902-0000-1000-8000-00805f9b34fb", description="CCCD", handle=3, characteristic_handle=2)}
+    return services, characteristics, descriptors
+
+class fake_client:
+    # BleakClient stand-in, every address exposes trees[address]
+    trees = {}
+    created = []
+
+    def __init__(self, address, services=None):
+        self.address = address
+        self.filter = services
+        self.is_connected = False
+        services, characteristics, descriptors = self.trees[address]
+        self.services = SimpleNamespace(services=services, characteristics=characteristics, descriptors=descriptors,
+                                        get_characteristic=characteristics.get)
+        self.created.append(self)
+
+    async def connect(self):
+        self.is_connected = True
+
+    async def disconnect(self):
+        self.is_connected = False
+
+    async def read_gatt_char(self, key):
+        return b"\x64"
+
+    async def read_gatt_descriptor(self, handle):
+        return b"\x00\x00"
+
+def device(address):
+    return SimpleNamespace(address=address, name="Tracker 1234", manufacturers="76", manufacturer_binary="1219aabbcc",
+                           uuids=vendor, rssi=-60, advertisingflags="06")
+
+def interrogate(gatt, address):
+    asyncio.run_coroutine_threadsafe(gatt._process(device(address)), gatt.loop).result(timeout=10)
+
+def test_profiles_are_verified_by_handle_and_saved(tmp_path, monkeypatch):
+    monkeypatch.setattr(lib.ble_gatt, "BleakClient", fake_client)
+    fake_client.trees = {"AA:00:00:00:00:01": tree(), "AA:00:00:00:00:02": tree(),
+                         "AA:00:00:00:00:03": tree(status_uuid="0000fe03-0000-1000-8000-00805f9b34fb")}
+    fake_client.created = []
+    db = BluetoothDatabase(str(tmp_path / "gatt.db"))
+    emitted = []
+    gatt = ble_gatt(lambda device, services, characteristics, descriptors: emitted.append((device.address, characteristics)),
+                    profiles=gatt_profiles(min_confirmations=1), db=db)
+    try:
+        # learned from a full interrogation
+        interrogate(gatt, "AA:00:00:00:00:01")
+        assert fake_client.created[-1].filter is None
+        assert gatt.profiles.stats.get("learned") == 1
+
+        # same model: only the services of the probes are discovered
+        interrogate(gatt, "AA:00:00:00:00:02")
+        client = fake_client.created[-1]
+        assert client.filter == sorted([battery, vendor, gatt_profiles.generic_access])
+        assert gatt.profiles.stats.get("verified") == 1
+        assert gatt.stats.get("profile_hits") == 1
+        assert any(c.uuid == vendor_status for address, chars in emitted if address == "AA:00:00:00:00:02" for c in chars)
+
+        # another characteristic at a probe handle: full interrogation
+        interrogate(gatt, "AA:00:00:00:00:03")
+        assert gatt.profiles.stats.get("verify_failed") == 1
+        assert fake_client.created[-1].filter is None
+    finally:
+        gatt.stop()
+
+    restored = gatt_profiles(min_confirmations=1)
+    assert restored.restore(db) == 1
+    fingerprint = gatt.profiles.fingerprint(device("AA:00:00:00:00:04"))
+    # replaced by the tree of the third device
+    saved, loaded = gatt.profiles.profiles.get(fingerprint), restored.profiles.get(fingerprint)
+    assert loaded.signature == saved.signature
+    assert loaded.probes == saved.probes == [(2, battery_level), (13, "0000fe03-0000-1000-8000-00805f9b34fb")]
+    assert (loaded.confirmations, loaded.mismatches) == (saved.confirmations, saved.mismatches)
+    db.close()
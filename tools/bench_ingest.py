@@ -0,0 +1,136 @@
+import argparse
+import io
+import os
+import tempfile
+import threading
+import time
+
+from lib.db import BluetoothDatabase
+from lib.db_writer import db_writer
+from lib.ble_scanner import ble_scanner
+from lib.ble_coalescer import ble_coalescer
+from lib.ble_device import ble_device
+from lib.ble_replay import advert_recorder, replay_backend, synthetic_backend
+from lib.metrics import metrics
+
+# end to end ingest benchmark without a radio:
+#   python -m tools.bench_ingest --devices 500 --rate 5 --duration 30
+#   python -m tools.bench_ingest --replay adverts.rec --speed 10
+#   python -m tools.bench_ingest --devices 200 --record adverts.rec
+#   python -m tools.bench_ingest --devices 500 --ui
+
+def main():
+    parser = argparse.ArgumentParser(description="BLE ingest benchmark")
+    parser.add_argument("--replay", help="recording to replay instead of synthetic devices")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed, 0 = as fast as possible")
+    parser.add_argument("--devices", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=10.0, help="adverts per second and device")
+    parser.add_argument("--rotation", type=float, default=900, help="seconds between address rotations")
+    parser.add_argument("--adapters", type=int, default=0, help="simulated adapters (0: single default adapter)")
+    parser.add_argument("--loss", type=float, default=0.0, help="share of adverts each simulated adapter misses")
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--window", type=float, default=1.0, help="coalescing window")
+    parser.add_argument("--db", help="database file (default: temporary)")
+    parser.add_argument("--profile", default="default")
+    parser.add_argument("--record", help="also record the generated adverts to this file")
+    parser.add_argument("--ui", action="store_true", help="also feed the TUITable and render it once per second")
+    args = parser.parse_args()
+
+    if args.replay:
+        backend = replay_backend(args.replay, speed=args.speed or None)
+    else:
+        backend = synthetic_backend(args.devices, args.rate, args.rotation, seed=1, loss=args.loss)
+
+    tmp = None
+    db_path = args.db
+    if db_path is None:
+        tmp = tempfile.TemporaryDirectory()
+        db_path = os.path.join(tmp.name, "bench.db")
+
+    db = BluetoothDatabase(db_path, profile=args.profile)
+    writer = db_writer(db)
+
+    ui = None
+    ui_stats = metrics()
+    ui_lock = threading.Lock()
+    if args.ui:
+        # rich and matplotlib are only needed for this
+        from rich.console import Console
+        from lib.UI import TUITable
+        ui = TUITable()
+        ui.console = Console(file=io.StringIO(), width=160, force_terminal=True)
+
+    def ble_callback(record):
+        device = ble_device(record)
+        writer.insert_ble_device(device)
+        if ui:
+            with ui_lock, ui_stats.timer("ui_update"):
+                ui.update(device)
+
+    def render():
+        # what TUITable.run does every second, into a discarded buffer
+        with ui_stats.timer("ui_render"):
+            with ui_lock:
+                ui._update_table()
+            ui.console.print(ui.table)
+        ui.console.file.seek(0)
+        ui.console.file.truncate()
+        ui_stats.gauge("ui_rows", ui.table.row_count)
+
+    coalescer = ble_coalescer(ble_callback, window=args.window)
+    callback = coalescer
+    recorder = None
+    if args.record:
+        recorder = advert_recorder(args.record, callback=coalescer)
+        callback = recorder
+    adapters = [f"hci{i}" for i in range(args.adapters)] or None
+    scanner = ble_scanner(callback, backend=backend, report_interval=args.duration, adapters=adapters)
+
+    writer.start()
+    coalescer.start()
+    start = time.monotonic()
+    scanner.scan()
+    rendered = start
+    while time.monotonic() - start < args.duration and not backend.done:
+        time.sleep(0.1)
+        if ui and time.monotonic() - rendered >= 1:
+            rendered = time.monotonic()
+            render()
+    scanner.stop()
+    elapsed = time.monotonic() - start
+
+    coalescer.stop()
+    drained = writer.stop(timeout=60)
+    total = time.monotonic() - start
+    if recorder:
+        recorder.close()
+
+    adverts = scanner.stats.get("adverts")
+    records = coalescer.stats.get("records")
+    written = writer.stats.get("written")
+    latency = writer.stats.snapshot()["timings"].get("queue_latency", {})
+    sightings = db.db.execute_single("SELECT COUNT(*) FROM ble_sighting")[0]
+    devices = db.db.execute_single("SELECT COUNT(*) FROM ble_device")[0]
+
+    print(f"adverts:    {adverts} in {elapsed:.1f}s ({adverts / elapsed:.0f}/s)")
+    print(f"records:    {records} after coalescing ({records / max(adverts, 1):.1%})")
+    print(f"written:    {written} in {total:.1f}s ({written / total:.0f}/s), drained: {drained}")
+    print(f"latency:    avg {latency.get('avg', 0) * 1000:.1f}ms max {latency.get('max', 0) * 1000:.1f}ms (queue to commit)")
+    print(f"database:   {devices} devices, {sightings} sightings")
+    if ui:
+        timings = ui_stats.snapshot()["timings"]
+        update, draw = timings.get("ui_update", {}), timings.get("ui_render", {})
+        print(f"ui update:  avg {update.get('avg', 0) * 1e6:.1f}us max {update.get('max', 0) * 1000:.1f}ms ({update.get('count', 0)} devices)")
+        print(f"ui render:  avg {draw.get('avg', 0) * 1000:.1f}ms max {draw.get('max', 0) * 1000:.1f}ms ({draw.get('count', 0)} frames, {ui_stats.get('ui_rows')} rows)")
+    if adapters:
+        heard = dict(db.db.execute("SELECT adapter, COUNT(*) FROM ble_sighting_adapter GROUP BY adapter"))
+        for adapter, count in db.db.execute("SELECT adapter, COUNT(*) FROM ble_sighting GROUP BY adapter"):
+            print(f"  {adapter}: strongest in {count} sightings, {coalescer.stats.get(f'first_{adapter}')} first seen, "
+                  f"heard in {heard.get(adapter, 0)} shared sightings")
+
+    db.close()
+    if tmp:
+        tmp.cleanup()
+
+if __name__ == "__main__":
+    main()
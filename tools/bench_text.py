@@ -0,0 +1,91 @@
+import argparse
+import random
+import time
+
+from lib.db import DB
+from lib.text_similarity import TextSimilarity, trigram_index, ratio
+
+# compares the trigram index and the memoized ratio with plain SequenceMatcher:
+#   python -m tools.bench_text --db db/2024.db --queries 50 --threshold 0.6
+#   python -m tools.bench_text --synthetic 50000
+
+def synthetic_names(n, seed=1):
+    r = random.Random(seed)
+    brands = ["Galaxy Buds", "Bose QC35", "JBL Flip", "Mi Band", "Fitbit Charge", "AirPods", "Pixel",
+              "[TV] Samsung", "LE-Bose", "Tile", "Polar H10", "WH-1000XM", "Echo Dot", "Garmin Venu"]
+    names = []
+    for i in range(n):
+        kind = r.random()
+        if kind < 0.4:
+            names.append("-".join(f"{r.randrange(256):02X}" for _ in range(6)))
+        elif kind < 0.8:
+            names.append(f"{r.choice(brands)} {r.choice(['', '2', '3', 'Pro', 'Lite'])} ({r.randrange(16 ** 4):04X})".replace("  ", " "))
+        else:
+            names.append(f"{r.choice(['Device', 'Sensor', 'Tag', 'Beacon'])} {r.randrange(1000)}")
+    return names
+
+def db_names(path):
+    db = DB(path, profile="analysis")
+    res = db.execute("SELECT name FROM ble_device WHERE name IS NOT NULL UNION SELECT alias FROM ble_device WHERE alias IS NOT NULL") or []
+    db.close()
+    return [r[0] for r in res if r[0]]
+
+def main():
+    parser = argparse.ArgumentParser(description="text similarity benchmark")
+    parser.add_argument("--db", help="take the names and aliases of this database")
+    parser.add_argument("--synthetic", type=int, default=20000, help="number of synthetic names without --db")
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--threshold", type=float, default=0.6)
+    parser.add_argument("--top", type=int, default=10, help="ranking compared for the top results")
+    parser.add_argument("--min-shared", type=int, default=1, help="shared trigrams of a candidate, 0: only the length and character filters")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    names = db_names(args.db) if args.db else synthetic_names(args.synthetic, args.seed)
+    start = time.monotonic()
+    index = trigram_index(names)
+    print(f"index:      {len(index)} unique strings in {time.monotonic() - start:.2f}s")
+
+    queries = random.Random(args.seed).sample(index.texts, min(args.queries, len(index)))
+    brute_time = index_time = 0
+    expected = found = 0
+    same_ranking = 0
+    for query in queries:
+        start = time.monotonic()
+        scores = [(text, ratio(query, text)) for text in index.texts]
+        brute = sorted([s for s in scores if s[1] >= args.threshold], key=lambda x: x[1], reverse=True)
+        brute_time += time.monotonic() - start
+
+        start = time.monotonic()
+        res = index.search(query, args.threshold, min_shared=args.min_shared)
+        index_time += time.monotonic() - start
+
+        got = {text for text, _ in res}
+        expected += len(brute)
+        found += sum(1 for text, _ in brute if text in got)
+        # equal scores may be ordered differently, compare the score sequence
+        if [round(s, 9) for _, s in brute[:args.top]] == [round(s, 9) for _, s in res[:args.top]]:
+            same_ranking += 1
+
+    n = len(queries)
+    print(f"brute:      {brute_time / n * 1000:.1f}ms per query")
+    print(f"index:      {index_time / n * 1000:.1f}ms per query ({brute_time / max(index_time, 1e-9):.0f}x), {index.stats}")
+    print(f"recall:     {found}/{expected} ({found / max(expected, 1):.1%}) above {args.threshold}")
+    print(f"ranking:    top {args.top} equal for {same_ranking}/{n} queries")
+
+    # repeated comparisons, like the attribute loop of ble_stats
+    pairs = [(random.choice(queries), random.choice(index.texts)) for _ in range(2000)] * 5
+    memo = TextSimilarity()
+    memo.cache_clear()
+    start = time.monotonic()
+    for a, b in pairs:
+        ratio(a, b)
+    plain = time.monotonic() - start
+    start = time.monotonic()
+    for a, b in pairs:
+        memo.ratio(a, b)
+    cached = time.monotonic() - start
+    print(f"memo:       {len(pairs)} comparisons {plain * 1000:.0f}ms -> {cached * 1000:.0f}ms, {memo.cache_info()}")
+
+if __name__ == "__main__":
+    main()
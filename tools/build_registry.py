@@ -0,0 +1,9 @@
+from lib.registry import registry
+
+# compile "Assigned Numbers" into registry.bin
+# (also happens automatically on first use when the sources changed)
+
+data = registry.build()
+print(f"{registry.cache_file}: {len(data)} bytes")
+for name, (kind, offset, length) in registry.get().sections.items():
+    print(f"\t{name}: {length} bytes")
@@ -0,0 +1,56 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+
+from lib.db import BluetoothDatabase
+from lib.ble_linking import ble_linker
+from ble_stats import ble_stats
+
+# links a small synthetic database with one known pair (same model, name and
+# payload, two random addresses), fails if the pair ends up in two clusters:
+#   python -m tools.check_linking --devices 60
+
+def address(r):
+    return ":".join(f"{r.randrange(256):02X}" for _ in range(6))
+
+def device(r, name, uuids, payload):
+    a = address(r)
+    return dict(name=name, name2=name, address=a, address2=a, addresstype="random", alias=name or a.replace(":", "-"),
+                legacypairing=0, uuids=uuids, manufacturers="117", manufacturer_binary=payload, advertisingflags="06")
+
+def main():
+    parser = argparse.ArgumentParser(description="check that a known pair is linked")
+    parser.add_argument("--devices", type=int, default=60, help="unrelated devices besides the pair")
+    parser.add_argument("--threshold", type=float, default=0.8)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    r = random.Random(args.seed)
+    rows = []
+    for i in range(args.devices):
+        payload = "".join(f"{r.randrange(256):02x}" for _ in range(10))
+        uuids = f"{r.randrange(65536):08x}-0000-1000-8000-00805f9b34fb" if r.random() < 0.5 else None
+        rows.append(device(r, f"Sensor-{r.randrange(10 ** 6)}", uuids, payload))
+    pair = [device(r, "Galaxy Buds Pro (4F2A)", "0000fd69-0000-1000-8000-00805f9b34fb", "0215aabbccddeeff0011") for _ in range(2)]
+    rows += pair
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = BluetoothDatabase(os.path.join(tmp, "check.db"), profile="analysis")
+        columns = list(rows[0])
+        db.db.execute_silent(f"INSERT INTO ble_device ({', '.join(columns)}) VALUES ({', '.join(':' + c for c in columns)})", rows)
+        stats = ble_stats(db.db)
+        features = stats.get_features()
+        linker = ble_linker(features)
+        labels = linker.link(args.threshold)
+        addresses = {p["address"] for p in pair}
+        rows_of_pair = [i for i in range(len(features)) if features.value("address", i) in addresses]
+        linked = len(rows_of_pair) == 2 and labels[rows_of_pair[0]] == labels[rows_of_pair[1]]
+        print(f"{len(features)} devices: {linker.stats}")
+        print(f"pair {'linked' if linked else 'NOT linked'}")
+        db.close()
+    sys.exit(0 if linked else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+import sys
+from lib.db import BluetoothDatabase, legacy_sightings
+
+# convert the time + *_device_time link tables into the sighting tables
+# usage: python -m tools.migrate_sightings <db path> [--drop]
+
+def migrate(db: BluetoothDatabase, drop=False):
+    tables = db.db.get_tables()
+
+    with db.transaction():
+        db.db.execute_silent("""
+            INSERT OR IGNORE INTO location (name)
+            SELECT DISTINCT geolocation FROM time WHERE geolocation IS NOT NULL;
+        """)
+
+        for link_table, sighting_table in legacy_sightings.items():
+            if link_table not in tables:
+                continue
+
+            before = db.db.execute_single(f"SELECT COUNT(*) FROM {sighting_table}")[0]
+            # 'utc' converts the local timestamps to real epoch seconds
+            db.db.execute_silent(f"""
+                INSERT OR IGNORE INTO {sighting_table} (device_id, ts, location_id)
+                SELECT dt.device_id, CAST(strftime('%s', t.timestamp, 'utc') AS INTEGER), l.id
+                FROM {link_table} dt
+                JOIN time t ON dt.time_id = t.id
+                LEFT JOIN location l ON l.name = t.geolocation
+                WHERE dt.device_id IS NOT NULL AND t.timestamp IS NOT NULL;
+            """)
+            after = db.db.execute_single(f"SELECT COUNT(*) FROM {sighting_table}")[0]
+            print(f"{link_table} -> {sighting_table}: {after - before} sightings")
+
+            if drop:
+                db.db.execute_silent(f"DROP TABLE {link_table}")
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: python -m tools.migrate_sightings <db path> [--drop]")
+        sys.exit(1)
+
+    db = BluetoothDatabase(sys.argv[1])
+    migrate(db, drop="--drop" in sys.argv[2:])
+    db.close()
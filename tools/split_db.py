@@ -1,163 +1,69 @@
-import sqlite3
-
-source_db = "db/db.BAK"
-target_db = "/tmp/test.db"
-
-lower_date = "2024-12-28"
-upper_date = "2024-12-31"
-
-source_conn = sqlite3.connect(source_db)
-target_conn = sqlite3.connect(target_db)
-
-source_cursor = source_conn.cursor()
-target_cursor = target_conn.cursor()
-
-tables = [
-    """CREATE TABLE IF NOT EXISTS time (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        timestamp TIMESTAMP,
-        geolocation TEXT
-    );""",
-    """CREATE TABLE IF NOT EXISTS bluetooth_device_time (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        device_id INTEGER,
-        time_id INTEGER,
-        FOREIGN KEY (device_id) REFERENCES bluetooth_device (id),
-        FOREIGN KEY (time_id) REFERENCES time (id)
-    );""",
-    """CREATE TABLE IF NOT EXISTS ble_device_time (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        device_id INTEGER,
-        time_id INTEGER,
-        FOREIGN KEY (device_id) REFERENCES ble_device (id),
-        FOREIGN KEY (time_id) REFERENCES time (id)
-    );""",
-    """CREATE TABLE IF NOT EXISTS bluetooth_device (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        address TEXT,
-        name TEXT,
-        device_class TEXT,
-        manufacturer TEXT,
-        version TEXT,
-        hci_version TEXT,
-        lmp_version TEXT,
-        device_type TEXT,
-        device_id TEXT,
-        extra_hci_info TEXT,
-        services TEXT
-    );""",
-    """CREATE TABLE IF NOT EXISTS ble_device (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT,
-        name2 TEXT,
-        address TEXT,
-        address2 TEXT,
-        addresstype TEXT,
-        alias TEXT,
-        appearance TEXT,
-        paired BOOLEAN,
-        bonded BOOLEAN,
-        trusted BOOLEAN,
-        blocked BOOLEAN,
-        legacypairing BOOLEAN,
-        connected BOOLEAN,
-        uuids TEXT,
-        manufacturers TEXT,
-        manufacturer_binary BLOB,
-        ServiceData TEXT,
-        AdvertisingFlags BLOB,
-        txpower INTEGER,
-        servicesresolved BOOLEAN,
-        class_name TEXT,
-        modalias TEXT,
-        icon TEXT
-    );""",
-    """CREATE TABLE IF NOT EXISTS bluetooth_service (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        host TEXT,
-        name TEXT,
-        service_classes TEXT,
-        profiles TEXT,
-        description TEXT,
-        provider TEXT,
-        service_id TEXT,
-        protocol TEXT,
-        port INTEGER
-    );""",
-    """CREATE TABLE IF NOT EXISTS bluetooth_device_service (
-        device_id INTEGER,
-        service_id INTEGER,
-        time_id INTEGER,
-        FOREIGN KEY (device_id) REFERENCES bluetooth_device (id),
-        FOREIGN KEY (service_id) REFERENCES bluetooth_service (id),
-        FOREIGN KEY (time_id) REFERENCES time (id)
-    );"""
-]
-
-for table in tables:
-    target_cursor.execute(table)
-
-source_cursor.execute("""
-    SELECT * FROM time WHERE Date(timestamp) >= ? AND Date(timestamp) <= ?;
-""", (lower_date, upper_date))
-time_rows = source_cursor.fetchall()
-time_ids = [row[0] for row in time_rows]
-
-for row in time_rows:
-    target_cursor.execute("""
-        INSERT INTO time (id, timestamp, geolocation) VALUES (?, ?, ?);
-    """, row)
-
-related_time_tables = [("ble_device_time", "device_id", "time_id"),
-                       ("bluetooth_device_time", "device_id", "time_id")]
-
-device_ids = set()
-for table, device_column, time_column in related_time_tables:
-    source_cursor.execute(f"""
-        SELECT * FROM {table} WHERE {time_column} IN ({','.join('?' * len(time_ids))});
-    """, time_ids)
-    rows = source_cursor.fetchall()
-
-    for row in rows:
-        target_cursor.execute(f"""
-            INSERT INTO {table} VALUES ({','.join(['?'] * len(row))});
-        """, row)
-        device_ids.add(row[1])
-
-device_tables = [("bluetooth_device", "id"), ("ble_device", "id")]
-
-for table, column in device_tables:
-    source_cursor.execute(f"""
-        SELECT * FROM {table} WHERE {column} IN ({','.join('?' * len(device_ids))});
-    """, list(device_ids))
-    rows = source_cursor.fetchall()
-    for row in rows:
-        target_cursor.execute(f"""
-            INSERT INTO {table} VALUES ({','.join(['?'] * len(row))});
-        """, row)
-
-source_cursor.execute(f"""
-    SELECT * FROM bluetooth_device_service WHERE time_id IN ({','.join('?' * len(time_ids))});
-""", time_ids)
-bluetooth_device_service_rows = source_cursor.fetchall()
-service_ids = set()
-
-for row in bluetooth_device_service_rows:
-    target_cursor.execute("""
-        INSERT INTO bluetooth_device_service (device_id, service_id, time_id) VALUES (?, ?, ?);
-    """, row)
-    service_ids.add(row[1])
-
-source_cursor.execute(f"""
-    SELECT * FROM bluetooth_service WHERE id IN ({','.join('?' * len(service_ids))});
-""", list(service_ids))
-bluetooth_service_rows = source_cursor.fetchall()
-
-for row in bluetooth_service_rows:
-    target_cursor.execute("""
-        INSERT INTO bluetooth_service (id, host, name, service_classes, profiles, description, provider, service_id, protocol, port)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
-    """, row)
-
-target_conn.commit()
-
+import argparse
+import datetime
+import sys
+
+from lib.db import DB, BluetoothDatabase, to_epoch, unmigrated_sightings
+
+# copies the sightings of a date range with their devices, locations and
+# classic services into a new database:
+#   python -m tools.split_db --source db/db.BAK --target /tmp/test.db --from 2024-12-28 --to 2024-12-31
+
+sighting_tables = [("ble_sighting", "ble_device"), ("bluetooth_sighting", "bluetooth_device")]
+
+def copy_rows(db, table, where, params=None):
+    # columns both databases have, older sources may lack the newer ones.
+    # Runs in the transaction, on the write connection src is attached to.
+    source = db.db.execute(f"PRAGMA src.table_info({table})") or []
+    if not source:
+        return 0
+    target = set(db.db.get_columns(table))
+    columns = ", ".join(c[1] for c in source if c[1] in target)
+    db.db.execute_silent(f"INSERT OR IGNORE INTO {table} ({columns}) SELECT {columns} FROM src.{table} WHERE {where}", params or {})
+    return db.db.execute_single(f"SELECT COUNT(*) FROM src.{table} WHERE {where}", params or {})[0]
+
+def split(source_db, target_db, lower_date, upper_date):
+    source = DB(source_db, profile="analysis")
+    unmigrated = unmigrated_sightings(source)
+    source.close()
+    if unmigrated:
+        print(f"{source_db} still keeps its sightings in {', '.join(unmigrated)}, run python -m tools.migrate_sightings {source_db} first")
+        return False
+
+    start = datetime.datetime.fromisoformat(lower_date)
+    end = datetime.datetime.fromisoformat(upper_date) + datetime.timedelta(days=1)
+    params = {"start": to_epoch(start), "end": to_epoch(end) - 1}
+    dates = {"lower": lower_date, "upper": upper_date}
+
+    db = BluetoothDatabase(target_db)
+    db.db.execute_silent("ATTACH DATABASE :path AS src", {"path": source_db})
+    try:
+        with db.transaction():
+            copy_rows(db, "location", "1")
+            for sighting_table, device_table in sighting_tables:
+                sightings = copy_rows(db, sighting_table, "ts >= :start AND ts <= :end", params)
+                devices = copy_rows(db, device_table, f"id IN (SELECT device_id FROM src.{sighting_table} WHERE ts >= :start AND ts <= :end)", params)
+                print(f"{sighting_table}: {sightings} sightings of {devices} devices")
+            copy_rows(db, "ble_sighting_adapter", "ts >= :start AND ts <= :end", params)
+
+            # services of classic devices are still linked to the time table
+            copy_rows(db, "time", "Date(timestamp) >= :lower AND Date(timestamp) <= :upper", dates)
+            in_range = "time_id IN (SELECT id FROM src.time WHERE Date(timestamp) >= :lower AND Date(timestamp) <= :upper)"
+            services = copy_rows(db, "bluetooth_device_service", in_range, dates)
+            copy_rows(db, "bluetooth_service", f"id IN (SELECT service_id FROM src.bluetooth_device_service WHERE {in_range})", dates)
+            print(f"bluetooth_device_service: {services} services")
+    finally:
+        db.db.execute_silent("DETACH DATABASE src")
+        db.close()
+    return True
+
+def main():
+    parser = argparse.ArgumentParser(description="copy a date range into a new database")
+    parser.add_argument("--source", default="db/db.BAK")
+    parser.add_argument("--target", default="/tmp/test.db")
+    parser.add_argument("--from", dest="lower", default="2024-12-28", help="first day, YYYY-MM-DD")
+    parser.add_argument("--to", dest="upper", default="2024-12-31", help="last day, YYYY-MM-DD")
+    args = parser.parse_args()
+    sys.exit(0 if split(args.source, args.target, args.lower, args.upper) else 1)
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,57 @@
 from datetime import datetime
-from lib.db import DB
+from lib.db import BluetoothDatabase, to_epoch, content_hash
 
 def update_geolocation(db, date, start_time, end_time, new_geolocation):
     start_time = f"{date} {start_time}"
     end_time = f"{date} {end_time}"
 
     try:
-        datetime.strptime(start_time, "%Y-%m-%d %H:%M")
-        datetime.strptime(end_time, "%Y-%m-%d %H:%M")
+        start = datetime.strptime(start_time, "%Y-%m-%d %H:%M")
+        end = datetime.strptime(end_time, "%Y-%m-%d %H:%M")
     except ValueError:
         print("Invalid date or time format. Use 'YYYY-MM-DD' for date and 'HH:MM' for time.")
         return
 
-    db.execute("""
-        UPDATE time
-        SET geolocation = ?
-        WHERE timestamp >= ? AND timestamp <= ?;
-    """, (new_geolocation, start_time, end_time))
+    location_id = db.get_location_id(new_geolocation)
+    params = {"location_id": location_id, "start": to_epoch(start), "end": to_epoch(end)}
 
-    rows = db.execute("""
-        SELECT * FROM time
-        WHERE timestamp >= ? AND timestamp <= ?;
-    """, (start_time, end_time))
-    print(f"{len(rows)} rows affected")
+    rows = 0
+    with db.transaction():
+        for table in ["ble_sighting", "bluetooth_sighting"]:
+            # index range scan on {table}_ts
+            db.db.execute_silent(f"""
+                UPDATE {table}
+                SET location_id = :location_id
+                WHERE ts >= :start AND ts <= :end;
+            """, params)
+            rows += db.db.execute_single(f"""
+                SELECT COUNT(*) FROM {table}
+                WHERE ts >= :start AND ts <= :end;
+            """, params)[0]
 
-db = DB("../db/db.db")
+        # services of classic devices are still linked to the time table,
+        # geolocation is part of its content hash
+        times = db.db.execute("""
+            SELECT id, timestamp FROM time
+            WHERE timestamp >= :start AND timestamp <= :end;
+        """, {"start": start_time, "end": end_time}) or []
+        updates = []
+        seen = set()
+        for time_id, timestamp in times:
+            h = content_hash("time", {"timestamp": timestamp, "geolocation": new_geolocation})
+            if h in seen or db.db.execute_single("SELECT id FROM time WHERE hash = :hash AND id != :id", {"hash": h, "id": time_id}):
+                # like the backfill: the duplicate is kept, new inserts resolve to the existing row
+                h = f"{h}:{time_id}"
+            seen.add(h)
+            updates.append({"id": time_id, "geolocation": new_geolocation, "hash": h})
+        if updates:
+            db.db.execute_silent("UPDATE time SET geolocation = :geolocation, hash = :hash WHERE id = :id", updates)
+    # cached hash -> id entries of the old values point to the changed rows
+    db.clear_cache()
+
+    print(f"{rows} rows affected")
+
+db = BluetoothDatabase("../db/db.db")
 while True:
     day = input("Day: ")
     if day == "":